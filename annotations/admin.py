@@ -8,7 +8,7 @@ from nested_admin.nested import NestedModelAdmin, NestedTabularInline
 
 from .forms import SubSentenceForm, SubSentenceFormSet, LabelForm
 from .models import Language, TenseCategory, Tense, Corpus, Document, Source, Fragment, \
-    Sentence, Word, Alignment, Annotation, SubCorpus, SubSentence, Label, LabelKey
+    Sentence, Word, Alignment, Annotation, SubCorpus, SubSentence, Label, LabelKey, ImportRun
 
 
 @admin.register(Language)
@@ -103,6 +103,12 @@ class AnnotationAdmin(VersionAdmin):
     readonly_fields = ('words', 'alignment')
 
 
+@admin.register(ImportRun)
+class ImportRunAdmin(admin.ModelAdmin):
+    list_display = ('filename', 'importer', 'corpus', 'rows', 'last_row', 'started_at', 'finished_at', )
+    list_filter = ('corpus', 'importer', )
+
+
 class SubSentenceInline(admin.TabularInline):
     model = SubSentence
     form = SubSentenceForm
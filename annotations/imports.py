@@ -0,0 +1,643 @@
+import csv
+import functools
+import hashlib
+import io
+import multiprocessing
+import queue
+import time
+
+from django.db import NotSupportedError, connections, router, transaction
+from django.utils import timezone
+
+from stats.signals import record_changes
+from .models import Fragment, Sentence, Word, Alignment, ImportRun
+
+# The messages that are sent from the parsing processes to the writer, see ImportPipeline
+HEADER = 'header'
+ROWS = 'rows'
+PROGRESS = 'progress'
+DONE = 'done'
+
+
+def bulk_insert(model, objects, batch_size=None, key=None):
+    """
+    Inserts objects with a bulk insert, and sets their pks.
+    On databases that do not return the pks of a bulk insert (e.g. MySQL), the pks are assigned by the database as
+    usual, and derived from the id of the last insert of the connection, which is safe with concurrent inserts and
+    under any isolation level:
+    - MySQL returns the first pk of a multi-row insert, and InnoDB assigns consecutive pks (in steps of
+      auto_increment_increment) to its rows in the traditional and consecutive lock modes (innodb_autoinc_lock_mode 0
+      and 1). In the interleaved lock mode (2, the default of MySQL 8) the pks are only increasing, so they are read
+      back by the natural key of the objects (see select_pks). Objects without a (unique) natural key are then
+      inserted one by one.
+    - SQLite returns the last pk, and assigns consecutive pks as it allows a single writer only.
+    :param key: the names of the fields that identify every object among the rows inserted since the batch started,
+    e.g. ('fragment_id', 'xml_id') for the Sentences of new Fragments
+    """
+    if not objects:
+        return
+
+    using = router.db_for_write(model)
+    connection = connections[using]
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.using(using).bulk_create(objects, batch_size=batch_size)
+        return
+
+    with connection.cursor() as cursor:
+        increment = 1
+        interleaved = False
+        if connection.vendor == 'mysql':
+            cursor.execute('SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment')
+            lock_mode, increment = cursor.fetchone()
+            if lock_mode == 2:
+                interleaved = True
+                if not has_natural_key(objects, key):
+                    batch_size = 1
+        elif connection.vendor != 'sqlite':
+            raise NotSupportedError('Bulk inserts with pks are not supported on {}'.format(connection.vendor))
+
+        batch_size = batch_size or len(objects)
+        for start in range(0, len(objects), batch_size):
+            batch = objects[start:start + batch_size]
+            model.objects.using(using).bulk_create(batch)
+            if connection.vendor == 'mysql':
+                cursor.execute('SELECT LAST_INSERT_ID()')
+                first_pk = cursor.fetchone()[0]
+            else:
+                cursor.execute('SELECT last_insert_rowid()')
+                first_pk = cursor.fetchone()[0] - (len(batch) - 1) * increment
+            if interleaved and len(batch) > 1:
+                select_pks(model, batch, key, first_pk, using)
+            else:
+                for n, obj in enumerate(batch):
+                    obj.pk = first_pk + n * increment
+
+
+def has_natural_key(objects, key):
+    """
+    :return: whether the given fields (see bulk_insert) are set on all objects, and are unique among them
+    """
+    if not key:
+        return False
+    values = [tuple(getattr(obj, field) for field in key) for obj in objects]
+    return all(None not in value for value in values) and len(set(values)) == len(values)
+
+
+def select_pks(model, objects, key, first_pk, using=None):
+    """
+    Sets the pks of inserted objects by selecting the rows from the first pk of their insert on by their natural key.
+    :param key: the names of the fields that identify every object, see bulk_insert
+    :param first_pk: the pk of the first inserted object, which is the lowest of their pks
+    """
+    filters = {'{}__in'.format(field): {getattr(obj, field) for obj in objects} for field in key}
+    pks = {tuple(row[1:]): row[0]
+           for row in model.objects.using(using).filter(pk__gte=first_pk, **filters).values_list('pk', *key)}
+    for obj in objects:
+        obj.pk = pks[tuple(getattr(obj, field) for field in key)]
+
+
+def bulk_insert_children(model, parents):
+    """
+    Inserts the rows of a model that extends the model of the given (inserted) objects through multi-table
+    inheritance, which a bulk insert does not support. The model should not have fields of its own.
+    """
+    if not parents:
+        return
+
+    if [field for field in model._meta.local_concrete_fields if field != model._meta.pk]:
+        raise NotSupportedError('Bulk inserts of {} are not supported, as it has fields'.format(model.__name__))
+
+    connection = connections[router.db_for_write(model)]
+    quote_name = connection.ops.quote_name
+    sql = 'INSERT INTO {} ({}) VALUES (%s)'.format(quote_name(model._meta.db_table), quote_name(model._meta.pk.column))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [(parent.pk, ) for parent in parents])
+
+
+def row_key(row):
+    """
+    :return: the idempotency key of a row of an import file, which is stored as the import_key of its Fragment
+    """
+    return hashlib.sha256('\x1f'.join(row).encode('utf-8')).hexdigest()
+
+
+def file_checksum(filename, chunk_size=1 << 20):
+    """
+    :return: the SHA-256 checksum of a file, which identifies the ImportRun of the file
+    """
+    checksum = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def parse_sentences(element, target_ids=()):
+    """
+    Parses the Sentences and Words from the XML of a Fragment, without saving them.
+    :param element: the parsed XML
+    :param target_ids: the xml_ids of the target Words
+    :return: a list of (Sentence, list of Words) tuples
+    """
+    sentences = []
+    for s in element.xpath('.//s'):
+        words = []
+        for w in s.xpath('.//w'):
+            xml_id = w.get('id')
+            is_in_dialogue_prob = float(w.get('dialog', 0))
+            words.append(Word(xml_id=xml_id,
+                              word=w.text,
+                              pos=w.get('tree') or w.get('pos') or w.get('hun') or '?',
+                              lemma=w.get('lem', '?'),
+                              is_in_dialogue_prob=is_in_dialogue_prob,
+                              is_in_dialogue=is_in_dialogue_prob > 0,
+                              is_target=xml_id in target_ids))
+        sentences.append((Sentence(xml_id=s.get('id')), words))
+    return sentences
+
+
+class ParsedFragment:
+    """
+    A Fragment that has been parsed from an import file, together with its Sentences, Words, Labels and translations,
+    none of which have been saved yet. The formal structure and sentence function are set from the parsed Words,
+    so that the Fragment does not have to be saved again after its Words have been created.
+    """
+
+    def __init__(self, fragment, sentences, labels=None, check_structure=False):
+        """
+        :param fragment: the (unsaved) Fragment
+        :param sentences: the Sentences and Words of the Fragment, see parse_sentences
+        :param labels: the Labels of the Fragment
+        :param check_structure: whether the Corpus checks the formal structure and sentence function
+        """
+        self.fragment = fragment
+        self.sentences = sentences
+        self.labels = labels or []
+        self.translations = []
+        self.alignments = []  # set by the FragmentWriter, in the order of the translations
+
+        # Fragments that already exist (e.g. when appending translations) are left as they are
+        if fragment.pk is None:
+            words = [word for _, sentence_words in sentences for word in sentence_words]
+            fragment.formal_structure = Fragment.formal_structure_of(check_structure, words)
+            fragment.sentence_function = Fragment.sentence_function_of(check_structure, fragment.tense, words)
+
+    def add_translation(self, translation, alignment_type):
+        """
+        Adds a translated Fragment, that will be aligned to this Fragment. The translation of a new Fragment is keyed
+        on the import_key of that Fragment, so that its pk can be read back after a bulk insert (see bulk_insert).
+        """
+        if self.fragment.pk is None and self.fragment.import_key and not translation.fragment.import_key:
+            translation.fragment.import_key = row_key([self.fragment.import_key, str(len(self.translations))])
+        self.translations.append((translation, alignment_type))
+
+    def all_fragments(self):
+        return [self] + [translation for translation, _ in self.translations]
+
+
+class FragmentWriter:
+    """
+    Collects ParsedFragments and inserts them in batches: every batch is inserted in a single transaction, using a
+    bulk insert per table. Rows of a batch that has not been flushed yet are not in the database.
+    The original Fragment of a ParsedFragment may already exist, in which case only its translations are inserted.
+    The pks of all inserted objects are set, so that e.g. Annotations can be created for the Alignments afterwards.
+    Fragments with an import_key that has already been imported in their Document are skipped (with their
+    translations), so that importing the same rows again does not create duplicates.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.batch = []
+        self.n_fragments = 0
+
+    def add(self, parsed):
+        self.batch.append(parsed)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.write(self.batch)
+        self.batch = []
+
+    def write(self, batch):
+        """
+        Inserts a batch of ParsedFragments in a single transaction.
+        """
+        with transaction.atomic():
+            batch = self.exclude_imported(batch)
+            if not batch:
+                return
+
+            fragments = [p for parsed in batch for p in parsed.all_fragments() if p.fragment.pk is None]
+            self.insert_fragments(batch, [p.fragment for p in fragments])
+
+            Fragment.labels.through.objects.bulk_create(
+                [Fragment.labels.through(fragment_id=p.fragment.pk, label_id=label.pk)
+                 for p in fragments for label in p.labels],
+                batch_size=self.batch_size)
+
+            sentences = []
+            for p in fragments:
+                for sentence, _ in p.sentences:
+                    sentence.fragment_id = p.fragment.pk
+                    sentences.append(sentence)
+            bulk_insert(Sentence, sentences, self.batch_size, key=('fragment_id', 'xml_id'))
+
+            words = []
+            for p in fragments:
+                for sentence, sentence_words in p.sentences:
+                    for word in sentence_words:
+                        word.sentence_id = sentence.pk
+                        words.append(word)
+            bulk_insert(Word, words, self.batch_size, key=('sentence_id', 'xml_id'))
+
+            alignments = []
+            for parsed in batch:
+                parsed.alignments = [Alignment(original_fragment_id=parsed.fragment.pk,
+                                               translated_fragment_id=translation.fragment.pk,
+                                               type=alignment_type)
+                                     for translation, alignment_type in parsed.translations]
+                alignments.extend(parsed.alignments)
+            bulk_insert(Alignment, alignments, self.batch_size, key=('translated_fragment_id', ))
+
+            # The bulk inserts do not send the signals that mark the Fragments as changed for the Scenarios
+            record_changes([parsed.fragment.pk for parsed in batch])
+
+        self.n_fragments += len(batch)
+
+    def insert_fragments(self, batch, fragments):
+        """
+        Inserts the new Fragments of a batch (original Fragments and translations), and sets their pks.
+        """
+        bulk_insert(Fragment, fragments, self.batch_size, key=('document_id', 'import_key'))
+
+    def exclude_imported(self, batch):
+        """
+        :return: the ParsedFragments of a batch of which the import_key has not been imported before
+        """
+        keys = [parsed.fragment.import_key for parsed in batch
+                if parsed.fragment.pk is None and parsed.fragment.import_key]
+        if not keys:
+            return batch
+
+        imported = set(Fragment.objects.filter(import_key__in=keys).values_list('document_id', 'import_key'))
+        result = []
+        for parsed in batch:
+            fragment = parsed.fragment
+            if fragment.pk is None and fragment.import_key:
+                key = (fragment.document_id, fragment.import_key)
+                if key in imported:
+                    continue
+                imported.add(key)
+            result.append(parsed)
+        return result
+
+
+class Importer:
+    """
+    The steps of importing the rows of a .csv-file, see ImportPipeline.
+    If a name is set, the progress of the import of a file into the corpus is recorded in an ImportRun.
+    """
+    name = None
+    corpus = None
+
+    def parse(self, header, row):
+        """
+        Parses and validates a row. This is called in a parsing process, and should thus not query the database.
+        :param header: the header row of the file
+        :return: the parsed row, which is sent to the writer
+        :raise ValueError: if the row is invalid
+        """
+        raise NotImplementedError
+
+    def start(self, header):
+        """
+        Prepares the import of a file in the writer, e.g. by retrieving the Languages from the header row.
+        :return: the context that is passed to resolve and write
+        """
+        return None
+
+    def resolve(self, context, item):
+        """
+        Looks up the objects a parsed row refers to, in the writer.
+        :raise ValueError: if the row refers to objects that do not exist
+        """
+        return item
+
+    def write(self, context, items):
+        """
+        Writes a batch of resolved rows to the database, in a single transaction.
+        """
+        raise NotImplementedError
+
+    def finish(self, context):
+        """
+        Finishes the import of a file in the writer.
+        """
+
+
+class FileReport:
+    """
+    The outcome of the import of a file: the number of imported rows, the rows that failed, and the throughput.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.rows = 0
+        self.errors = []
+        self.start = time.time()
+        self.seconds = None
+
+    def finish(self):
+        self.seconds = time.time() - self.start
+
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0
+
+    def __str__(self):
+        return '{}: imported {} rows in {:.1f} seconds ({:.0f} rows/second), {} rows failed'.format(
+            self.filename, self.rows, self.seconds or 0, self.rows_per_second(), len(self.errors))
+
+
+def read_rows(f, delimiter=';', progress=None, progress_every=1000):
+    """
+    Streams the rows of a .csv-file, without reading the whole file into memory. A UTF-8 BOM is skipped.
+    :param f: the file, opened in binary mode (e.g. an uploaded file) or in text mode
+    :param progress: a function that is called with the number of bytes read, every progress_every rows
+    :return: a generator of rows
+    """
+    if isinstance(f.read(0), bytes):
+        buffer = f
+        text = io.TextIOWrapper(f, encoding='utf-8-sig', newline='')
+    else:
+        buffer = getattr(f, 'buffer', None)
+        text = f
+
+    try:
+        for n, row in enumerate(csv.reader(text, delimiter=delimiter), start=1):
+            if n == 1 and row and row[0].startswith('\ufeff'):
+                row[0] = row[0][1:]
+            yield row
+            if progress and buffer and n % progress_every == 0:
+                progress(buffer.tell())
+        if progress and buffer:
+            progress(buffer.tell())
+    finally:
+        # Do not close the file of the caller when the wrapper is garbage collected
+        if text is not f:
+            text.detach()
+
+
+def parse_batches(importer, rows, batch_size, skip=0, retry=()):
+    """
+    Parses the rows of a .csv-file, the first of which is the header row.
+    :param skip: the line up to which the rows are skipped, e.g. the last processed row of an ImportRun
+    :param retry: the lines of the skipped rows that are parsed nevertheless, e.g. the failed rows of an ImportRun
+    :return: a generator of messages: first the header, then the parsed rows and the invalid rows in batches
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return
+    yield HEADER, header
+
+    items = []
+    errors = []
+    for line, row in enumerate(rows, start=2):
+        if line <= skip and line not in retry:
+            continue
+        try:
+            items.append((line, importer.parse(header, row)))
+        except (ValueError, IndexError, SyntaxError) as e:  # lxml's XMLSyntaxError is a SyntaxError
+            errors.append((line, str(e)))
+        if len(items) >= batch_size:
+            yield ROWS, (items, errors)
+            items = []
+            errors = []
+    yield ROWS, (items, errors)
+
+
+def parse_files(importer, tasks, results, batch_size, current):
+    """
+    Parses files until a None is received. Runs in a parsing process of an ImportPipeline.
+    :param tasks: a queue with the index and the filename of the files to parse, the line up to which the rows are
+    skipped, and the lines to retry
+    :param results: a (bounded) queue to send the parsed rows (and the progress) to the writer
+    :param current: a shared value to record the index of the file that is being parsed, in case the process dies
+    """
+    for index, filename, skip, retry in iter(tasks.get, None):
+        current.value = index
+        error = None
+        try:
+            with open(filename, 'rb') as f:
+                rows = read_rows(f, progress=lambda offset: results.put((filename, PROGRESS, offset)),
+                                 progress_every=batch_size)
+                for kind, payload in parse_batches(importer, rows, batch_size, skip, retry):
+                    results.put((filename, kind, payload))
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+        results.put((filename, DONE, error))
+
+
+class ImportPipeline:
+    """
+    Imports .csv-files with an Importer. The files are parsed and validated in a pool of processes, which send the
+    parsed rows in batches through a bounded queue to a single writer (the current process). The writer looks up the
+    objects the rows refer to, and writes every batch in a single transaction.
+    Invalid rows are skipped and reported per file, unless strict is set, in which case the import stops.
+    The progress is reported by calling progress with the filename and the number of bytes read, if given.
+    The last processed row of every file is recorded in an ImportRun (if the Importer has a name), so that importing
+    the same file again resumes after that row. Invalid rows are not imported again, but the rows that could not be
+    written (e.g. because they refer to objects that do not exist yet) are recorded in the ImportRun and retried.
+    The file of a parsing process that dies (e.g. killed by the OOM killer) fails, rather than blocking the writer.
+    """
+    # The number of seconds the writer waits for a message before it checks whether the parsing processes are alive
+    poll_interval = 1
+
+    def __init__(self, importer, processes=1, batch_size=1000, queue_size=10, strict=False, progress=None):
+        self.importer = importer
+        self.processes = processes
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.strict = strict
+        self.progress = progress
+
+    def run(self, filenames):
+        """
+        :return: a generator of FileReports, in order of completion
+        """
+        runs = {filename: self.start_run(filename) for filename in filenames}
+        if self.processes <= 1 or len(filenames) <= 1:
+            for filename in filenames:
+                with open(filename, 'rb') as f:
+                    progress = functools.partial(self.progress, filename) if self.progress else None
+                    rows = read_rows(f, progress=progress, progress_every=self.batch_size)
+                    yield self.import_rows(rows, filename, runs[filename])
+            return
+
+        # Database connections cannot be shared between processes
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        tasks = context.Queue()
+        results = context.Queue(self.queue_size)
+        for index, filename in enumerate(filenames):
+            tasks.put((index, filename, *self.resume_from(runs[filename])))
+        workers = []
+        for _ in range(min(self.processes, len(filenames))):
+            current = context.Value('i', -1, lock=False)
+            worker = context.Process(target=parse_files, args=(self.importer, tasks, results, self.batch_size, current))
+            workers.append((worker, current))
+            tasks.put(None)
+            worker.start()
+
+        try:
+            contexts = dict()
+            reports = dict()
+            remaining = set(filenames)
+            while remaining:
+                try:
+                    messages = [results.get(timeout=self.poll_interval)]
+                except queue.Empty:
+                    messages = self.check_workers(workers, results, filenames, remaining)
+
+                for filename, kind, payload in messages:
+                    report = reports.setdefault(filename, FileReport(filename))
+                    if kind == HEADER:
+                        contexts[filename] = self.importer.start(payload)
+                    elif kind == ROWS:
+                        self.write(contexts[filename], report, *payload, run=runs[filename])
+                    elif kind == PROGRESS:
+                        if self.progress:
+                            self.progress(filename, payload)
+                    elif filename in remaining:
+                        remaining.discard(filename)
+                        if payload:
+                            self.fail(report, None, payload)
+                        if filename in contexts:
+                            self.importer.finish(contexts[filename])
+                        self.finish_run(runs[filename], report)
+                        report.finish()
+                        yield report
+        finally:
+            for worker, _ in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+    def check_workers(self, workers, results, filenames, remaining):
+        """
+        Checks whether the parsing processes are alive. A process that has died never reports its file as done,
+        so that file fails. If all processes have exited, the files that are left fail as well. These may include
+        files that a process had parsed before it died, if the queue had not sent their last messages yet. The rows
+        that were not written are imported when the files are imported again, see ImportRun.
+        :param workers: the parsing processes, with the index of the file they are parsing
+        :param remaining: the files that have not been reported as done
+        :return: the messages to handle: a message that was sent just before the check, or the failed files
+        """
+        exited = [(worker, current) for worker, current in workers if not worker.is_alive()]
+
+        # The messages of a process that has exited normally have been flushed to the queue
+        try:
+            return [results.get(block=False)]
+        except queue.Empty:
+            pass
+
+        messages = []
+        for worker, current in exited:
+            if current.value >= 0 and filenames[current.value] in remaining:
+                messages.append((filenames[current.value], DONE,
+                                 'The parsing process exited with code {}'.format(worker.exitcode)))
+        if len(exited) == len(workers):
+            failed = {filename for filename, _, _ in messages}
+            messages.extend((filename, DONE, 'The parsing processes exited before the file was parsed')
+                            for filename in sorted(remaining - failed))
+        return messages
+
+    def import_rows(self, rows, filename='', run=None):
+        """
+        Imports the rows of a file in the current process.
+        :param run: the ImportRun of the file, if any
+        :return: the FileReport
+        """
+        report = FileReport(filename)
+        context = None
+        for kind, payload in parse_batches(self.importer, rows, self.batch_size, *self.resume_from(run)):
+            if kind == HEADER:
+                context = self.importer.start(payload)
+            else:
+                self.write(context, report, *payload, run=run)
+        if context is not None:
+            self.importer.finish(context)
+        self.finish_run(run, report)
+        report.finish()
+        return report
+
+    def start_run(self, filename):
+        """
+        Retrieves the ImportRun of a file by its checksum, or creates a new one.
+        :return: the ImportRun, or None if the Importer has no name
+        """
+        if not self.importer.name:
+            return None
+        run, _ = ImportRun.objects.get_or_create(corpus=self.importer.corpus, importer=self.importer.name,
+                                                 checksum=file_checksum(filename), defaults=dict(filename=filename))
+        return run
+
+    def resume_from(self, run):
+        """
+        :return: the line up to which the rows of a file are skipped, and the lines of the failed rows to retry
+        """
+        return (run.last_row, set(run.failed_rows)) if run else (0, set())
+
+    def checkpoint(self, run, lines, rows, failed=()):
+        """
+        Records that the rows on the given lines have been processed: they have either been written, or reported as
+        invalid. The rows that failed to be written are recorded to be retried.
+        :param rows: the number of rows that have been written
+        """
+        if run and lines:
+            run.last_row = max(run.last_row, max(lines))
+            run.rows += rows
+            run.failed_rows = sorted(set(run.failed_rows).difference(lines).union(failed))
+            run.save(update_fields=['last_row', 'rows', 'failed_rows'])
+
+    def finish_run(self, run, report):
+        """
+        Records that the import of a file has finished, unless rows have failed.
+        """
+        if run and not report.errors and not run.failed_rows and not run.finished_at:
+            run.finished_at = timezone.now()
+            run.save(update_fields=['finished_at'])
+
+    def write(self, context, report, items, errors, run=None):
+        for line, error in errors:
+            self.fail(report, line, error)
+
+        # The rows that cannot be resolved or written are retried when the file is imported again
+        resolved = []
+        failed = []
+        for line, item in items:
+            try:
+                resolved.append((line, self.importer.resolve(context, item)))
+            except ValueError as e:
+                self.fail(report, line, str(e))
+                failed.append(line)
+
+        # The checkpoint is committed together with the batch
+        lines = [line for line, _ in items] + [line for line, _ in errors]
+        try:
+            with transaction.atomic():
+                self.importer.write(context, [item for _, item in resolved])
+                self.checkpoint(run, lines, len(resolved), failed)
+            report.rows += len(resolved)
+        except Exception as e:
+            if self.strict:
+                raise
+            for line, _ in resolved:
+                report.errors.append((line, str(e)))
+            self.checkpoint(run, lines, 0, failed + [line for line, _ in resolved])
+
+    def fail(self, report, line, error):
+        if self.strict:
+            raise ValueError('Line {}: {}'.format(line, error) if line else error)
+        report.errors.append((line, error))
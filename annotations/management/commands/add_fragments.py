@@ -1,13 +1,15 @@
-import csv
-
 from lxml import etree
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 from django.db.models import Case, When
 
 from .constants import COLUMN_DOCUMENT, COLUMN_TYPE, COLUMN_IDS, COLUMN_XML, FROM_WIDTH, TO_WIDTH
-from annotations.models import Language, Tense, Corpus, Document, Fragment, Sentence, Word, Alignment, LabelKey
+from .utils import report_import, report_progress
+from annotations.imports import FragmentWriter, ImportPipeline, Importer, ParsedFragment, parse_sentences, read_rows, \
+    row_key
+from annotations.models import Language, Tense, Corpus, Document, Fragment, Sentence, Word, Alignment, Label, \
+    LabelKey, ImportRun
+from annotations.structure import recompute_structure
 
 
 class Command(BaseCommand):
@@ -20,6 +22,13 @@ class Command(BaseCommand):
         parser.add_argument('--label_titles', dest='label_titles', nargs='+')
         parser.add_argument('--delete', action='store_true', dest='delete', default=False,
                             help='Delete existing Fragments (and contents) for this Corpus')
+        parser.add_argument('--bulk', action='store_true', dest='bulk', default=False,
+                            help='Insert the Fragments in batches, rather than one row per transaction')
+        parser.add_argument('--batch_size', type=int, dest='batch_size', default=1000,
+                            help='The number of rows per batch in bulk mode')
+        parser.add_argument('--processes', type=int, dest='processes', default=1,
+                            help='Parse the files in this number of processes (implies --bulk). '
+                                 'Invalid rows are then skipped and reported.')
 
     def handle(self, *args, **options):
         # Retrieve the Corpus from the database
@@ -33,20 +42,40 @@ class Command(BaseCommand):
 
         if options['delete']:
             Fragment.objects.filter(document__corpus=corpus).delete()
+            ImportRun.objects.filter(corpus=corpus).delete()
 
-        for filename in options['filenames']:
-            with open(filename, 'rb') as f:
-                try:
-                    process_file(f, corpus, label_titles=options['label_titles'])
-                    self.stdout.write(self.style.SUCCESS('Successfully imported fragments'))
-                except Exception as e:
-                    raise CommandError(e)
-
-
-def process_file(f, corpus, label_pks=None, label_titles=None):
-    lines = f.read().decode('utf-8-sig').splitlines()
-    csv_reader = csv.reader(lines, delimiter=';')
-
+        # Without --bulk, every row is inserted in its own transaction
+        batch_size = options['batch_size'] if options['bulk'] or options['processes'] > 1 else 1
+        importer = FragmentImporter(corpus, retrieve_label_keys(corpus, label_titles=options['label_titles']))
+        pipeline = ImportPipeline(importer, options['processes'], batch_size,
+                                  strict=options['processes'] <= 1, progress=report_progress(self))
+        try:
+            report_import(self, pipeline, options['filenames'])
+        except (ValueError, Language.DoesNotExist) as e:
+            raise CommandError(e)
+
+
+def process_file(f, corpus, label_pks=None, label_titles=None, bulk=False, batch_size=1000, progress=None):
+    """
+    Imports the Fragments (and their translations) from a .csv-file generated by PerfectExtractor, see
+    FragmentImporter. The rows are streamed from the file, see read_rows.
+    Rows that have been imported before are skipped. When a row fails, the batches before it have been committed,
+    while the rows of its batch have not.
+    :param bulk: whether to insert the Fragments in batches, rather than one row per transaction
+    :param batch_size: the number of rows per batch in bulk mode
+    :param progress: a function that is called with the number of bytes read
+    :return: the number of imported rows
+    """
+    label_keys = retrieve_label_keys(corpus, label_pks, label_titles)
+    pipeline = ImportPipeline(FragmentImporter(corpus, label_keys), batch_size=batch_size if bulk else 1, strict=True)
+    return pipeline.import_rows(read_rows(f, progress=progress)).rows
+
+
+def retrieve_label_keys(corpus, label_pks=None, label_titles=None):
+    """
+    Retrieves the LabelKeys for the type column(s), in the given order.
+    If no LabelKeys are given, the type column contains the Tense.
+    """
     # Solution to preserve order taken from https://stackoverflow.com/a/37648265
     label_keys = LabelKey.objects.none()
     if label_pks:
@@ -55,42 +84,94 @@ def process_file(f, corpus, label_pks=None, label_titles=None):
     elif label_titles:
         preserved = Case(*[When(title=title, then=pos) for pos, title in enumerate(label_titles)])
         label_keys = LabelKey.objects.filter(title__in=label_titles, corpora=corpus).order_by(preserved)
-    additional_columns = len(label_keys) - 1 if label_keys else 0
-
-    for n, row in enumerate(csv_reader):
-        # Retrieve the languages from the first row of the output
-        if n == 0:
-            language_from, languages_to = retrieve_languages(row, additional_columns)
-            continue
-
-        # For every other line, create a Fragment and its Alignments
-        with transaction.atomic():
-            doc, _ = Document.objects.get_or_create(corpus=corpus, title=row[COLUMN_DOCUMENT])
-
-            from_fragment = Fragment.objects.create(language=language_from, document=doc)
-
-            # Add Labels or Tense (the default) to Fragment
-            if label_keys:
-                for i, label_key in enumerate(label_keys):
-                    label_title = row[COLUMN_TYPE + i]
-                    label, _ = label_key.labels.get_or_create(language=language_from, title=label_title)
-                    from_fragment.labels.add(label)
-            else:
-                tense_title = row[COLUMN_TYPE]
-                try:
-                    from_fragment.tense = Tense.objects.get(language=language_from, title=tense_title)
-                except Tense.DoesNotExist:
-                    raise ValueError('Unknown tense: {}'.format(tense_title))
-
-            from_fragment.save()
-
-            # Add Sentences to Fragment
-            xml_column = row[COLUMN_XML + additional_columns]
-            ids_column = row[COLUMN_IDS + additional_columns]
-            add_sentences(from_fragment, xml_column, ids_column.split(' '))
-
-            # Create the Fragments in other Languages and add the Alignment object
-            create_to_fragments(doc, from_fragment, languages_to, row)
+    return label_keys
+
+
+class FragmentImporter(Importer):
+    """
+    Imports the rows of a .csv-file generated by PerfectExtractor in batches (see ImportPipeline).
+    The rows are parsed without querying the database. The Documents, Tenses and Labels are then looked up in
+    dictionaries (see FragmentLookup), and the Fragments are inserted with a FragmentWriter.
+    Rows that have been imported before (by their row_key) are skipped.
+    """
+    name = 'add_fragments'
+
+    def __init__(self, corpus, label_keys):
+        self.corpus = corpus
+        self.label_keys = list(label_keys)
+        self.additional_columns = len(self.label_keys) - 1 if self.label_keys else 0
+
+    def parse(self, header, row):
+        xml_column = row[COLUMN_XML + self.additional_columns]
+        ids_column = row[COLUMN_IDS + self.additional_columns]
+        types = row[COLUMN_TYPE:COLUMN_TYPE + (len(self.label_keys) or 1)]
+        sentences = parse_sentences(etree.fromstring(xml_column), ids_column.split(' '))
+
+        # Parse the Fragments in other Languages
+        translations = [(m, row[m - 1], parse_sentences(etree.fromstring(row[m])))
+                        for m in range(FROM_WIDTH + self.additional_columns + 1, len(header), TO_WIDTH) if row[m]]
+        return row_key(row), row[COLUMN_DOCUMENT], types, sentences, translations
+
+    def start(self, header):
+        return FragmentLookup(self.corpus, self.label_keys, *retrieve_languages(header, self.additional_columns))
+
+    def resolve(self, lookup, item):
+        key, document_title, types, sentences, translations = item
+        document = lookup.document(document_title)
+        check_structure = self.corpus.check_structure
+
+        # Add Labels or Tense (the default) to Fragment
+        labels = []
+        tense = None
+        if self.label_keys:
+            labels = [lookup.label(label_key, title) for label_key, title in zip(self.label_keys, types)]
+        else:
+            tense = lookup.tense(types[0])
+
+        parsed = ParsedFragment(Fragment(language=lookup.language_from, document=document, tense=tense,
+                                         import_key=key),
+                                sentences, labels, check_structure)
+        for m, alignment_type, translation_sentences in translations:
+            translation = ParsedFragment(Fragment(language=lookup.languages_to[m], document=document),
+                                         translation_sentences, check_structure=check_structure)
+            parsed.add_translation(translation, alignment_type)
+        return parsed
+
+    def write(self, lookup, items):
+        FragmentWriter().write(items)
+
+
+class FragmentLookup:
+    """
+    Looks up the Documents, Tenses and Labels of the rows of a file in dictionaries, which are filled from the database
+    first. Documents and Labels that do not exist yet are created.
+    """
+
+    def __init__(self, corpus, label_keys, language_from, languages_to):
+        self.corpus = corpus
+        self.language_from = language_from
+        self.languages_to = languages_to
+
+        self.documents = {d.title: d for d in Document.objects.filter(corpus=corpus)}
+        self.tenses = {t.title: t for t in Tense.objects.filter(language=language_from)}
+        self.labels = {(label.key_id, label.title): label
+                       for label in Label.objects.filter(key__in=label_keys, language=language_from)}
+
+    def document(self, title):
+        if title not in self.documents:
+            self.documents[title], _ = Document.objects.get_or_create(corpus=self.corpus, title=title)
+        return self.documents[title]
+
+    def tense(self, title):
+        if title not in self.tenses:
+            raise ValueError('Unknown tense: {}'.format(title))
+        return self.tenses[title]
+
+    def label(self, label_key, title):
+        if (label_key.pk, title) not in self.labels:
+            self.labels[(label_key.pk, title)], _ = label_key.labels.get_or_create(language=self.language_from,
+                                                                                   title=title)
+        return self.labels[(label_key.pk, title)]
 
 
 def create_to_fragments(document, from_fragment, languages_to, row):
@@ -134,3 +215,6 @@ def add_sentences(fragment, xml, target_ids=[]):
                                 is_in_dialogue=is_in_dialogue,
                                 is_target=is_target,
                                 sentence=sentence)
+
+    # The formal structure and sentence function depend on the Words, which did not exist when the Fragment was saved
+    recompute_structure(Fragment.objects.filter(pk=fragment.pk))
@@ -1,13 +1,12 @@
-import csv
-
 from lxml import etree
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 
-from .constants import COLUMN_DOCUMENT, COLUMN_IDS, COLUMN_XML
-from .add_fragments import retrieve_languages, create_to_fragments
-from annotations.models import Corpus, Document, Sentence
+from .constants import COLUMN_DOCUMENT, COLUMN_IDS, COLUMN_XML, FROM_WIDTH, TO_WIDTH
+from .add_fragments import retrieve_languages
+from .utils import report_import, report_progress
+from annotations.imports import FragmentWriter, ImportPipeline, Importer, ParsedFragment, parse_sentences
+from annotations.models import Corpus, Document, Fragment, Sentence
 
 
 class Command(BaseCommand):
@@ -17,6 +16,11 @@ class Command(BaseCommand):
         parser.add_argument('corpus', type=str)
         parser.add_argument('filenames', type=str, nargs='+')
 
+        parser.add_argument('--batch_size', type=int, dest='batch_size', default=1000,
+                            help='The number of rows that are inserted per transaction')
+        parser.add_argument('--processes', type=int, dest='processes', default=1,
+                            help='Parse the files in this number of processes')
+
     def handle(self, *args, **options):
         # Retrieve the Corpus from the database
         try:
@@ -27,45 +31,64 @@ class Command(BaseCommand):
         if len(options['filenames']) == 0:
             raise CommandError('No documents specified')
 
-        for filename in options['filenames']:
-            with open(filename, 'r') as f:
-                csv_reader = csv.reader(f, delimiter=';')
-                for n, row in enumerate(csv_reader):
-                    # Retrieve the languages from the first row of the output
-                    if n == 0:
-                        language_from, languages_to = retrieve_languages(row)
-                        continue
-
-                    with transaction.atomic():
-                        doc = Document.objects.get(corpus=corpus, title=row[COLUMN_DOCUMENT])
-                        xml_id = get_first_sentence_id(row[COLUMN_XML])
-
-                        # Retrieve the matching sentence
-                        sentences = Sentence.objects.filter(xml_id=xml_id,
-                                                            fragment__language=language_from,
-                                                            fragment__document=doc)
-
-                        if not sentences:
-                            self.stdout.write(self.style.WARNING('No match found for {}'.format(xml_id)))
-                            continue
-
-                        sentence = None
-                        if sentences.count() >= 1:
-                            # Find the matching sentence using the target id's
-                            for s in sentences:
-                                if [w.xml_id for w in s.word_set.filter(is_target=True)] == row[COLUMN_IDS].split(' '):
-                                    sentence = s
-
-                            if sentence is None:
-                                self.stdout.write(self.style.WARNING('No match found for {}'.format(xml_id)))
-                                continue
-                        else:
-                            sentence = sentences.first()
-
-                        # Create the Fragment and Alignment
-                        create_to_fragments(doc, sentence.fragment, languages_to, row)
-
-                    self.stdout.write(self.style.SUCCESS('Line {} processed'.format(n)))
+        # Rows without a matching Fragment are skipped and reported
+        pipeline = ImportPipeline(AppendImporter(corpus), options['processes'], options['batch_size'],
+                                  progress=report_progress(self))
+        report_import(self, pipeline, options['filenames'])
+
+
+class AppendImporter(Importer):
+    """
+    Imports the rows of a .csv-file generated by PerfectExtractor in batches (see ImportPipeline), as translations of
+    existing Fragments. The Fragments are matched on the id of their first Sentence and on their target Words.
+    """
+    name = 'append_fragments'
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    def parse(self, header, row):
+        xml_id = get_first_sentence_id(row[COLUMN_XML])
+        target_ids = row[COLUMN_IDS].split(' ')
+
+        # Parse the Fragments in other Languages
+        translations = [(m, row[m - 1], parse_sentences(etree.fromstring(row[m])))
+                        for m in range(FROM_WIDTH + 1, len(header), TO_WIDTH) if row[m]]
+        return row[COLUMN_DOCUMENT], xml_id, target_ids, translations
+
+    def start(self, header):
+        language_from, languages_to = retrieve_languages(header)
+        documents = {d.title: d for d in Document.objects.filter(corpus=self.corpus)}
+        return language_from, languages_to, documents
+
+    def resolve(self, context, item):
+        language_from, languages_to, documents = context
+        document_title, xml_id, target_ids, translations = item
+        if document_title not in documents:
+            raise ValueError('Unknown document: {}'.format(document_title))
+        document = documents[document_title]
+
+        # Retrieve the matching Sentence, using the target ids
+        fragment = None
+        sentences = Sentence.objects \
+            .filter(xml_id=xml_id, fragment__language=language_from, fragment__document=document) \
+            .select_related('fragment')
+        for s in sentences:
+            if [w.xml_id for w in s.word_set.filter(is_target=True)] == target_ids:
+                fragment = s.fragment
+        if fragment is None:
+            raise ValueError('No match found for {}'.format(xml_id))
+
+        check_structure = self.corpus.check_structure
+        parsed = ParsedFragment(fragment, [], check_structure=check_structure)
+        for m, alignment_type, translation_sentences in translations:
+            translation = ParsedFragment(Fragment(language=languages_to[m], document=document),
+                                         translation_sentences, check_structure=check_structure)
+            parsed.add_translation(translation, alignment_type)
+        return parsed
+
+    def write(self, context, items):
+        FragmentWriter().write(items)
 
 
 def get_first_sentence_id(xml):
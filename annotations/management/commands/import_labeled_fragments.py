@@ -1,13 +1,15 @@
-import csv
 import unicodedata
 
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
-from django.utils import timezone
 
-from annotations.models import Language, Label, Corpus, Document, Fragment, Sentence, Word, Alignment, LabelKey, Annotation
+from annotations.imports import FragmentWriter, ImportPipeline, Importer, ParsedFragment, bulk_insert, read_rows, \
+    row_key
+from annotations.models import Language, Label, Corpus, Document, Fragment, Sentence, Word, LabelKey, Annotation, \
+    ImportRun
 from stats.models import Scenario, ScenarioLanguage
 from stats.utils import run_mds
+from .utils import report_import, report_progress
 
 
 class Command(BaseCommand):
@@ -20,6 +22,11 @@ class Command(BaseCommand):
 
         parser.add_argument('--delete', action='store_true', dest='delete', default=False,
                             help='Delete existing Fragments (and contents) for this Corpus')
+        parser.add_argument('--batch_size', type=int, dest='batch_size', default=1000,
+                            help='The number of rows that are inserted per transaction')
+        parser.add_argument('--processes', type=int, dest='processes', default=1,
+                            help='Parse the files in this number of processes. '
+                                 'Invalid rows are then skipped and reported.')
 
     def handle(self, *args, **options):
         # Retrieve the Corpus from the database, or create it
@@ -38,82 +45,119 @@ class Command(BaseCommand):
 
         if options['delete']:
             Fragment.objects.filter(document__corpus=corpus).delete()
+            ImportRun.objects.filter(corpus=corpus).delete()
 
-        for filename in options['filenames']:
-            with open(filename, 'r') as f:
-                try:
-                    process_file(f, corpus, labelkey)
-                    self.stdout.write(self.style.SUCCESS('Successfully imported fragments'))
-                except Exception as e:
-                    raise e
+        importer = LabeledFragmentImporter(corpus, labelkey)
+        pipeline = ImportPipeline(importer, options['processes'], options['batch_size'],
+                                  strict=options['processes'] <= 1, progress=report_progress(self))
+        report_import(self, pipeline, options['filenames'])
+        create_scenario(corpus, labelkey, importer.languages_from, importer.languages_to)
 
 
 def process_file(file_handler, corpus, key):
-    lines = file_handler.read().splitlines()
-    csv_reader = csv.reader(lines, delimiter=';')
+    importer = LabeledFragmentImporter(corpus, key)
+    ImportPipeline(importer, strict=True).import_rows(read_rows(file_handler))
+    create_scenario(corpus, key, importer.languages_from, importer.languages_to)
 
-    for n, row in enumerate(csv_reader):
-        # Retrieve the languages from the first row of the .csv-file
-        if n == 0:
-            language_from, languages_to = retrieve_languages(row)
-            continue
 
-        # For every other line, create a Fragment and its Alignments
+class LabeledFragmentImporter(Importer):
+    """
+    Imports the rows of a .csv-file with labeled (tokenized) sentences in batches (see ImportPipeline).
+    Every row results in a Fragment with a Label, and a translated Fragment with an Annotation per target language.
+    Rows that have been imported before (by their row_key) are skipped.
+    """
+    name = 'import_labeled_fragments'
+
+    def __init__(self, corpus, key):
+        self.corpus = corpus
+        self.key = key
+        # The Languages of the imported files, see create_scenario
+        self.languages_from = []
+        self.languages_to = []
+
+    def parse(self, header, row):
+        document_title = row[1]
+        sentence_id = 's' + row[2].replace(':', '.')
+        full_text = row[3]
+        label_title = row[4]
+
+        sentence, words, targets = parse_words(sentence_id, full_text, label_title)
+        for target in targets:
+            target.is_target = True
+
+        translations = [(column, row[column], parse_words(sentence_id, row[column - 1], row[column]))
+                        for column in range(6, len(header), 2)]
+        return row_key(row), document_title, label_title, (sentence, words), translations
+
+    def start(self, header):
+        language_from, languages_to = retrieve_languages(header)
+
+        # Attach the Languages to the Corpus
+        self.corpus.languages.add(language_from, *languages_to.values())
+        if language_from not in self.languages_from:
+            self.languages_from.append(language_from)
+        self.languages_to.extend(language for language in languages_to.values() if language not in self.languages_to)
+
+        labels = {(label.language_id, label.title): label for label in Label.objects.filter(key=self.key)}
+        documents = {document.title: document for document in Document.objects.filter(corpus=self.corpus)}
+        return language_from, languages_to, labels, documents
+
+    def label(self, labels, language, title):
+        if not title:
+            return None
+        if (language.pk, title) not in labels:
+            labels[(language.pk, title)], _ = Label.objects.get_or_create(key=self.key, language=language,
+                                                                          title=title)
+        return labels[(language.pk, title)]
+
+    def resolve(self, context, item):
+        language_from, languages_to, labels, documents = context
+        key, document_title, label_title, sentence, translations = item
+
+        # Create a Document and Fragment
+        if document_title not in documents:
+            documents[document_title], _ = Document.objects.get_or_create(corpus=self.corpus, title=document_title)
+        document = documents[document_title]
+
+        label = self.label(labels, language_from, label_title)
+        parsed = ParsedFragment(Fragment(language=language_from, document=document, import_key=key), [sentence],
+                                [label] if label else [], self.corpus.check_structure)
+
+        # Create the translated Fragments, and the targets and Label of their Annotations
+        annotations = []
+        for column, to_label_title, (to_sentence, to_words, to_targets) in translations:
+            language_to = languages_to[column]
+            translation = ParsedFragment(Fragment(language=language_to, document=document),
+                                         [(to_sentence, to_words)], check_structure=self.corpus.check_structure)
+            parsed.add_translation(translation, '1 => 1')
+            annotations.append((to_targets, self.label(labels, language_to, to_label_title)))
+        return parsed, annotations
+
+    def write(self, context, items):
         with transaction.atomic():
-            document_title = row[1]
-            sentence_id = 's' + row[2].replace(':', '.')
-            full_text = row[3]
-            label_title = row[4]
-
-            # Attach language_from to Corpus
-            corpus.languages.add(language_from)
-
-            # Create a Document and Fragment
-            document, _ = Document.objects.get_or_create(corpus=corpus, title=document_title)
-            from_fragment = Fragment.objects.create(language=language_from, document=document)
-
-            # Add Labels or Tense (the default) to Fragment
-            if label_title:
-                label, _ = Label.objects.get_or_create(key=key, language=language_from, title=label_title)
-                from_fragment.labels.add(label)
-            from_fragment.save()
-
-            # Add Sentence and Words
-            sentence = Sentence.objects.create(fragment=from_fragment, xml_id=sentence_id)
-            targets = attach_words(sentence, full_text, label_title)
-
-            for target in targets:
-                target.is_target = True
-                target.save()
+            FragmentWriter().write([parsed for parsed, _ in items])
 
-            for column, language_to in languages_to.items():
-                label_title = row[column]
-                full_text = row[column - 1]
+            # Create an Annotation per Alignment
+            annotations = []
+            for parsed, parsed_annotations in items:
+                for alignment, (targets, label) in zip(parsed.alignments, parsed_annotations):
+                    annotations.append((Annotation(alignment_id=alignment.pk), targets, label))
+            bulk_insert(Annotation, [annotation for annotation, _, _ in annotations], key=('alignment_id', ))
 
-                # Attach language_to to Corpus
-                corpus.languages.add(language_to)
+            Annotation.words.through.objects.bulk_create(
+                [Annotation.words.through(annotation_id=annotation.pk, word_id=target.pk)
+                 for annotation, targets, _ in annotations for target in targets])
+            Annotation.labels.through.objects.bulk_create(
+                [Annotation.labels.through(annotation_id=annotation.pk, label_id=label.pk)
+                 for annotation, _, label in annotations if label])
 
-                # Create Fragment
-                to_fragment = Fragment.objects.create(language=language_to, document=document)
 
-                # Add Sentence and Words to Fragment
-                sentence = Sentence.objects.create(fragment=to_fragment, xml_id=sentence_id)
-                targets = attach_words(sentence, full_text, label_title)
-
-                # Create Alignment and Annotation
-                alignment = Alignment.objects.create(original_fragment=from_fragment,
-                                                     translated_fragment=to_fragment,
-                                                     type='1 => 1')
-                annotation = Annotation.objects.create(alignment=alignment)
-
-                # Add target Words to Annotation
-                for target in targets:
-                    annotation.words.add(target)
-
-                # Add Label to Annotation
-                if label_title:
-                    label, _ = Label.objects.get_or_create(key=key, language=language_to, title=label_title)
-                    annotation.labels.add(label)
+def create_scenario(corpus, key, languages_from, languages_to):
+    """
+    Creates (or updates) the default Scenario of a Corpus, and runs it.
+    """
+    if not languages_from:
+        return
 
     # Create default Scenario
     scenario, _ = Scenario.objects.get_or_create(corpus=corpus, title=corpus.title)
@@ -121,14 +165,13 @@ def process_file(file_handler, corpus, key):
     scenario.save()
 
     # Attach Languages to Scenario
-    attach_language(scenario, language_from, key, as_from=True)
-    for language_to in languages_to.values():
+    for language_from in languages_from:
+        attach_language(scenario, language_from, key, as_from=True)
+    for language_to in languages_to:
         attach_language(scenario, language_to, key, as_from=False)
 
     # Run multidimensional scaling
     run_mds(scenario)
-    scenario.last_run = timezone.now()
-    scenario.save()
 
 
 def attach_language(scenario, language, key, as_from):
@@ -144,22 +187,26 @@ def attach_language(scenario, language, key, as_from):
     sl.save()
 
 
-def attach_words(sentence, full_text, label_title):
+def parse_words(sentence_id, full_text, label_title):
     """
-    Attached Words based on a tokenized full text to a Sentence and finds target Words.
+    Creates (unsaved) Words based on a tokenized full text for a Sentence and finds target Words.
+    :return: the Sentence, its Words, and the target Words
     """
+    sentence = Sentence(xml_id=sentence_id)
+    words = []
     targets = []
     label_parts = label_title.split('=')  # TODO: make this a parameter of some sort
     for i, word in enumerate(full_text.split(), start=1):  # Assumes that the input is tokenized
-        xml_id = sentence.xml_id.replace('s', 'w') + '.' + str(i)
-        w = Word.objects.create(sentence=sentence, xml_id=xml_id, word=word)
+        xml_id = sentence_id.replace('s', 'w') + '.' + str(i)
+        w = Word(xml_id=xml_id, word=word)
+        words.append(w)
 
         # Find the target Words and add them to the list of targets.
         # This is a bit iffy as potentially this matches an earlier occurrence in the sentence.
         if label_parts and remove_accents(word.lower()) == label_parts[0].lower():
             targets.append(w)
             label_parts.pop(0)
-    return targets
+    return sentence, words, targets
 
 
 def retrieve_languages(row):
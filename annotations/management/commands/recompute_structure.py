@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from annotations.models import Corpus, Fragment
+from annotations.structure import recompute_structure
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the formal structure and sentence function of the Fragments in a Corpus.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('corpus', type=str)
+        parser.add_argument('--batch_size', type=int, dest='batch_size', default=1000,
+                            help='The number of Fragments that are recomputed per batch')
+
+    def handle(self, *args, **options):
+        # Retrieve the Corpus from the database
+        try:
+            corpus = Corpus.objects.get(title=options['corpus'])
+        except Corpus.DoesNotExist:
+            raise CommandError('Corpus with title {} does not exist'.format(options['corpus']))
+
+        n_updated = recompute_structure(Fragment.objects.filter(document__corpus=corpus), options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Successfully updated {} Fragments'.format(n_updated)))
@@ -1,5 +1,6 @@
 import contextlib
 import csv
+import os
 
 from xlsxwriter import Workbook
 
@@ -55,3 +56,34 @@ def pad_list(orig_list, pad_length):
     :return: the resulting, padded list
     """
     return orig_list + [''] * (pad_length - len(orig_list))
+
+
+def report_progress(command):
+    """
+    :return: a function that writes the progress of the import of a file (by the number of bytes read)
+    to the output of a command
+    """
+    sizes = dict()
+
+    def progress(filename, offset):
+        if filename not in sizes:
+            sizes[filename] = os.path.getsize(filename)
+        size = sizes[filename]
+        command.stdout.write('{}: read {} of {} bytes ({:.0%})'.format(
+            filename, offset, size, offset / size if size else 1))
+    return progress
+
+
+def report_import(command, pipeline, filenames):
+    """
+    Runs an ImportPipeline, and writes the report of every file (and its failed rows) to the output of a command.
+    :return: the FileReports
+    """
+    reports = []
+    for report in pipeline.run(filenames):
+        style = command.style.WARNING if report.errors else command.style.SUCCESS
+        command.stdout.write(style(str(report)))
+        for line, error in report.errors:
+            command.stdout.write('  line {}: {}'.format(line, error) if line else '  {}'.format(error))
+        reports.append(report)
+    return reports
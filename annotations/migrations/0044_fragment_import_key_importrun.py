@@ -0,0 +1,40 @@
+# Generated by Django 3.2.8 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotations', '0043_alter_corpus_is_public'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fragment',
+            name='import_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='fragment',
+            unique_together={('document', 'import_key')},
+        ),
+        migrations.CreateModel(
+            name='ImportRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('importer', models.CharField(max_length=200)),
+                ('filename', models.CharField(max_length=500)),
+                ('checksum', models.CharField(max_length=64)),
+                ('last_row', models.PositiveIntegerField(default=0)),
+                ('rows', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('corpus', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='annotations.corpus')),
+            ],
+            options={
+                'unique_together': {('corpus', 'importer', 'checksum')},
+            },
+        ),
+    ]
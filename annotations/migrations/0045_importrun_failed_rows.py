@@ -0,0 +1,18 @@
+# Generated by Django 3.2.8 on 2026-10-17 19:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('annotations', '0044_fragment_import_key_importrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importrun',
+            name='failed_rows',
+            field=models.JSONField(blank=True, default=list, help_text='The lines of the rows that could not be written, before the last row'),
+        ),
+    ]
@@ -224,6 +224,8 @@ class Fragment(models.Model, HasLabelsMixin):
         (SF_EXCLAMATORY, 'exclamatory'),
         (SF_IMPERATIVE, 'imperative'),
     )
+    # The Words that determine the sentence function
+    SF_PUNCTUATION = ('?', '!')
 
     language = models.ForeignKey(Language, on_delete=models.CASCADE)
     document = models.ForeignKey(Document, on_delete=models.CASCADE)
@@ -237,6 +239,12 @@ class Fragment(models.Model, HasLabelsMixin):
     sentence_function = models.PositiveIntegerField(
         'Sentence function', choices=SENTENCE_FUNCTIONS, default=SF_NONE)
 
+    # A hash of the imported row, so that importing the same row again does not create a duplicate Fragment
+    import_key = models.CharField(max_length=64, blank=True, null=True, editable=False)
+
+    class Meta:
+        unique_together = ('document', 'import_key', )
+
     def to_html(self):
         result = '<ul>'
         for sentence in self.sentence_set.all():
@@ -297,33 +305,73 @@ class Fragment(models.Model, HasLabelsMixin):
         return '\n'.join([sentence.full(format_, annotation) for sentence in self.sentence_set.all()])
 
     def get_formal_structure(self):
+        words = (word for sentence in self.sentence_set.all() for word in sentence.word_set.all())
+        return Fragment.formal_structure_of(self.document.corpus.check_structure, words)
+
+    def get_sentence_function(self):
+        words = (word for sentence in self.sentence_set.all() for word in sentence.word_set.all())
+        return Fragment.sentence_function_of(self.document.corpus.check_structure, self.tense, words)
+
+    @staticmethod
+    def formal_structure_of(check_structure, words):
+        """
+        Determines the formal structure of a Fragment from its Words, see formal_structure_from.
+        :param check_structure: whether the Corpus of the Fragment checks the structure
+        :param words: the (possibly unsaved) Words of the Fragment
+        """
+        target_in_dialogue = any(word.is_target and word.is_in_dialogue for word in words)
+        return Fragment.formal_structure_from(check_structure, target_in_dialogue)
+
+    @staticmethod
+    def formal_structure_from(check_structure, target_in_dialogue):
+        """
+        Determines the formal structure of a Fragment: dialogue if a target Word is in dialogue.
+        :param check_structure: whether the Corpus of the Fragment checks the structure
+        :param target_in_dialogue: whether any target Word of the Fragment is in dialogue
+        """
         result = Fragment.FS_NONE
 
-        if self.document.corpus.check_structure:
+        if check_structure:
             result = Fragment.FS_NARRATION
-            for sentence in self.sentence_set.all():
-                for word in sentence.word_set.all():
-                    if word.is_target and word.is_in_dialogue:
-                        result = Fragment.FS_DIALOGUE
+            if target_in_dialogue:
+                result = Fragment.FS_DIALOGUE
 
         return result
 
-    def get_sentence_function(self):
-        """Very simple way to acquire the sentence function."""
+    @staticmethod
+    def sentence_function_of(check_structure, tense, words):
+        """
+        Determines the sentence function of a Fragment from its Words, see sentence_function_from.
+        :param check_structure: whether the Corpus of the Fragment checks the structure
+        :param tense: the Tense of the Fragment
+        :param words: the (possibly unsaved) Words of the Fragment, in order
+        """
+        last_punctuation = None
+        for word in words:
+            if word.word in Fragment.SF_PUNCTUATION:
+                last_punctuation = word.word
+        return Fragment.sentence_function_from(check_structure, tense.title if tense else None, last_punctuation)
+
+    @staticmethod
+    def sentence_function_from(check_structure, tense_title, last_punctuation):
+        """
+        Very simple way to acquire the sentence function.
+        :param check_structure: whether the Corpus of the Fragment checks the structure
+        :param tense_title: the title of the Tense of the Fragment
+        :param last_punctuation: the last '?' or '!' Word of the Fragment, if any
+        """
         result = Fragment.SF_NONE
 
-        if self.document.corpus.check_structure:
+        if check_structure:
             result = Fragment.SF_DECLARATIVE
 
-            if self.tense and self.tense.title == 'imperative':
+            if tense_title == 'imperative':
                 result = Fragment.SF_IMPERATIVE
 
-            for sentence in self.sentence_set.all():
-                for word in sentence.word_set.all():
-                    if word.word == '?':
-                        result = Fragment.SF_INTERROGATIVE
-                    if word.word == '!':
-                        result = Fragment.SF_EXCLAMATORY
+            if last_punctuation == '?':
+                result = Fragment.SF_INTERROGATIVE
+            if last_punctuation == '!':
+                result = Fragment.SF_EXCLAMATORY
 
         return result
 
@@ -353,8 +401,10 @@ class Fragment(models.Model, HasLabelsMixin):
 
     def save(self, *args, **kwargs):
         """Sets the correct formal structure and sentence function on save of a Fragment"""
-        self.formal_structure = self.get_formal_structure()
-        self.sentence_function = self.get_sentence_function()
+        from .structure import fragment_structure
+
+        using = kwargs.get('using') or self._state.db
+        self.formal_structure, self.sentence_function = fragment_structure(self, using)
         super(Fragment, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -559,3 +609,28 @@ class SubSentence(models.Model):
 
     def __str__(self):
         return self.xml_id
+
+
+class ImportRun(models.Model):
+    """
+    Stores the progress of the import of a file into a :model:`annotations.Corpus`, by the checksum of the file.
+    An import that failed is resumed after the last processed row when the same file is imported again.
+    The rows that could not be written (e.g. because they refer to a Tense that does not exist yet) are retried then.
+    """
+    corpus = models.ForeignKey(Corpus, on_delete=models.CASCADE)
+    importer = models.CharField(max_length=200)
+    filename = models.CharField(max_length=500)
+    checksum = models.CharField(max_length=64)
+
+    last_row = models.PositiveIntegerField(default=0)
+    rows = models.PositiveIntegerField(default=0)
+    failed_rows = models.JSONField(default=list, blank=True,
+                                   help_text='The lines of the rows that could not be written, before the last row')
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        unique_together = ('corpus', 'importer', 'checksum', )
+
+    def __str__(self):
+        return '{} ({})'.format(self.filename, self.importer)
@@ -0,0 +1,89 @@
+from django.db import transaction
+from django.db.models import Count, Max, Q
+
+from stats.signals import record_changes
+from .models import Corpus, Fragment, Word
+
+
+def word_aggregates(fragment_pks, using=None):
+    """
+    Aggregates the Words that determine the formal structure and sentence function of Fragments, in a single query.
+    :param fragment_pks: the pks of the Fragments
+    :param using: the database alias
+    :return: a dictionary with per Fragment pk whether a target Word is in dialogue, and the last '?' or '!' Word.
+    Fragments without such Words are not included.
+    """
+    rows = Word.objects.using(using) \
+        .filter(sentence__fragment__in=fragment_pks) \
+        .filter(Q(is_target=True, is_in_dialogue=True) | Q(word__in=Fragment.SF_PUNCTUATION)) \
+        .values('sentence__fragment') \
+        .annotate(n_targets_in_dialogue=Count('pk', filter=Q(is_target=True, is_in_dialogue=True)),
+                  last_question=Max('pk', filter=Q(word='?')),
+                  last_exclamation=Max('pk', filter=Q(word='!'))) \
+        .values_list('sentence__fragment', 'n_targets_in_dialogue', 'last_question', 'last_exclamation') \
+        .order_by()
+
+    result = dict()
+    for fragment_pk, n_targets_in_dialogue, last_question, last_exclamation in rows:
+        # The Words are in order of their pks, see Fragment.sentence_function_of
+        last_punctuation = None
+        if last_question or last_exclamation:
+            last_punctuation = '?' if (last_question or 0) > (last_exclamation or 0) else '!'
+        result[fragment_pk] = (n_targets_in_dialogue > 0, last_punctuation)
+    return result
+
+
+def fragment_structure(fragment, using=None):
+    """
+    Determines the formal structure and sentence function of a (possibly unsaved) Fragment from its saved Words.
+    :param using: the database alias
+    :return: the formal structure and the sentence function
+    """
+    check_structure = Corpus.objects.using(using).filter(documents=fragment.document_id) \
+        .values_list('check_structure', flat=True).first()
+
+    target_in_dialogue, last_punctuation = False, None
+    if check_structure and fragment.pk is not None:
+        aggregates = word_aggregates([fragment.pk], using)
+        target_in_dialogue, last_punctuation = aggregates.get(fragment.pk, (False, None))
+
+    tense_title = fragment.tense.title if fragment.tense else None
+    return (Fragment.formal_structure_from(check_structure, target_in_dialogue),
+            Fragment.sentence_function_from(check_structure, tense_title, last_punctuation))
+
+
+def recompute_structure(fragments, batch_size=1000):
+    """
+    Recomputes the formal structure and sentence function of Fragments in batches, with two queries per batch,
+    and updates the Fragments that have changed with a bulk update.
+    :param fragments: a QuerySet of Fragments
+    :param batch_size: the number of Fragments per batch
+    :return: the number of updated Fragments
+    """
+    values = fragments.order_by('pk').values_list('pk', 'document__corpus__check_structure', 'tense__title',
+                                                  'formal_structure', 'sentence_function')
+    n_updated = 0
+    last_pk = 0
+    while True:
+        batch = list(values.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+
+        aggregates = word_aggregates([pk for pk, check_structure, _, _, _ in batch if check_structure], fragments.db)
+        changed = []
+        for pk, check_structure, tense_title, formal_structure, sentence_function in batch:
+            target_in_dialogue, last_punctuation = aggregates.get(pk, (False, None))
+            fragment = Fragment(pk=pk,
+                                formal_structure=Fragment.formal_structure_from(check_structure, target_in_dialogue),
+                                sentence_function=Fragment.sentence_function_from(check_structure, tense_title,
+                                                                                  last_punctuation))
+            if (fragment.formal_structure, fragment.sentence_function) != (formal_structure, sentence_function):
+                changed.append(fragment)
+
+        with transaction.atomic():
+            Fragment.objects.using(fragments.db).bulk_update(changed, ['formal_structure', 'sentence_function'])
+            # The bulk update does not send the signals that mark the Fragments as changed for the Scenarios
+            record_changes([fragment.pk for fragment in changed])
+        n_updated += len(changed)
+    return n_updated
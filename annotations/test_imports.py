@@ -0,0 +1,281 @@
+import csv
+import io
+import os
+import tempfile
+
+from django.test import TransactionTestCase
+
+from .imports import ImportPipeline, bulk_insert, has_natural_key, read_rows, select_pks
+from .management.commands.add_fragments import process_file, retrieve_label_keys, FragmentImporter
+from .management.commands.append_fragments import AppendImporter
+from .management.commands import import_labeled_fragments
+from .models import Alignment, Annotation, Corpus, Fragment, ImportRun, Language, LabelKey, Tense, TenseCategory
+from .test_models import BaseTestCase
+
+
+def make_file(rows):
+    """
+    Creates an (uploaded) .csv-file in the format of PerfectExtractor.
+    """
+    f = io.StringIO()
+    csv.writer(f, delimiter=';').writerows(rows)
+    return io.BytesIO(f.getvalue().encode('utf-8-sig'))
+
+
+def make_rows(document='doc{}', n_rows=3):
+    """
+    Creates the rows of a .csv-file in the format of PerfectExtractor, with an English Fragment in the present perfect
+    and a Dutch translation per row.
+    """
+    rows = [['document', 'sentence', 'type', 'words', 'ids', 'en', 'type', 'nl']]
+    for n in range(1, n_rows + 1):
+        rows.append([
+            document.format(n % 2), 's{}'.format(n), 'present perfect', 'has been', 'w{0}.2 w{0}.3'.format(n),
+            '<root><s id="s{0}"><w id="w{0}.1">It</w><w id="w{0}.2" dialog="0.8">has</w>'
+            '<w id="w{0}.3">been</w><w id="w{0}.4">?</w></s></root>'.format(n),
+            '1 => 1', '<root><s id="s{0}"><w id="w{0}.1">Het</w><w id="w{0}.2">is</w></s></root>'.format(n)])
+    return rows
+
+
+class ImportTestCase(BaseTestCase):
+    fixtures = ['languages']
+
+    def setUp(self):
+        super().setUp()
+        self.c1.check_structure = True
+        self.c1.save()
+        category, _ = TenseCategory.objects.get_or_create(title='Present Perfect')
+        self.tense, _ = Tense.objects.get_or_create(title='present perfect', language=self.en,
+                                                    defaults={'category': category})
+        self.rows = make_rows()
+
+    def test_read_rows(self):
+        f = make_file(self.rows)
+        offsets = []
+        self.assertEqual(list(read_rows(f, progress=offsets.append, progress_every=2)), self.rows)
+        self.assertEqual(offsets[-1], len(f.getvalue()))
+        self.assertFalse(f.closed)
+
+        # The BOM is also skipped when the file has been opened in text mode
+        text = io.StringIO(f.getvalue().decode('utf-8'))
+        self.assertEqual(list(read_rows(text))[0][0], 'document')
+
+    def test_bulk_insert(self):
+        # The pks are assigned by the database, also after a Fragment has been saved in between
+        fragments = [Fragment(language=self.en, document=self.d, import_key=str(n)) for n in range(5)]
+        bulk_insert(Fragment, fragments[:3], batch_size=2)
+        Fragment.objects.create(language=self.nl, document=self.d)
+        bulk_insert(Fragment, fragments[3:])
+        self.assertEqual(len({fragment.pk for fragment in fragments}), 5)
+        for fragment in fragments:
+            self.assertEqual(Fragment.objects.get(pk=fragment.pk).import_key, fragment.import_key)
+
+    def test_select_pks(self):
+        # In the interleaved lock mode of MySQL, the pks are read back by the natural key of the objects
+        key = ('document_id', 'import_key')
+        fragments = [Fragment(language=self.en, document=self.d, import_key=str(n)) for n in range(3)]
+        self.assertTrue(has_natural_key(fragments, key))
+        self.assertFalse(has_natural_key(fragments + [Fragment(language=self.en, document=self.d)], key))
+        self.assertFalse(has_natural_key(fragments + [Fragment(document=self.d, import_key='0')], key))
+
+        first_pk = Fragment.objects.create(language=self.nl, document=self.d).pk + 1
+        Fragment.objects.bulk_create(reversed(fragments))
+        select_pks(Fragment, fragments, key, first_pk)
+        for fragment in fragments:
+            self.assertEqual(Fragment.objects.get(pk=fragment.pk).import_key, fragment.import_key)
+
+    def test_add_fragments_bulk(self):
+        process_file(make_file(self.rows), self.c1, bulk=True, batch_size=2)
+
+        fragments = Fragment.objects.filter(document__title__in=['doc0', 'doc1'], language=self.en)
+        self.assertEqual(fragments.count(), 3)
+        for fragment in fragments:
+            self.assertEqual(fragment.tense, self.tense)
+            self.assertEqual(fragment.target_words(), 'has been')
+            self.assertEqual(fragment.full(), 'It has been ?')
+            # The formal structure and sentence function are determined from the parsed Words
+            self.assertEqual(fragment.formal_structure, Fragment.FS_DIALOGUE)
+            self.assertEqual(fragment.sentence_function, Fragment.SF_INTERROGATIVE)
+
+            alignment = Alignment.objects.get(original_fragment=fragment)
+            self.assertEqual(alignment.type, '1 => 1')
+            self.assertEqual(alignment.translated_fragment.language, self.nl)
+            self.assertEqual(alignment.translated_fragment.full(), 'Het is')
+
+    def test_add_fragments_bulk_unknown_tense(self):
+        self.rows[3][2] = 'unknown'
+        with self.assertRaises(ValueError):
+            process_file(make_file(self.rows), self.c1, bulk=True, batch_size=2)
+
+        # The first batch has been committed
+        self.assertEqual(Fragment.objects.filter(document__title__in=['doc0', 'doc1'], language=self.en).count(), 2)
+
+        # Importing the (corrected) file again does not duplicate the rows that have been imported
+        self.rows[3][2] = 'present perfect'
+        process_file(make_file(self.rows), self.c1, bulk=True, batch_size=2)
+        self.assertEqual(Fragment.objects.filter(document__title__in=['doc0', 'doc1'], language=self.en).count(), 3)
+
+    def test_add_fragments(self):
+        # Without bulk, every row is inserted in its own transaction
+        self.rows[3][2] = 'unknown'
+        with self.assertRaises(ValueError):
+            process_file(make_file(self.rows), self.c1)
+        self.assertEqual(Fragment.objects.filter(document__title__in=['doc0', 'doc1'], language=self.en).count(), 2)
+
+        # Importing the (corrected) file again, e.g. through the AddFragmentsForm, skips the rows that were imported
+        self.rows[3][2] = 'present perfect'
+        process_file(make_file(self.rows), self.c1)
+        fragments = Fragment.objects.filter(document__title__in=['doc0', 'doc1'], language=self.en)
+        self.assertEqual(fragments.count(), 3)
+        self.assertEqual(Alignment.objects.filter(original_fragment__in=fragments).count(), 3)
+
+    def test_pipeline_resumes_import_run(self):
+        self.rows[3][2] = 'unknown'
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'fragments.csv')
+            with open(filename, 'wb') as f:
+                f.write(make_file(self.rows).getvalue())
+
+            pipeline = ImportPipeline(FragmentImporter(self.c1, retrieve_label_keys(self.c1)), batch_size=2,
+                                      strict=True)
+            with self.assertRaises(ValueError):
+                list(pipeline.run([filename]))
+            run = ImportRun.objects.get(corpus=self.c1, importer='add_fragments')
+            self.assertEqual(run.last_row, 3)
+            self.assertIsNone(run.finished_at)
+
+            # After adding the missing Tense, the import resumes after the last committed row
+            Tense.objects.create(title='unknown', language=self.en, category=self.tense.category)
+            reports = list(pipeline.run([filename]))
+
+        self.assertEqual(reports[0].rows, 1)
+        run.refresh_from_db()
+        self.assertEqual((run.last_row, run.rows), (4, 3))
+        self.assertIsNotNone(run.finished_at)
+        self.assertEqual(Fragment.objects.filter(document__title__in=['doc0', 'doc1'], language=self.en).count(), 3)
+
+    def test_pipeline_reports_failed_rows(self):
+        self.rows[2][5] = '<s id="s2"><w id="w2.1">It'
+        self.rows[3][2] = 'unknown'
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'fragments.csv')
+            with open(filename, 'wb') as f:
+                f.write(make_file(self.rows).getvalue())
+
+            pipeline = ImportPipeline(FragmentImporter(self.c1, retrieve_label_keys(self.c1)), batch_size=2)
+            reports = list(pipeline.run([filename]))
+
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0].rows, 1)
+        # Both the invalid XML and the unknown Tense are reported, with their line numbers
+        self.assertEqual([line for line, _ in reports[0].errors], [3, 4])
+        self.assertEqual(Fragment.objects.filter(document__title__in=['doc0', 'doc1'], language=self.en).count(), 1)
+
+    def test_pipeline_retries_failed_rows(self):
+        self.rows[2][5] = '<s id="s2"><w id="w2.1">It'
+        self.rows[3][2] = 'unknown'
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'fragments.csv')
+            with open(filename, 'wb') as f:
+                f.write(make_file(self.rows).getvalue())
+
+            pipeline = ImportPipeline(FragmentImporter(self.c1, retrieve_label_keys(self.c1)), batch_size=2)
+            list(pipeline.run([filename]))
+            # The row with the unknown Tense is recorded to be retried, the invalid row is not
+            run = ImportRun.objects.get(corpus=self.c1, importer='add_fragments')
+            self.assertEqual((run.last_row, run.rows, run.failed_rows), (4, 1, [4]))
+            self.assertIsNone(run.finished_at)
+
+            # After adding the missing Tense, only the failed row is imported
+            Tense.objects.create(title='unknown', language=self.en, category=self.tense.category)
+            reports = list(pipeline.run([filename]))
+
+        self.assertEqual((reports[0].rows, reports[0].errors), (1, []))
+        run.refresh_from_db()
+        self.assertEqual((run.last_row, run.rows, run.failed_rows), (4, 2, []))
+        self.assertIsNotNone(run.finished_at)
+        self.assertEqual(Fragment.objects.filter(document__title__in=['doc0', 'doc1'], language=self.en).count(), 2)
+
+    def test_append_fragments(self):
+        process_file(make_file(self.rows), self.c1, bulk=True)
+
+        # Append another translation to the Fragments, the last row does not match a Fragment
+        self.rows[3][4] = 'w3.1'
+        pipeline = ImportPipeline(AppendImporter(self.c1), batch_size=2)
+        report = pipeline.import_rows(self.rows)
+        self.assertEqual(report.rows, 2)
+        self.assertEqual(report.errors, [(4, 'No match found for s3')])
+
+        fragments = Fragment.objects.filter(document__title__in=['doc0', 'doc1'], language=self.en).order_by('pk')
+        self.assertEqual([Alignment.objects.filter(original_fragment=fragment).count() for fragment in fragments],
+                         [2, 2, 1])
+
+    def test_import_labeled_fragments(self):
+        rows = [['id', 'document', 'sentence', 'text', 'en', '', 'nl'],
+                ['1', 'doc', '1:1', 'It has been', 'has=been', 'Het is geweest', 'is=geweest'],
+                ['2', 'doc', '1:2', 'It was', 'was', 'Het was', 'was']]
+        key = LabelKey.objects.create(title='tense')
+        importer = import_labeled_fragments.LabeledFragmentImporter(self.c1, key)
+        ImportPipeline(importer, strict=True).import_rows(rows)
+        self.assertEqual(importer.languages_to, [self.nl])
+
+        fragments = Fragment.objects.filter(document__title='doc', language=self.en).order_by('pk')
+        self.assertEqual([fragment.target_words() for fragment in fragments], ['has been', 'was'])
+        self.assertEqual([fragment.labels.get().title for fragment in fragments], ['has=been', 'was'])
+
+        annotation = Annotation.objects.get(alignment__original_fragment=fragments[0])
+        self.assertEqual(annotation.alignment.translated_fragment.full(), 'Het is geweest')
+        self.assertEqual(' '.join(word.word for word in annotation.words.order_by('pk')), 'is geweest')
+        self.assertEqual(annotation.labels.get().title, 'is=geweest')
+
+
+class CrashingImporter(FragmentImporter):
+    """
+    Kills the parsing process on the rows of the Document 'crash'.
+    """
+
+    def parse(self, header, row):
+        if row[0] == 'crash':
+            os._exit(1)
+        return super().parse(header, row)
+
+
+class ImportProcessesTestCase(TransactionTestCase):
+    """
+    Tests the import in multiple (forked) processes. The database connections are closed before forking,
+    hence this is not run in a transaction.
+    """
+    fixtures = ['languages']
+
+    def setUp(self):
+        self.corpus = Corpus.objects.create(title='corpus')
+        category, _ = TenseCategory.objects.get_or_create(title='Present Perfect')
+        Tense.objects.get_or_create(title='present perfect', language=Language.objects.get(iso='en'),
+                                    defaults={'category': category})
+
+    def import_files(self, importer, files):
+        with tempfile.TemporaryDirectory() as directory:
+            filenames = []
+            for name, rows in files:
+                filenames.append(os.path.join(directory, name))
+                with open(filenames[-1], 'wb') as f:
+                    f.write(make_file(rows).getvalue())
+            pipeline = ImportPipeline(importer, processes=2, batch_size=2)
+            return {os.path.basename(report.filename): report for report in pipeline.run(filenames)}
+
+    def test_processes(self):
+        reports = self.import_files(FragmentImporter(self.corpus, []),
+                                    [('a.csv', make_rows('a{}')), ('b.csv', make_rows('b{}', 5))])
+        self.assertEqual({name: report.rows for name, report in reports.items()}, {'a.csv': 3, 'b.csv': 5})
+        self.assertEqual(Fragment.objects.filter(document__corpus=self.corpus, language__iso='en').count(), 8)
+        self.assertEqual(ImportRun.objects.filter(corpus=self.corpus, finished_at__isnull=False).count(), 2)
+
+    def test_processes_crash(self):
+        # The crashing file comes first, so that the other file is parsed by the process that does not die
+        reports = self.import_files(CrashingImporter(self.corpus, []),
+                                    [('crash.csv', make_rows('crash')), ('a.csv', make_rows('a{}'))])
+
+        # The file of the process that died fails, rather than blocking the import
+        self.assertEqual(reports['a.csv'].rows, 3)
+        self.assertEqual(reports['crash.csv'].errors, [(None, 'The parsing process exited with code 1')])
+        self.assertIsNone(ImportRun.objects.get(corpus=self.corpus, filename__endswith='crash.csv').finished_at)
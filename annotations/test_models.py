@@ -1,9 +1,13 @@
+import io
+
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.test import TestCase
 
 from stats.models import Scenario
 from .models import Language, Corpus, Document, Fragment, Sentence, Word, \
     Alignment, Annotation, Tense, Label, LabelKey
+from .structure import recompute_structure
 
 
 class BaseTestCase(TestCase):
@@ -109,3 +113,29 @@ class ModelsTestCase(BaseTestCase):
         self.assertEqual(self.f_en.to_html(), html)
         html = '<ul><li>Dit <strong>is</strong> altijd moeilijk te testen <strong>geweest</strong> </li></ul>'
         self.assertEqual(self.f_nl.to_html(), html)
+
+    def test_structure(self):
+        self.c1.check_structure = True
+        self.c1.save()
+
+        self.f_en.save()
+        self.assertEqual(self.f_en.formal_structure, Fragment.FS_NARRATION)
+        self.assertEqual(self.f_en.sentence_function, Fragment.SF_DECLARATIVE)
+
+        # Only the Fragments of which the structure changes are updated
+        self.assertEqual(recompute_structure(Fragment.objects.filter(document__corpus=self.c1)), 1)
+        self.f_nl.refresh_from_db()
+        self.assertEqual(self.f_nl.formal_structure, Fragment.FS_NARRATION)
+
+        sentence = self.f_en.sentence_set.get()
+        Word.objects.filter(sentence=sentence, word='has').update(is_in_dialogue=True)
+        Word.objects.create(word='?', xml_id='w1.1.8', sentence=sentence)
+        Word.objects.create(word='!', xml_id='w1.1.9', sentence=sentence)
+        call_command('recompute_structure', self.c1.title, stdout=io.StringIO())
+
+        self.f_en.refresh_from_db()
+        self.assertEqual(self.f_en.formal_structure, Fragment.FS_DIALOGUE)
+        self.assertEqual(self.f_en.sentence_function, Fragment.SF_EXCLAMATORY)
+        # The aggregate queries agree with the Words of the Fragment
+        self.assertEqual(self.f_en.formal_structure, self.f_en.get_formal_structure())
+        self.assertEqual(self.f_en.sentence_function, self.f_en.get_sentence_function())
@@ -1,5 +1,6 @@
-from .models import Corpus, Annotation, Tense
-from .utils import get_next_alignment, get_available_corpora, get_tenses, get_most_frequent_tenses, is_before, sort_key
+from .models import Corpus, Annotation, Fragment, Tense, Word
+from .utils import get_next_alignment, get_available_corpora, get_tenses, get_most_frequent_tenses, is_before, sort_key, \
+    update_dialogue
 from .test_models import BaseTestCase
 
 
@@ -43,6 +44,20 @@ class UtilsTestCase(BaseTestCase):
         self.assertEqual(get_tenses(self.nl), ['infinitief', 'ott', 'ottt', 'ovt', 'ovtt', 'vtt', 'vvt'])
         self.assertEqual(get_most_frequent_tenses(self.nl)[0], t)
 
+    def test_update_dialogue(self):
+        self.c1.check_structure = True
+        self.c1.save()
+        sentence = self.f_en.sentence_set.get()
+
+        update_dialogue(True, fragment=self.f_en)
+        self.assertTrue(all(word.is_in_dialogue for word in Word.objects.filter(sentence=sentence)))
+        self.f_en.refresh_from_db()
+        self.assertEqual(self.f_en.formal_structure, Fragment.FS_DIALOGUE)
+
+        update_dialogue(False, word_range=[word.pk for word in sentence.word_set.filter(is_target=True)])
+        self.f_en.refresh_from_db()
+        self.assertEqual(self.f_en.formal_structure, Fragment.FS_NARRATION)
+
     def test_is_before(self):
         xml_id1 = '13'
 
@@ -12,6 +12,7 @@ from selections.models import PreProcessFragment
 from stats.utils import get_label_properties_from_cache, prepare_label_cache
 
 from .models import Corpus, Tense, Alignment, Source, Annotation, Fragment, Sentence, Word
+from .structure import recompute_structure
 
 
 def get_next_alignment(user, language_from, language_to, corpus=None):
@@ -109,16 +110,10 @@ def update_dialogue(in_dialogue, fragment=None, sentence=None, word_range=None):
     if word_range:
         words |= Word.objects.filter(pk__in=word_range)
 
-    fragments = set()
-    for word in words:
-        word.is_in_dialogue = in_dialogue
-        word.is_in_dialogue_prob = 1.0 if in_dialogue else 0.0
-        word.save()
-
-        fragments.add(word.sentence.fragment)
-
-    for fragment in fragments:
-        fragment.save()
+    # Update the Words and (the formal structure of) their Fragments in bulk
+    fragment_pks = list(Fragment.objects.filter(sentence__word__in=words).values_list('pk', flat=True).distinct())
+    words.update(is_in_dialogue=in_dialogue, is_in_dialogue_prob=1.0 if in_dialogue else 0.0)
+    recompute_structure(Fragment.objects.filter(pk__in=fragment_pks))
 
 
 XML_ID_REGEX = re.compile(r'w?(\d[\.\d]*)')
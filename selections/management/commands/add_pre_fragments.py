@@ -1,11 +1,13 @@
-import csv
+from lxml import etree
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 
-from annotations.models import Language, Corpus, Document
-from annotations.management.commands.add_fragments import add_sentences
+from annotations.imports import FragmentWriter, ImportPipeline, Importer, ParsedFragment, bulk_insert_children, \
+    parse_sentences, read_rows, row_key
+from annotations.models import Language, Corpus, Fragment, ImportRun
+from annotations.management.commands.add_fragments import FragmentLookup
 from annotations.management.commands.constants import COLUMN_DOCUMENT, COLUMN_XML
+from annotations.management.commands.utils import report_import, report_progress
 
 from selections.models import PreProcessFragment
 
@@ -19,6 +21,11 @@ class Command(BaseCommand):
 
         parser.add_argument('--delete', action='store_true', dest='delete', default=False,
                             help='Delete existing PreProcessFragments (and contents) for this Corpus')
+        parser.add_argument('--batch_size', type=int, dest='batch_size', default=1000,
+                            help='The number of rows that are inserted per transaction')
+        parser.add_argument('--processes', type=int, dest='processes', default=1,
+                            help='Parse the files in this number of processes. '
+                                 'Invalid rows are then skipped and reported.')
 
     def handle(self, *args, **options):
         # Retrieve the Corpus from the database
@@ -32,27 +39,58 @@ class Command(BaseCommand):
 
         if options['delete']:
             PreProcessFragment.objects.filter(document__corpus=corpus).delete()
+            ImportRun.objects.filter(corpus=corpus, importer=PreProcessFragmentImporter.name).delete()
 
-        for filename in options['filenames']:
-            with open(filename, 'r') as f:
-                try:
-                    process_file(f, corpus)
-                    self.stdout.write(self.style.SUCCESS('Successfully imported PreProcessFragments'))
-                except Exception as e:
-                    raise CommandError(e)
+        pipeline = ImportPipeline(PreProcessFragmentImporter(corpus), options['processes'], options['batch_size'],
+                                  strict=options['processes'] <= 1, progress=report_progress(self))
+        try:
+            report_import(self, pipeline, options['filenames'])
+        except (ValueError, Language.DoesNotExist) as e:
+            raise CommandError(e)
+
+
+def process_file(f, corpus, batch_size=1000, progress=None):
+    """
+    Creates PreProcessFragments from the rows of a .csv-file, which are streamed from the file (see read_rows).
+    The rows are inserted in batches, see PreProcessFragmentImporter.
+    :param progress: a function that is called with the number of bytes read
+    """
+    pipeline = ImportPipeline(PreProcessFragmentImporter(corpus), batch_size=batch_size, strict=True)
+    return pipeline.import_rows(read_rows(f, progress=progress)).rows
+
+
+class PreProcessFragmentImporter(Importer):
+    """
+    Imports the rows of a .csv-file generated by PerfectExtractor as PreProcessFragments, in batches
+    (see ImportPipeline). Only the source Fragment of every row is imported. Rows that have been imported before
+    (by their row_key) are skipped.
+    """
+    name = 'add_pre_fragments'
 
+    def __init__(self, corpus):
+        self.corpus = corpus
 
-def process_file(f, corpus):
-    lines = f.read().decode('utf-8-sig').splitlines()
-    csv_reader = csv.reader(lines, delimiter=';')
-    for n, row in enumerate(csv_reader):
+    def parse(self, header, row):
+        return row_key(row), row[COLUMN_DOCUMENT], parse_sentences(etree.fromstring(row[COLUMN_XML]))
+
+    def start(self, header):
         # Retrieve language from header row
-        if n == 0:
-            language = Language.objects.get(iso=row[COLUMN_XML])
-            continue
+        return FragmentLookup(self.corpus, [], Language.objects.get(iso=header[COLUMN_XML]), dict())
+
+    def resolve(self, lookup, item):
+        key, document_title, sentences = item
+        fragment = Fragment(language=lookup.language_from, document=lookup.document(document_title), import_key=key)
+        return ParsedFragment(fragment, sentences, check_structure=self.corpus.check_structure)
+
+    def write(self, lookup, items):
+        PreProcessFragmentWriter().write(items)
+
 
-        with transaction.atomic():
-            doc, _ = Document.objects.get_or_create(corpus=corpus, title=row[COLUMN_DOCUMENT])
+class PreProcessFragmentWriter(FragmentWriter):
+    """
+    Inserts the original Fragments of ParsedFragments as PreProcessFragments.
+    """
 
-            from_fragment = PreProcessFragment.objects.create(language=language, document=doc)
-            add_sentences(from_fragment, row[COLUMN_XML])
+    def insert_fragments(self, batch, fragments):
+        super().insert_fragments(batch, fragments)
+        bulk_insert_children(PreProcessFragment, [parsed.fragment for parsed in batch])
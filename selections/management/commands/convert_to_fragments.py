@@ -1,14 +1,16 @@
 # -*- coding: utf-8 -*-
 
-import csv
 from collections import defaultdict
+from functools import partial
 
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 
+from annotations.imports import read_rows
 from annotations.models import Language, Corpus, Document, Fragment, Alignment
 from annotations.management.commands.add_fragments import retrieve_languages, create_to_fragments
 from annotations.management.commands.constants import COLUMN_DOCUMENT, COLUMN_SENTENCE
+from annotations.management.commands.utils import report_progress
 
 from selections.models import Selection, PreProcessFragment
 
@@ -53,18 +55,23 @@ class Command(BaseCommand):
         create_new = options['create']
 
         for filename in options['filenames']:
-            with open(filename, 'r') as f:
+            with open(filename, 'rb') as f:
                 try:
                     fragment_cache = retrieve_fragments(language, corpus, create_new, document)
-                    convert_selections(f, fragment_cache, corpus, document)
+                    convert_selections(f, fragment_cache, corpus, document,
+                                       progress=partial(report_progress(self), filename))
                     self.stdout.write(self.style.SUCCESS('Successfully converted Selections'))
                 except Exception as e:
                     raise CommandError(e)
 
 
-def convert_selections(f, fragment_cache, corpus, document=None):
-    lines = f.read().decode('utf-8-sig').splitlines()
-    csv_reader = csv.reader(lines, delimiter=';')
+def convert_selections(f, fragment_cache, corpus, document=None, progress=None):
+    """
+    Creates the translations of the Fragments in the rows of a .csv-file, which are streamed from the file
+    (see read_rows).
+    :param progress: a function that is called with the number of bytes read
+    """
+    csv_reader = read_rows(f, progress=progress)
 
     languages_to = dict()
     for n, row in enumerate(csv_reader):
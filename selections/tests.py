@@ -1,8 +1,10 @@
 from django.contrib.auth.models import User
 from django.test import TestCase
 
-from annotations.models import Language, Corpus, Document, Sentence, Word
+from annotations.models import Language, Corpus, Document, Fragment, Sentence, Word
+from annotations.test_imports import make_file, make_rows
 
+from .management.commands.add_pre_fragments import process_file
 from .models import PreProcessFragment, Selection
 from .utils import get_next_fragment, get_open_fragments, get_selection_order
 
@@ -109,3 +111,14 @@ class SelectionTestCase(TestCase):
         s1.save()
 
         self.assertEqual(s1.annotated_words(), ' '.join([w1.word, w3.word, w2.word, w4.word]))
+
+    def test_add_pre_fragments(self):
+        corpus = Corpus.objects.create(title='import')
+        self.assertEqual(process_file(make_file(make_rows(n_rows=5)), corpus, batch_size=2), 5)
+
+        fragments = PreProcessFragment.objects.filter(document__corpus=corpus).order_by('pk')
+        self.assertEqual(fragments.count(), 5)
+        self.assertEqual([fragment.document.title for fragment in fragments], ['doc1', 'doc0', 'doc1', 'doc0', 'doc1'])
+        self.assertEqual(fragments[0].language, self.en)
+        self.assertEqual(fragments[0].full(), 'It has been ?')
+        self.assertEqual(Fragment.objects.filter(document__corpus=corpus).count(), 5)
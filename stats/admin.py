@@ -1,18 +1,14 @@
-import logging
 from django.contrib import admin, messages
 from django.db.models import Prefetch
 from django.urls import reverse
-from django.utils import timezone
 from django.utils.safestring import mark_safe
 
 from django_object_actions import BaseDjangoObjectActions
 
 from .forms import ScenarioForm, ScenarioLanguageForm
-from .models import Scenario, ScenarioLanguage
-from .utils import run_mds, copy_scenario, EmptyScenario, ImproperScenario
-
-
-logger = logging.getLogger()
+from .jobs import enqueue_scenario, reset_jobs
+from .models import Scenario, ScenarioLanguage, ScenarioJob
+from .utils import copy_scenario
 
 
 class ScenarioLanguageInline(admin.StackedInline):
@@ -30,7 +26,8 @@ class ScenarioLanguageInline(admin.StackedInline):
 @admin.register(Scenario)
 class ScenarioAdmin(BaseDjangoObjectActions, admin.ModelAdmin):
     form = ScenarioForm
-    list_display = ('title', 'corpus', 'is_test', 'is_public', 'from_languages', 'to_languages', 'last_run', )
+    list_display = ('title', 'corpus', 'is_test', 'is_public', 'from_languages', 'to_languages', 'last_run',
+                    'run_status', )
     list_filter = ('corpus', 'scenariolanguage__language', 'owner')
     list_per_page = 25
 
@@ -45,41 +42,70 @@ class ScenarioAdmin(BaseDjangoObjectActions, admin.ModelAdmin):
         }),
         ('Multidimensional Scaling', {
             'classes': ('collapse',),
-            'fields': ('mds_dimensions', 'mds_allow_partial')
+            'fields': ('mds_dimensions', 'mds_allow_partial', 'mds_collapse_tuples', 'mds_matrix_storage',
+                       'mds_landmarks', 'mds_init', ('mds_max_iter', 'mds_tolerance', ), 'mds_run_info', )
         })
     )
 
+    readonly_fields = ('mds_run_info', )
     inlines = [ScenarioLanguageInline]
 
     def get_queryset(self, request):
         languages_from = ScenarioLanguage.objects.filter(as_from=True).select_related('language')
         languages_to = ScenarioLanguage.objects.filter(as_to=True).select_related('language')
+        active_jobs = ScenarioJob.objects.filter(status__in=[ScenarioJob.QUEUED, ScenarioJob.RUNNING])
         return super().get_queryset(request) \
             .prefetch_related(Prefetch('scenariolanguage_set', queryset=languages_from, to_attr='languages_from'),
-                              Prefetch('scenariolanguage_set', queryset=languages_to, to_attr='languages_to')) \
-            .defer('mds_model', 'mds_matrix', 'mds_fragments', 'mds_labels')  # Don't fetch the PickledObjectFields
+                              Prefetch('scenariolanguage_set', queryset=languages_to, to_attr='languages_to'),
+                              Prefetch('jobs', queryset=active_jobs, to_attr='active_jobs')) \
+            .defer('mds_model', 'mds_matrix', 'mds_fragments', 'mds_labels',
+                   'mds_stress_history')  # Don't fetch the PickledObjectFields
+
+    def run_status(self, obj):
+        job = obj.active_job()
+        if not job:
+            return '-'
+        if job.status == ScenarioJob.RUNNING:
+            return 'running ({}%)'.format(job.progress)
+        return job.get_status_display()
+    run_status.short_description = 'Run status'
+
+    def mds_run_info(self, obj):
+        if not obj.mds_stress_history:
+            return '-'
+        return 'stress {:.4f} after {} iterations in {:.1f} seconds (stress at start: {:.4f})'.format(
+            obj.mds_stress, obj.mds_iterations(), obj.mds_duration or 0, obj.mds_stress_history[0])
+    mds_run_info.short_description = 'Last run'
 
     def run_mds(self, request, obj):
-        try:
-            run_mds(obj)
-            obj.last_run = timezone.now()
-            obj.save()
-            success_link = reverse('stats:show', args=(obj.pk,))
-            message = 'Scenario has been run. <a href="{}">Find it here</a>.'.format(success_link)
-            self.message_user(request, mark_safe(message))
-        except EmptyScenario:
-            self.message_user(request, 'Scenario configuration produced an empty data set.', level=messages.ERROR)
-        except ImproperScenario:
-            self.message_user(request, 'Scenario configuration incorrect. If have more than one from-language, '
-                                       'make sure that these are also set as to-languages.', level=messages.ERROR)
-        except ValueError:
-            message = 'Something went wrong while running scenario {}.'.format(obj.title)
-            self.message_user(request, message, level=messages.ERROR)
-            logger.exception('Error running scenario {}.'.format(obj.title))
+        enqueue_scenario(obj, request.user)
+        jobs_link = reverse('admin:stats_scenariojob_changelist')
+        message = 'Scenario has been queued to be (re)run. <a href="{}">Follow its progress here</a>.'.format(jobs_link)
+        self.message_user(request, mark_safe(message))
 
     run_mds.label = '(Re)run Scenario'
     run_mds.short_description = '(Re)run Scenario'
 
+    def update_mds(self, request, obj):
+        n_changes = obj.changes.count()
+        if not n_changes:
+            self.message_user(request, 'No fragments have changed since the last run of this scenario.')
+            return
+        enqueue_scenario(obj, request.user, incremental=True)
+        jobs_link = reverse('admin:stats_scenariojob_changelist')
+        message = 'Scenario has been queued to be updated with {} changed fragments. ' \
+                  '<a href="{}">Follow its progress here</a>.'.format(n_changes, jobs_link)
+        self.message_user(request, mark_safe(message))
+
+    update_mds.label = 'Update Scenario with changes'
+    update_mds.short_description = 'Update Scenario with the fragments that have changed since the last run'
+
+    def run_scenarios(self, request, queryset):
+        for scenario in queryset:
+            enqueue_scenario(scenario, request.user)
+        self.message_user(request, '{} scenario(s) have been queued to be (re)run.'.format(len(queryset)))
+    run_scenarios.short_description = '(Re)run selected Scenarios'
+
     def copy_scenario(self, request, obj):
         try:
             new_scenario = copy_scenario(request, obj)
@@ -92,10 +118,31 @@ class ScenarioAdmin(BaseDjangoObjectActions, admin.ModelAdmin):
     copy_scenario.label = 'Copy scenario'
     copy_scenario.short_description = 'Copy scenario'
 
-    change_actions = ['run_mds', 'copy_scenario']
+    change_actions = ['run_mds', 'update_mds', 'copy_scenario']
+    actions = ['run_scenarios']
 
     def save_model(self, request, obj, form, change):
         if obj.owner is None:
             # Avoid changing ownership when editing an existing scenario
             obj.owner = request.user
         super().save_model(request, obj, form, change)
+
+
+@admin.register(ScenarioJob)
+class ScenarioJobAdmin(admin.ModelAdmin):
+    list_display = ('scenario', 'incremental', 'status', 'attempt', 'progress', 'message', 'created_by', 'created_at',
+                    'started_at', 'finished_at', 'worker', )
+    list_filter = ('status', )
+    list_select_related = ('scenario', 'created_by', )
+    readonly_fields = ('scenario', 'incremental', 'status', 'attempt', 'progress', 'message', 'created_by',
+                       'created_at', 'started_at', 'heartbeat_at', 'finished_at', 'worker', )
+    actions = ['reset_running_jobs']
+
+    def reset_running_jobs(self, request, queryset):
+        n_reset = reset_jobs(queryset, 'The job has been reset by {}, the scenario has been queued again.'.format(
+            request.user))
+        self.message_user(request, '{} running job(s) have been reset and queued again.'.format(n_reset))
+    reset_running_jobs.short_description = 'Reset the selected running jobs (and queue them again)'
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+def index_tuples(codes):
+    """
+    Groups the rows of a (fragments x languages) array of label codes by their label tuple (the codes of a row).
+    :param codes: the label codes, see stats.store.ScenarioStore
+    :return: the tuple id of every row (in order of first occurrence of the tuple), the rows ordered by tuple id,
+    and the offsets of every tuple in these ordered rows
+    """
+    codes = np.asarray(codes)
+    if len(codes) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(1, dtype=np.int64)
+
+    _, first, inverse = np.unique(codes, axis=0, return_index=True, return_inverse=True)
+    # Renumber the tuples in order of their first occurrence
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first, kind='stable')] = np.arange(len(first))
+    tuples = rank[inverse.reshape(-1)]
+
+    rows = np.argsort(tuples, kind='stable')
+    offsets = np.searchsorted(tuples[rows], np.arange(len(first) + 1))
+    return tuples, rows, offsets
+
+
+def index_fragments(fragment_pks):
+    """
+    Creates an index to look up the row of a Fragment by its pk.
+    :return: the sorted pks, and the row of every sorted pk
+    """
+    fragment_pks = np.asarray(fragment_pks, dtype=np.int64)
+    rows = np.argsort(fragment_pks, kind='stable')
+    return fragment_pks[rows], rows
+
+
+class LabelCube:
+    """
+    The labels of the Fragments in a Scenario, integer-coded per language, together with an index of the Fragments
+    per label tuple (the labels in all languages). The cube is created when the Scenario is run (see ScenarioStore),
+    so that the views on a Scenario can count and group the labels with array lookups.
+    """
+
+    def __init__(self, fragment_pks, languages, vocabulary, codes, tuples=None, rows=None, offsets=None,
+                 sorted_pks=None, sorted_rows=None):
+        """
+        :param fragment_pks: the pks of the Fragments
+        :param languages: the languages, in the order of the columns of codes
+        :param vocabulary: a dictionary with the distinct labels per language, in order of first occurrence
+        :param codes: the (fragments x languages) label codes, an index into the vocabulary of the language
+        :param tuples: the tuple index, see index_tuples. Computed from the codes if not given.
+        :param sorted_pks: the Fragment index, see index_fragments. Computed from the pks if not given.
+        """
+        self.fragment_pks = np.asarray(fragment_pks, dtype=np.int64)
+        self.languages = list(languages)
+        self.vocabulary = vocabulary
+        self.codes = np.asarray(codes)
+        if tuples is None:
+            tuples, rows, offsets = index_tuples(self.codes)
+        self.tuples = tuples
+        self.rows = rows
+        self.offsets = offsets
+        if sorted_pks is None:
+            sorted_pks, sorted_rows = index_fragments(self.fragment_pks)
+        self.sorted_pks = sorted_pks
+        self.sorted_rows = sorted_rows
+
+    @classmethod
+    def from_labels(cls, fragment_pks, fragment_labels):
+        """
+        Creates a cube from a dictionary with a list of labels per language, in the order of fragment_pks.
+        """
+        languages = list(fragment_labels.keys())
+        codes = np.zeros((len(fragment_pks), len(languages)), dtype=np.int32)
+        vocabulary = dict()
+        for column, language in enumerate(languages):
+            code_table = dict()
+            for row, value in enumerate(fragment_labels[language]):
+                codes[row, column] = code_table.setdefault(value, len(code_table))
+            vocabulary[language] = list(code_table)
+        return cls(fragment_pks, languages, vocabulary, codes)
+
+    def __len__(self):
+        return len(self.fragment_pks)
+
+    def column(self, language):
+        """
+        :return: the label codes of the Fragments in a language
+        """
+        return self.codes[:, self.languages.index(language)]
+
+    def label_counts(self, language):
+        """
+        :return: the number of Fragments per label in a language, in the order of the vocabulary of the language
+        """
+        return np.bincount(self.column(language), minlength=len(self.vocabulary[language]))
+
+    def group_rows(self, codes, n_groups):
+        """
+        Groups the rows by an integer code per row.
+        :return: a list with the (ascending) rows per code
+        """
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(n_groups + 1))
+        return [order[bounds[n]:bounds[n + 1]] for n in range(n_groups)]
+
+    def rows_per_label(self, language):
+        """
+        :return: a list with the rows of the Fragments per label in a language, in the order of the vocabulary
+        """
+        return self.group_rows(self.column(language), len(self.vocabulary[language]))
+
+    def n_tuples(self):
+        return len(self.offsets) - 1
+
+    def tuple_rows(self, tuple_id):
+        """
+        :return: the (ascending) rows of the Fragments with a label tuple
+        """
+        return self.rows[self.offsets[tuple_id]:self.offsets[tuple_id + 1]]
+
+    def tuple_labels(self, tuple_id):
+        """
+        :return: a dictionary with the label per language of a label tuple
+        """
+        return self.row_labels(self.rows[self.offsets[tuple_id]])
+
+    def row_labels(self, row):
+        """
+        :return: a dictionary with the label per language of a Fragment
+        """
+        return {language: self.vocabulary[language][self.codes[row, column]]
+                for column, language in enumerate(self.languages)}
+
+    def find_row(self, fragment_pk):
+        """
+        :return: the row of a Fragment, or None if the Fragment is not part of the cube
+        """
+        position = int(np.searchsorted(self.sorted_pks, fragment_pk))
+        if position < len(self.sorted_pks) and self.sorted_pks[position] == fragment_pk:
+            return int(self.sorted_rows[position])
+        return None
+
+    def find_tuple(self, fragment_pk):
+        """
+        :return: the id of the label tuple of a Fragment, or None if the Fragment is not part of the cube
+        """
+        row = self.find_row(fragment_pk)
+        return None if row is None else int(self.tuples[row])
+
+    def tuple_fragments(self, tuple_id):
+        """
+        :return: the pks of the Fragments with a label tuple, in the order of the Fragments
+        """
+        return self.fragment_pks[self.tuple_rows(tuple_id)].tolist()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+import numpy as np
+
+
+# Number of cells (rows x columns x languages) compared at once when computing a block of the distance matrix
+BLOCK_CELLS = 2 ** 24
+
+
+def encode_labels(fragment_labels):
+    """
+    Integer-encodes the labels of a Scenario into a code matrix.
+    Every distinct label (tuple) in a language receives a positive code, missing labels are encoded as 0.
+    :param fragment_labels: a dictionary with an equally long list of labels per language
+    :return: a (fragments x languages) numpy array of label codes
+    """
+    n_fragments = max((len(values) for values in fragment_labels.values()), default=0)
+    codes = np.zeros((n_fragments, len(fragment_labels)), dtype=np.int32)
+    for column, values in enumerate(fragment_labels.values()):
+        code_table = dict()
+        for row, value in enumerate(values):
+            if value:
+                codes[row, column] = code_table.setdefault(value, len(code_table) + 1)
+    return codes
+
+
+def distance_table(n_languages):
+    """
+    Precomputes the distance for every combination of matching and compared labels.
+    This uses the exact same arithmetic as stats.utils.get_distance, so that the resulting matrix is identical.
+    :param n_languages: the number of languages in the Scenario
+    :return: a (matches x total) numpy array of distances
+    """
+    table = np.zeros((n_languages + 1, n_languages + 1), dtype=np.float64)
+    for total in range(1, n_languages + 1):
+        for result in range(total + 1):
+            table[result, total] = 1 - round(result / total, 2)
+    return table
+
+
+def distance_block(block, codes, table):
+    """
+    Computes the distances between the rows of a block and all rows of a code matrix.
+    Missing labels (encoded as 0) are skipped in the comparison.
+    :return: a (block rows x fragments) numpy array of distances
+    """
+    block = block[:, np.newaxis, :]
+    others = codes[np.newaxis, :, :]
+    compared = (block > 0) & (others > 0)
+    result = ((block == others) & compared).sum(axis=2)
+    total = compared.sum(axis=2)
+    return table[result, total]
+
+
+def iter_distance_blocks(codes, block_cells=BLOCK_CELLS):
+    """
+    Yields the distance matrix for a code matrix in blocks of rows.
+    :return: tuples of (start, stop, block)
+    """
+    n_fragments, n_languages = codes.shape
+    table = distance_table(n_languages)
+    rows = max(1, block_cells // max(1, n_fragments * n_languages))
+    for start in range(0, n_fragments, rows):
+        stop = min(start + rows, n_fragments)
+        yield start, stop, distance_block(codes[start:stop], codes, table)
+
+
+def get_distance_matrix(codes, block_cells=BLOCK_CELLS):
+    """
+    Computes the full (fragments x fragments) distance matrix for a code matrix.
+    """
+    n_fragments = codes.shape[0]
+    matrix = np.empty((n_fragments, n_fragments), dtype=np.float64)
+    for start, stop, block in iter_distance_blocks(codes, block_cells):
+        matrix[start:stop] = block
+    return matrix
+
+
+def get_distance_rows(codes, rows, block_cells=BLOCK_CELLS):
+    """
+    Computes the distances between the given rows and all rows of a code matrix.
+    :param rows: the indices of the rows
+    :return: a (rows x fragments) numpy array of distances
+    """
+    n_fragments, n_languages = codes.shape
+    table = distance_table(n_languages)
+    step = max(1, block_cells // max(1, n_fragments * n_languages))
+    result = np.empty((len(rows), n_fragments), dtype=np.float64)
+    for start in range(0, len(rows), step):
+        result[start:start + step] = distance_block(codes[rows[start:start + step]], codes, table)
+    return result
+
+
+def quantize(block):
+    """
+    Quantizes distances to unsigned bytes. Distances are rounded to two decimals, so this is (almost) lossless.
+    """
+    return np.rint(block * 100).astype(np.uint8)
+
+
+def dequantize(block, dtype=np.float64):
+    """
+    Converts a block of (possibly quantized or single precision) distances back to floating point values.
+    :param dtype: the data type of the values, numpy.float32 keeps a single precision block as it is (rounded)
+    """
+    if block.dtype == np.uint8:
+        values = block.astype(dtype)
+        values /= 100
+        return values
+    if block.dtype == np.float32:
+        values = block.astype(dtype)
+        return values.round(2, out=values)
+    return block
+
+
+def write_matrix(blocks, n_fragments, filename, dtype):
+    """
+    Writes a distance matrix, given in blocks of rows, to a memory-mapped file.
+    The file is written next to its destination first, so that readers never see a partially written matrix.
+    :param blocks: an iterable of (start, stop, block) tuples, see iter_distance_blocks
+    :param filename: the destination of the matrix
+    :param dtype: the data type to store the distances in, either numpy.float64, numpy.float32 or numpy.uint8
+    :return: the sum of the squared distances (used to normalize the stress)
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # A unique temporary file, as the matrix of a Scenario may be built by multiple processes at once
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    os.close(fd)
+
+    matrix = np.memmap(tmp_filename, dtype=dtype, mode='w+', shape=(n_fragments, n_fragments))
+    squares = 0.0
+    for start, stop, block in blocks:
+        squares += (block ** 2).sum()
+        matrix[start:stop] = quantize(block) if matrix.dtype == np.uint8 else block
+    matrix.flush()
+    del matrix
+    os.chmod(tmp_filename, 0o644)
+
+    os.replace(tmp_filename, filename)
+    return squares
+
+
+def write_distance_matrix(codes, filename, dtype, block_cells=BLOCK_CELLS):
+    """
+    Computes the distance matrix for a code matrix in blocks of rows, and writes it to a memory-mapped file.
+    :param codes: the code matrix, see encode_labels
+    :return: the sum of the squared distances
+    """
+    return write_matrix(iter_distance_blocks(codes, block_cells), codes.shape[0], filename, dtype)
+
+
+def iter_patched_blocks(matrix, kept, codes, changed, block_cells=BLOCK_CELLS):
+    """
+    Yields the distance matrix for a patched code matrix in blocks of rows, reusing a previous distance matrix:
+    the first rows of the code matrix are the kept rows of the previous matrix, the distances of the changed rows
+    (including all rows that have been appended) are recomputed.
+    :param matrix: the previous (possibly memory-mapped) distance matrix
+    :param kept: the indices of the kept rows in the previous matrix
+    :param changed: the (sorted) indices of the changed rows in the code matrix
+    :return: tuples of (start, stop, block)
+    """
+    n_fragments = codes.shape[0]
+    changed_rows = get_distance_rows(codes, changed, block_cells)
+    kept = np.asarray(kept, dtype=np.int64)
+
+    rows = max(1, block_cells // max(1, n_fragments))
+    for start in range(0, n_fragments, rows):
+        stop = min(start + rows, n_fragments)
+        block = np.empty((stop - start, n_fragments), dtype=np.float64)
+        if start < len(kept):
+            previous = dequantize(np.asarray(matrix[kept[start:stop]]))
+            block[:len(previous), :len(kept)] = previous[:, kept]
+        block[:, changed] = changed_rows[:, start:stop].T
+        in_block = (changed >= start) & (changed < stop)
+        block[changed[in_block] - start] = changed_rows[in_block]
+        yield start, stop, block
+
+
+def read_distance_matrix(filename, dtype, n_fragments):
+    """
+    Opens a memory-mapped distance matrix, as written by write_distance_matrix, read-only.
+    """
+    return np.memmap(filename, dtype=dtype, mode='r', shape=(n_fragments, n_fragments))
+
+
+def iter_matrix_rows(matrix, block_cells=BLOCK_CELLS):
+    """
+    Yields a (possibly memory-mapped) distance matrix in dequantized blocks of rows.
+    :return: tuples of (start, stop, block)
+    """
+    n_rows = matrix.shape[0]
+    rows = max(1, block_cells // max(1, matrix.shape[1]))
+    for start in range(0, n_rows, rows):
+        stop = min(start + rows, n_rows)
+        yield start, stop, dequantize(np.asarray(matrix[start:stop]))
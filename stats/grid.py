@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+# Number of levels of a MultiResolutionGrid: the finest level divides the plot in 2 ** 10 x 2 ** 10 cells
+GRID_LEVELS = 11
+
+
+class GridLevel:
+    """
+    The non-empty cells of a level of a MultiResolutionGrid, with their ids (see MultiResolutionGrid.cell_ids),
+    the number of points, the centroid of the points and the most frequent group of the points.
+    """
+
+    def __init__(self, ids, counts, x, y, dominant):
+        self.ids = ids
+        self.counts = counts
+        self.x = x
+        self.y = y
+        self.dominant = dominant
+
+
+class MultiResolutionGrid:
+    """
+    A pyramid of grids over the points of a scatter plot, used to downsample the plot to a budget of points.
+    Level l divides the bounding box of the points in 2 ** l x 2 ** l cells.
+    The points are divided in groups (e.g. their label tuples), for every cell the most frequent group is kept.
+    """
+
+    def __init__(self, x, y, groups, levels=GRID_LEVELS):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.groups = np.asarray(groups, dtype=np.int64)
+
+        self.x_min = self.x.min()
+        self.y_min = self.y.min()
+        # Prevent a division by zero if all points have the same coordinate
+        self.width = max(self.x.max() - self.x_min, 1e-9)
+        self.height = max(self.y.max() - self.y_min, 1e-9)
+
+        self.levels = [self._aggregate(level) for level in range(levels)]
+
+    def cell_coordinates(self, x, y, level):
+        """
+        :return: the column and row of the cells of the given coordinates on a level
+        """
+        size = 2 ** level
+        column = np.clip(np.floor((np.asarray(x) - self.x_min) / self.width * size), 0, size - 1).astype(np.int64)
+        row = np.clip(np.floor((np.asarray(y) - self.y_min) / self.height * size), 0, size - 1).astype(np.int64)
+        return column, row
+
+    def cell_ids(self, level):
+        """
+        :return: the ids of the cells of all points on a level
+        """
+        column, row = self.cell_coordinates(self.x, self.y, level)
+        return column * 2 ** level + row
+
+    def _aggregate(self, level):
+        ids, inverse, counts = np.unique(self.cell_ids(level), return_inverse=True, return_counts=True)
+        x = np.bincount(inverse, weights=self.x, minlength=len(ids)) / np.maximum(counts, 1)
+        y = np.bincount(inverse, weights=self.y, minlength=len(ids)) / np.maximum(counts, 1)
+
+        # Find the most frequent group per cell, ties are resolved in favour of the lowest group
+        n_groups = self.groups.max() + 1
+        pairs, pair_counts = np.unique(inverse * n_groups + self.groups, return_counts=True)
+        pair_cells, pair_groups = pairs // n_groups, pairs % n_groups
+        order = np.lexsort((-pair_counts, pair_cells))
+        dominant = pair_groups[order[np.searchsorted(pair_cells[order], np.arange(len(ids)))]]
+
+        return GridLevel(ids, counts, x, y, dominant)
+
+    def cells_in_window(self, level, x0, x1, y0, y1):
+        """
+        :return: the indices of the cells on a level that overlap with a window
+        """
+        grid = self.levels[level]
+        size = 2 ** level
+        (column0, column1), (row0, row1) = self.cell_coordinates([x0, x1], [y0, y1], level)
+        columns, rows = grid.ids // size, grid.ids % size
+        return np.flatnonzero((columns >= column0) & (columns <= column1) & (rows >= row0) & (rows <= row1))
+
+    def query(self, x0, x1, y0, y1, budget):
+        """
+        Downsamples the points in a window to a budget of points.
+        If the window contains more points than the budget, the finest level with at most budget cells in the window
+        is selected. The cells with the fewest points are then replaced by their points, as long as the budget allows.
+        :param budget: the maximum number of cells and points to return (at least 1)
+        :return: a tuple of the level (or None if all points fit the budget), the indices of the cells on that level,
+        and the indices of the points
+        """
+        in_window = (self.x >= x0) & (self.x <= x1) & (self.y >= y0) & (self.y <= y1)
+        if in_window.sum() <= budget:
+            return None, np.array([], dtype=np.int64), np.flatnonzero(in_window)
+
+        level = len(self.levels) - 1
+        cells = self.cells_in_window(level, x0, x1, y0, y1)
+        while len(cells) > budget and level > 0:
+            level -= 1
+            cells = self.cells_in_window(level, x0, x1, y0, y1)
+
+        # Expand the smallest cells into their points, only the points of those cells inside the window are returned
+        grid = self.levels[level]
+        order = np.argsort(grid.counts[cells], kind='stable')
+        extra = np.cumsum(grid.counts[cells[order]] - 1)
+        n_expanded = np.searchsorted(extra, budget - len(cells), side='right')
+        expanded = cells[order[:n_expanded]]
+        cells = np.sort(cells[order[n_expanded:]])
+
+        points = np.flatnonzero(in_window & np.isin(self.cell_ids(level), grid.ids[expanded]))
+        return level, cells, points
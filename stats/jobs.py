@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+import contextlib
+from datetime import timedelta
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import Q
+from django.utils import timezone
+
+from annotations.models import Corpus
+from .loader import CorpusSnapshot
+from .models import Scenario, ScenarioJob
+from .utils import run_mds, update_mds, EmptyScenario, ImproperScenario
+
+
+logger = logging.getLogger(__name__)
+
+# CorpusSnapshots used by rerun_scenarios, these are shared with the (forked) worker processes
+_snapshots = dict()
+
+EMPTY_SCENARIO_MESSAGE = 'Scenario configuration produced an empty data set.'
+IMPROPER_SCENARIO_MESSAGE = 'Scenario configuration incorrect. If have more than one from-language, ' \
+                            'make sure that these are also set as to-languages.'
+
+
+def enqueue_scenario(scenario, user=None, incremental=False, attempt=1):
+    """
+    Queues a (re)run of a Scenario, unless a run has already been queued.
+    A queued incremental run is turned into a full run if a full run is requested.
+    :param incremental: only process the Fragments that have changed since the last run (see update_mds)
+    :param attempt: the number of the attempt, when a job is queued again (see reset_jobs)
+    :return: the queued ScenarioJob
+    """
+    job = scenario.jobs.filter(status=ScenarioJob.QUEUED).first()
+    if not job:
+        job = ScenarioJob.objects.create(scenario=scenario, created_by=user, incremental=incremental, attempt=attempt)
+    elif job.incremental and not incremental:
+        job.incremental = False
+        job.save()
+    return job
+
+
+def claim_job(worker):
+    """
+    Claims the oldest queued ScenarioJob for a worker.
+    Claiming is done with a conditional update, so that concurrent workers never claim the same job.
+    Scenarios that are currently being run by another worker are skipped. Running jobs of which the worker has
+    stopped responding are queued again first, see requeue_stale_jobs.
+    :return: the claimed ScenarioJob, or None if the queue is empty
+    """
+    requeue_stale_jobs()
+
+    running = ScenarioJob.objects.filter(status=ScenarioJob.RUNNING).values('scenario')
+    candidates = ScenarioJob.objects \
+        .filter(status=ScenarioJob.QUEUED) \
+        .exclude(scenario__in=running) \
+        .order_by('created_at') \
+        .values_list('pk', flat=True)
+    for pk in candidates[:10]:
+        claimed = ScenarioJob.objects \
+            .filter(pk=pk, status=ScenarioJob.QUEUED) \
+            .update(status=ScenarioJob.RUNNING, started_at=timezone.now(), heartbeat_at=timezone.now(), worker=worker)
+        if claimed:
+            return ScenarioJob.objects.select_related('scenario').get(pk=pk)
+    return None
+
+
+def requeue_stale_jobs(timeout=None, max_attempts=None):
+    """
+    Fails the running ScenarioJobs of which the worker has stopped sending heartbeats (e.g. because it has been
+    killed), and queues their Scenarios again. Otherwise, these Scenarios would never be run again (see claim_job).
+    A Scenario of which the worker keeps stopping (e.g. because it runs out of memory) is no longer queued after a
+    number of attempts, so that it does not occupy the workers forever.
+    :param timeout: the number of seconds after which a job without a heartbeat is stale, see SCENARIO_JOB_TIMEOUT
+    :param max_attempts: the number of attempts after which a job is not queued again, see SCENARIO_JOB_MAX_ATTEMPTS
+    :return: the number of jobs that have been queued again
+    """
+    timeout = settings.SCENARIO_JOB_TIMEOUT if timeout is None else timeout
+    max_attempts = settings.SCENARIO_JOB_MAX_ATTEMPTS if max_attempts is None else max_attempts
+    threshold = timezone.now() - timedelta(seconds=timeout)
+    stale = ScenarioJob.objects \
+        .filter(status=ScenarioJob.RUNNING) \
+        .filter(Q(heartbeat_at__lt=threshold) | Q(heartbeat_at__isnull=True, started_at__lt=threshold))
+    return reset_jobs(stale, 'The worker stopped responding, the scenario has been queued again.',
+                      max_attempts=max_attempts,
+                      final_message='The worker stopped responding in {} attempts, the scenario has not been queued '
+                                    'again.'.format(max_attempts))
+
+
+def reset_jobs(jobs, message, max_attempts=None, final_message=None):
+    """
+    Fails running ScenarioJobs, and queues their Scenarios again.
+    :param jobs: a QuerySet of ScenarioJobs, of which only the running jobs are reset
+    :param max_attempts: if given, jobs that have been attempted this number of times are failed with the
+    final_message, and are not queued again
+    :return: the number of jobs that have been queued again
+    """
+    n_reset = 0
+    for job in jobs.filter(status=ScenarioJob.RUNNING).select_related('scenario', 'created_by'):
+        final = max_attempts is not None and job.attempt >= max_attempts
+        # The conditional update makes sure a job is only reset once
+        reset = ScenarioJob.objects \
+            .filter(pk=job.pk, status=ScenarioJob.RUNNING) \
+            .update(status=ScenarioJob.FAILED, message=final_message if final else message, finished_at=timezone.now())
+        if reset and not final:
+            enqueue_scenario(job.scenario, job.created_by, job.incremental, attempt=job.attempt + 1)
+            n_reset += 1
+    return n_reset
+
+
+@contextlib.contextmanager
+def heartbeat(job, interval=None):
+    """
+    Regularly updates the heartbeat of a running ScenarioJob from a background thread, see requeue_stale_jobs.
+    """
+    interval = settings.SCENARIO_JOB_HEARTBEAT if interval is None else interval
+    stopped = threading.Event()
+
+    def beat():
+        try:
+            while not stopped.wait(interval):
+                ScenarioJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now())
+        finally:
+            # Every thread has its own database connection
+            connection.close()
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def process_job(job):
+    """
+    Runs the Scenario of a claimed ScenarioJob, and records the outcome on the job.
+    """
+    def progress(percentage, message):
+        ScenarioJob.objects.filter(pk=job.pk).update(progress=percentage, message=message)
+
+    status = ScenarioJob.FAILED
+    try:
+        scenario = Scenario.objects.get(pk=job.scenario_id)
+        with heartbeat(job):
+            if job.incremental:
+                n_changes = update_mds(scenario, progress=progress)
+                message = 'Scenario has been updated with {} changed fragments.'.format(n_changes)
+            else:
+                run_mds(scenario, progress=progress)
+                message = 'Scenario has been run.'
+        status = ScenarioJob.FINISHED
+    except EmptyScenario:
+        message = EMPTY_SCENARIO_MESSAGE
+    except ImproperScenario:
+        message = IMPROPER_SCENARIO_MESSAGE
+    except Exception as e:
+        message = 'Something went wrong while running scenario {}: {}'.format(job.scenario.title, e)
+        logger.exception('Error running scenario {}.'.format(job.scenario.title))
+
+    ScenarioJob.objects.filter(pk=job.pk).update(
+        status=status, message=message, finished_at=timezone.now(),
+        progress=100 if status == ScenarioJob.FINISHED else job.progress)
+    job.refresh_from_db()
+    return job
+
+
+def run_worker(poll_interval=5, once=False):
+    """
+    Processes queued ScenarioJobs until stopped.
+    :param poll_interval: the number of seconds to wait before checking an empty queue again
+    :param once: stop when the queue is empty
+    """
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    while True:
+        job = claim_job(worker)
+        if job:
+            process_job(job)
+        elif once:
+            break
+        else:
+            time.sleep(poll_interval)
+
+
+def run_workers(processes, poll_interval=5, once=False):
+    """
+    Starts a number of worker processes, and waits for them to finish.
+    """
+    if processes <= 1:
+        run_worker(poll_interval, once)
+        return
+
+    # Database connections cannot be shared between processes
+    connections.close_all()
+    workers = [multiprocessing.Process(target=run_worker, args=(poll_interval, once)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def rerun_scenario(scenario_pk):
+    """
+    Reruns a Scenario, using the CorpusSnapshot of its Corpus if it has been loaded.
+    :return: a tuple of the Scenario's pk and title, the duration in seconds, and an error message (or None)
+    """
+    start = time.time()
+    scenario = Scenario.objects.get(pk=scenario_pk)
+    error = None
+    try:
+        run_mds(scenario, snapshot=_snapshots.get(scenario.corpus_id))
+    except EmptyScenario:
+        error = EMPTY_SCENARIO_MESSAGE
+    except ImproperScenario:
+        error = IMPROPER_SCENARIO_MESSAGE
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        logger.exception('Error running scenario {}.'.format(scenario.title))
+    return scenario.pk, scenario.title, time.time() - start, error
+
+
+def rerun_scenarios(scenarios, processes=1):
+    """
+    Reruns a number of Scenarios in a pool of processes.
+    The Fragments and Annotations of every Corpus involved are loaded once, and shared between the processes.
+    :return: a generator of the results of rerun_scenario, in order of completion
+    """
+    scenario_pks = [scenario.pk for scenario in scenarios]
+
+    _snapshots.clear()
+    for corpus in Corpus.objects.filter(scenario__pk__in=scenario_pks).distinct():
+        _snapshots[corpus.pk] = CorpusSnapshot(corpus)
+
+    if processes <= 1:
+        for scenario_pk in scenario_pks:
+            yield rerun_scenario(scenario_pk)
+        return
+
+    # Database connections cannot be shared between processes
+    connections.close_all()
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        for result in pool.imap_unordered(rerun_scenario, scenario_pks):
+            yield result
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+
+import numpy as np
+
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+
+from annotations.models import Fragment, Annotation, Language
+
+
+def _columns(queryset, fields, n_columns):
+    """
+    Fetches the given (integer) fields of a QuerySet as the columns of a numpy array.
+    """
+    values = np.array(list(queryset.values_list(*fields)), dtype=np.int64)
+    return values.reshape(-1, n_columns).T
+
+
+class LabelLinks:
+    """
+    The Labels of a set of Fragments or Annotations, stored as columns sorted by the pk of the owner.
+    Within an owner, the Labels are kept in their default ordering, which determines the order in the label tuples.
+    """
+
+    def __init__(self, through, field, **filters):
+        queryset = through.objects \
+            .filter(**filters) \
+            .order_by('label__key', 'label__language', 'label__title')
+        owners, labels, keys = _columns(queryset, ['{}_id'.format(field), 'label_id', 'label__key_id'], 3)
+
+        order = np.argsort(owners, kind='stable')
+        self.owners = owners[order]
+        self.labels = labels[order]
+        self.keys = keys[order]
+
+    def get(self, pk):
+        """
+        :return: the Label pks and LabelKey pks for the given owner
+        """
+        start, stop = np.searchsorted(self.owners, [pk, pk + 1])
+        return self.labels[start:stop], self.keys[start:stop]
+
+    def owners_with(self, labels):
+        """
+        :return: the pks of the owners that have one of the given Labels
+        """
+        return np.unique(self.owners[np.isin(self.labels, list(labels))])
+
+
+class CorpusSnapshot:
+    """
+    A columnar snapshot of the Fragments, Annotations and their Labels in a Corpus.
+    The snapshot is loaded with a fixed number of values queries, after which the labels of a Scenario can be retrieved
+    without querying the database for Fragments or Annotations, and without instantiating any models.
+    A snapshot is either scoped to a single Scenario (see run_mds), or contains the whole Corpus.
+    In the latter case, it can be shared between (forked) worker processes that run multiple Scenarios.
+    A snapshot scoped to a Scenario can be further limited to a set of Fragments (see update_mds).
+    """
+
+    def __init__(self, corpus, scenario=None, fragment_pks=None):
+        self.corpus_id = corpus.pk
+        self.scenario_id = scenario.pk if scenario else None
+        self.isos = dict(Language.objects.values_list('pk', 'iso'))
+
+        fragments = Fragment.objects.filter(document__corpus=corpus)
+        if scenario:
+            fragments = self._scope_fragments(scenario, fragments)
+        if fragment_pks is not None:
+            fragments = fragments.filter(pk__in=fragment_pks)
+        annotations = Annotation.objects \
+            .filter(alignment__original_fragment__in=fragments, is_no_target=False, is_translation=True)
+        if scenario:
+            annotations = annotations.filter(
+                alignment__translated_fragment__language__in=scenario.languages(as_to=True).values('language'))
+
+        self.fragments = _columns(
+            fragments.order_by('pk').annotate(tense_or_zero=Coalesce('tense', Value(0))),
+            ['pk', 'language_id', 'document_id', 'tense_or_zero', 'formal_structure', 'sentence_function'], 6)
+        self.annotations = _columns(
+            annotations.order_by('pk').annotate(tense_or_zero=Coalesce('tense', Value(0))),
+            ['pk', 'alignment__original_fragment_id', 'alignment__translated_fragment__language_id',
+             'tense_or_zero', 'is_not_same_structure'], 5)
+
+        self.fragment_labels = LabelLinks(Fragment.labels.through, 'fragment', fragment__in=fragments)
+        self.annotation_labels = LabelLinks(Annotation.labels.through, 'annotation', annotation__in=annotations)
+
+        # Annotations without a Tense and without Labels are never included
+        pks, _, _, tense_ids, _ = self.annotations
+        self.annotations = self.annotations[:, (tense_ids > 0) | np.isin(pks, self.annotation_labels.owners)]
+
+    def _scope_fragments(self, scenario, fragments):
+        """
+        Limits the Fragments to those that can possibly be included in the Scenario.
+        The remaining filters are applied in memory, see _filter_fragments.
+        """
+        languages_from = scenario.languages(as_from=True)
+        if languages_from.exists():
+            fragments = fragments.filter(language__in=languages_from.values('language'))
+        if scenario.documents.exists():
+            fragments = fragments.filter(document__in=scenario.documents.all())
+        if scenario.formal_structure != Fragment.FS_NONE:
+            fragments = fragments.filter(formal_structure=scenario.formal_structure)
+        if scenario.sentence_function != Fragment.SF_NONE:
+            fragments = fragments.filter(sentence_function=scenario.sentence_function)
+        return fragments
+
+    def retrieve_labels(self, scenario, languages_from, languages_to):
+        """
+        Retrieves the labels per language for the Fragments in a Scenario.
+        :return: the list of Fragment pks and a dictionary with a list of labels per language
+        """
+        if self.corpus_id != scenario.corpus_id or self.scenario_id not in [None, scenario.pk]:
+            raise ValueError('Snapshot does not match scenario {}'.format(scenario.title))
+
+        fragment_pks = []
+        fragment_labels = defaultdict(list)
+
+        for language_from in languages_from:
+            # Retrieve the Annotations from all ScenarioLanguages (except when they are also used as from-language)
+            languages_to_filtered = [lt for lt in languages_to if lt.language_id != language_from.language_id]
+            self._retrieve_labels(scenario, languages_to_filtered, fragment_labels, fragment_pks, language_from)
+
+        # If no from-languages are provided, use the Fragments in all languages
+        if not languages_from:
+            self._retrieve_labels(scenario, languages_to, fragment_labels, fragment_pks)
+
+        return fragment_pks, fragment_labels
+
+    def _retrieve_labels(self, scenario, languages_to, fragment_labels, fragment_pks, language_from=None):
+        from_filters = LanguageFilters(language_from) if language_from else None
+        to_filters = {language_to.language_id: LanguageFilters(language_to) for language_to in languages_to}
+
+        fragments = self.fragments[:, self._filter_fragments(scenario, language_from, from_filters)]
+        annotations = self.annotations[:, self._filter_annotations(scenario, fragments[0], to_filters)]
+
+        # Keep the first Annotation per Fragment and Language, and create a lookup of Fragment -> Annotations
+        pks, original_pks, language_ids, tense_ids, _ = annotations
+        _, first = np.unique(np.stack([original_pks, language_ids]), axis=1, return_index=True)
+        annotations_dict = defaultdict(dict)
+        for pk, original_pk, language_id, tense_id in zip(pks[first].tolist(), original_pks[first].tolist(),
+                                                          language_ids[first].tolist(), tense_ids[first].tolist()):
+            annotations_dict[original_pk][language_id] = (pk, tense_id)
+
+        pks, language_ids, _, tense_ids, _, _ = fragments
+        for fragment_pk, language_id, tense_id in zip(pks.tolist(), language_ids.tolist(), tense_ids.tolist()):
+            fragment_annotations = annotations_dict.get(fragment_pk)
+            if not fragment_annotations:
+                # No Annotations at all, skip Fragment
+                continue
+
+            annotated_labels = dict()
+            for language_to in languages_to:
+                if language_to.language_id in fragment_annotations:
+                    pk, a_tense_id = fragment_annotations[language_to.language_id]
+                    a_label = to_filters[language_to.language_id].get_labels(
+                        a_tense_id, self.annotation_labels.get(pk))
+                    if a_label:
+                        annotated_labels[self.isos[language_to.language_id]] = a_label
+
+            # Only allow Fragments that have Annotations in all languages, unless the scenario allows partial tuples
+            if scenario.mds_allow_partial or len(annotated_labels) == len(languages_to):
+                fragment_pks.append(fragment_pk)
+
+                # store label of source language
+                if language_from:
+                    from_labels = from_filters.get_labels(tense_id, self.fragment_labels.get(fragment_pk))
+                    fragment_labels[self.isos[language_id]].append(from_labels)
+
+                # store label(s) of target language(s)
+                for language_to in languages_to:
+                    key = self.isos[language_to.language_id]
+                    fragment_labels[key].append(annotated_labels.get(key))
+
+    def _filter_fragments(self, scenario, language_from, filters):
+        pks, language_ids, document_ids, tense_ids, formal_structures, sentence_functions = self.fragments
+        mask = np.ones(len(pks), dtype=bool)
+
+        # Filter on the from-language (if set)
+        if language_from:
+            mask &= language_ids == language_from.language_id
+
+        # Filter on Documents (if selected)
+        documents = list(scenario.documents.values_list('pk', flat=True))
+        if documents:
+            mask &= np.isin(document_ids, documents)
+
+        # Filter on SubCorpora (if selected)
+        for subcorpus in scenario.subcorpora.all():
+            mask &= np.isin(pks, list(subcorpus.get_fragments().values_list('pk', flat=True)))
+
+        # Filter on formal structure and sentence function (if selected)
+        if scenario.formal_structure != Fragment.FS_NONE:
+            mask &= formal_structures == scenario.formal_structure
+        if scenario.sentence_function != Fragment.SF_NONE:
+            mask &= sentence_functions == scenario.sentence_function
+
+        # Filter on Tenses and Labels (if selected)
+        if filters:
+            if filters.tenses:
+                mask &= np.isin(tense_ids, list(filters.tenses))
+            if filters.include_labels:
+                mask &= np.isin(pks, self.fragment_labels.owners_with(filters.include_labels))
+
+        return mask
+
+    def _filter_annotations(self, scenario, fragment_pks, filters):
+        pks, original_pks, language_ids, tense_ids, is_not_same_structure = self.annotations
+        mask = np.isin(original_pks, fragment_pks) & np.isin(language_ids, list(filters))
+
+        # Filter on formal structure (if selected)
+        if scenario.formal_structure != Fragment.FS_NONE and scenario.formal_structure_strict:
+            mask &= is_not_same_structure == 0
+
+        # Filter on Tenses and Labels (if selected)
+        for language_id, language_filters in filters.items():
+            other_language = language_ids != language_id
+            if language_filters.tenses:
+                mask &= other_language | np.isin(tense_ids, list(language_filters.tenses))
+            if language_filters.include_labels:
+                mask &= other_language | np.isin(pks, self.annotation_labels.owners_with(language_filters.include_labels))
+
+        return mask
+
+
+class LanguageFilters:
+    """
+    The Tenses and Labels to filter on, and the LabelKeys to include in the tuples, for a ScenarioLanguage.
+    """
+
+    def __init__(self, scenario_language):
+        self.use_tenses = scenario_language.use_tenses
+        self.use_labels = scenario_language.use_labels
+        self.tenses = set(t.pk for t in scenario_language.tenses.all()) if self.use_tenses else set()
+        self.include_labels = set(label.pk for label in scenario_language.include_labels.all()) \
+            if self.use_labels else set()
+        self.include_keys = set(key.pk for key in scenario_language.include_keys.all())
+
+    def get_labels(self, tense_id, labels):
+        """
+        Creates the label tuple for a Fragment or Annotation, this mirrors HasLabelsMixin.get_labels.
+        :param tense_id: the pk of the Tense, 0 if not set
+        :param labels: the Label pks and LabelKey pks, see LabelLinks.get
+        """
+        out = []
+        if self.use_tenses and tense_id:
+            out.append('Tense:{}'.format(tense_id))
+        if self.use_labels:
+            label_ids, key_ids = labels
+            out.extend('Label:{}'.format(label_id) for label_id, key_id in zip(label_ids.tolist(), key_ids.tolist())
+                       if not self.include_keys or key_id in self.include_keys)
+        return tuple(out)
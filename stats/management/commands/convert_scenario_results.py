@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from stats.models import Scenario
+from stats.utils import convert_results
+
+
+class Command(BaseCommand):
+    help = 'Moves the pickled results of scenarios from the database to the scenario store on disk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', type=int, nargs='*',
+                            help='The pks of the scenarios to convert (defaults to all scenarios)')
+
+    def handle(self, *args, **options):
+        scenarios = Scenario.objects.filter(mds_fragments__isnull=False)
+        if options['scenarios']:
+            scenarios = scenarios.filter(pk__in=options['scenarios'])
+
+        # Load the scenarios one by one, as the pickled results can be large
+        scenario_pks = list(scenarios.order_by('pk').values_list('pk', flat=True))
+        for scenario_pk in scenario_pks:
+            scenario = Scenario.objects.get(pk=scenario_pk)
+            convert_results(scenario)
+            self.stdout.write('Scenario {} ({}) has been converted'.format(scenario.title, scenario.pk))
+
+        self.stdout.write(self.style.SUCCESS('{} scenario(s) have been converted'.format(len(scenario_pks))))
@@ -0,0 +1,68 @@
+import os
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F, OuterRef, Q, Subquery
+
+from annotations.models import Annotation, Corpus
+from stats.jobs import rerun_scenarios
+from stats.models import Scenario
+
+
+class Command(BaseCommand):
+    help = 'Reruns MDS for multiple scenarios in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', type=str, dest='corpora', action='append',
+                            help='Only rerun scenarios for the Corpus with this title (can be repeated)')
+        parser.add_argument('--owner', type=str,
+                            help='Only rerun scenarios owned by the User with this username')
+        parser.add_argument('--stale', action='store_true', default=False,
+                            help='Only rerun scenarios that have never been run, '
+                                 'or that have Annotations that were modified after their last run')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Number of scenarios to run in parallel (defaults to the number of CPUs)')
+
+    def handle(self, *args, **options):
+        scenarios = Scenario.objects.all()
+
+        if options['corpora']:
+            corpora = Corpus.objects.filter(title__in=options['corpora'])
+            if len(corpora) != len(set(options['corpora'])):
+                raise CommandError('One or more corpora in {} do not exist'.format(', '.join(options['corpora'])))
+            scenarios = scenarios.filter(corpus__in=corpora)
+
+        if options['owner']:
+            try:
+                scenarios = scenarios.filter(owner=User.objects.get(username=options['owner']))
+            except User.DoesNotExist:
+                raise CommandError('User with username {} does not exist'.format(options['owner']))
+
+        if options['stale']:
+            last_modified = Annotation.objects \
+                .filter(alignment__original_fragment__document__corpus=OuterRef('corpus')) \
+                .order_by('-last_modified_at') \
+                .values('last_modified_at')[:1]
+            scenarios = scenarios \
+                .annotate(last_modified=Subquery(last_modified)) \
+                .filter(Q(last_run__isnull=True) | Q(last_run__lt=F('last_modified')))
+
+        scenarios = list(scenarios.only('pk', 'corpus').order_by('pk'))
+        self.stdout.write('Rerunning {} scenario(s)'.format(len(scenarios)))
+
+        start = time.time()
+        failures = []
+        for pk, title, duration, error in rerun_scenarios(scenarios, options['processes']):
+            if error:
+                failures.append((pk, title, error))
+                self.stdout.write(self.style.ERROR('Scenario {} ({}) failed after {:.1f}s: {}'.format(
+                    title, pk, duration, error)))
+            else:
+                self.stdout.write('Scenario {} ({}) has been run in {:.1f}s'.format(title, pk, duration))
+
+        summary = '{} of {} scenario(s) have been run in {:.1f}s'.format(
+            len(scenarios) - len(failures), len(scenarios), time.time() - start)
+        self.stdout.write(self.style.ERROR(summary) if failures else self.style.SUCCESS(summary))
+        for pk, title, error in failures:
+            self.stdout.write(self.style.ERROR(' - {} ({}): {}'.format(title, pk, error)))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from stats.jobs import run_workers
+
+
+class Command(BaseCommand):
+    help = 'Processes queued (re)runs of scenarios'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Number of worker processes, i.e. the number of scenarios to run in parallel')
+        parser.add_argument('--poll-interval', type=float, default=5,
+                            help='Number of seconds to wait before checking an empty queue again')
+        parser.add_argument('--once', action='store_true',
+                            help='Stop when the queue is empty')
+
+    def handle(self, *args, **options):
+        run_workers(options['processes'], options['poll_interval'], options['once'])
@@ -1,12 +1,23 @@
 # -*- coding: utf-8 -*-
+import glob
+import os
+import tempfile
+from zipfile import ZipFile
+
 import pandas as pd
+import pyarrow as pa
 import pyarrow.feather as feather
 
 from django.core.management.base import BaseCommand, CommandError
 
 from annotations.models import TenseCategory, Fragment
+from stats.distances import iter_matrix_rows
 from stats.models import Scenario
-from stats.utils import prepare_label_cache, get_label_properties_from_cache
+from stats.utils import prepare_label_cache, get_label_properties_from_cache, label_cache_version
+
+
+class NoMatrix(Exception):
+    pass
 
 
 class Command(BaseCommand):
@@ -24,7 +35,10 @@ class Command(BaseCommand):
 
         # Write a file with the matrix
         filename = 's{}-matrix.feather'.format(scenario.pk)
-        export_matrix(filename, scenario)
+        try:
+            export_matrix(filename, scenario)
+        except NoMatrix as e:
+            raise CommandError(e)
 
         # Write a file with the TenseCategory labels and colors
         filename = 'tensecats.feather'
@@ -35,10 +49,95 @@ class Command(BaseCommand):
         export_fragments(filename, scenario)
 
 
+def export_zip(scenario):
+    """
+    Exports a Scenario to a ZIP file with the matrix (if any), the TenseCategories and the labels in Feather format.
+    The ZIP file is kept in the directory of the ScenarioStore, keyed on the last run of the Scenario and on the version
+    of the label cache, so that it is only created once per run. The members are written in a private temporary
+    directory, and the ZIP file is moved into place when it is complete.
+    :return: the ZIP file, opened for reading, so that it can still be read if a concurrent export removes it
+    """
+    store = scenario.results()
+    key = (int(scenario.last_run.timestamp() * 1000000) if scenario.last_run else 0, label_cache_version())
+    filename = store.path('export-{}-{}.zip'.format(*key))
+    try:
+        return open_export(filename)
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(store.directory, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=store.directory) as directory:
+        members = []
+        try:
+            members.append('s{}-matrix.feather'.format(scenario.pk))
+            export_matrix(os.path.join(directory, members[-1]), scenario)
+        except NoMatrix:
+            members.pop()
+
+        members.append('tensecats.feather')
+        export_tensecats(os.path.join(directory, members[-1]))
+
+        members.append('s{}-labels.feather'.format(scenario.pk))
+        export_fragments(os.path.join(directory, members[-1]), scenario)
+
+        # The members are copied into the ZIP file in chunks
+        zip_filename = os.path.join(directory, 'export.zip')
+        with ZipFile(zip_filename, 'w') as zip_file:
+            for member in members:
+                zip_file.write(os.path.join(directory, member), member)
+        zip_file = open_export(zip_filename)
+        os.replace(zip_filename, filename)
+
+    remove_previous_exports(store, key)
+    return zip_file
+
+
+def open_export(filename):
+    """
+    Opens an export by its file descriptor: the file object has no name, as the file may have been moved or removed
+    since (see remove_previous_exports). Use os.fstat to retrieve its size.
+    """
+    return os.fdopen(os.open(filename, os.O_RDONLY), 'rb')
+
+
+def remove_previous_exports(store, key):
+    """
+    Removes the exports of previous runs and label cache versions. Exports that are not older than the given key
+    (e.g. the export of a newer run, created by a concurrent request) are kept.
+    :param key: the last run and the version of the label cache of the current export
+    """
+    for previous in glob.glob(store.path('export-*.zip')):
+        try:
+            name = os.path.basename(previous)[len('export-'):-len('.zip')]
+            previous_key = tuple(int(part) for part in name.split('-'))
+        except ValueError:
+            continue
+        if previous_key != key and all(p <= k for p, k in zip(previous_key, key)):
+            try:
+                os.remove(previous)
+            except FileNotFoundError:
+                pass
+
+
 def export_matrix(filename, scenario):
-    mds_matrix = scenario.mds_matrix
-    df = pd.DataFrame(data=mds_matrix)
-    feather.write_feather(df, filename, compression='uncompressed')
+    """
+    Exports the distance matrix of a Scenario. Of a Scenario that was run on collapsed tuples, the matrix between the
+    unique label tuples is exported, and the row of every Fragment in it is exported with the labels (see
+    export_fragments).
+    :raise NoMatrix: if the Scenario has no matrix, e.g. because it was run with landmarks
+    """
+    collapsed = scenario.get_collapsed_matrix()
+    mds_matrix = scenario.get_matrix() if collapsed is None else collapsed[0]
+    if mds_matrix is None:
+        raise NoMatrix('Scenario {} has no MDS matrix'.format(scenario.pk))
+
+    # Write the matrix in batches of rows, so that matrices stored on disk are never fully loaded in memory.
+    # A Feather (V2) file is an Arrow IPC file, hence we can use the IPC writer directly.
+    schema = pa.schema([(str(n), pa.float64()) for n in range(mds_matrix.shape[1])])
+    with pa.ipc.new_file(filename, schema) as writer:
+        for _, _, rows in iter_matrix_rows(mds_matrix):
+            columns = [pa.array(column) for column in rows.T]
+            writer.write_batch(pa.record_batch(columns, schema=schema))
 
 
 def export_tensecats(filename):
@@ -52,13 +151,17 @@ def export_tensecats(filename):
 
 
 def export_fragments(filename, scenario):
-    fragment_pks = scenario.mds_fragments
-    documents = []
-    for fragment in Fragment.objects.filter(pk__in=fragment_pks):
-        documents.append(fragment.document.title)
+    fragment_pks = scenario.get_fragments()
+    titles = dict(Fragment.objects.filter(pk__in=fragment_pks).values_list('pk', 'document__title'))
+    documents = [titles.get(pk) for pk in fragment_pks]
 
     df = pd.DataFrame({'fragment_pk': fragment_pks, 'document': documents})
 
+    # The rows of the Fragments in the matrix of the unique label tuples (see export_matrix)
+    collapsed = scenario.get_collapsed_matrix()
+    if collapsed is not None:
+        df['matrix_row'] = collapsed[1]
+
     scenario_labels = scenario.get_labels()
     cache = prepare_label_cache(scenario.corpus)
     for sl in scenario.languages().all():
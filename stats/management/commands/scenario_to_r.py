@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from collections import defaultdict
 
+import numpy as np
 import rpy2.robjects as robjects
 from rpy2.robjects.packages import importr
 from rpy2.robjects import numpy2ri
@@ -9,6 +10,7 @@ from rpy2.rlike import container
 from django.core.management.base import BaseCommand, CommandError
 
 from annotations.models import TenseCategory
+from stats.distances import dequantize
 from stats.models import Scenario
 from stats.utils import prepare_label_cache, get_label_properties_from_cache
 
@@ -30,8 +32,16 @@ class Command(BaseCommand):
             raise CommandError('Scenario with title {} does not exist'.format(options['scenario']))
 
         # Retrieve the pickled data
-        mds_matrix = scenario.mds_matrix
-        fragment_ids = scenario.mds_fragments
+        mds_matrix = scenario.get_matrix()
+        collapsed = scenario.get_collapsed_matrix()
+        if collapsed is not None:
+            # Expand the matrix between the unique label tuples of a Scenario that was run on collapsed tuples
+            matrix, inverse = collapsed
+            mds_matrix = matrix[np.ix_(inverse, inverse)]
+        if mds_matrix is None:
+            raise CommandError('Scenario {} has no MDS matrix'.format(scenario.pk))
+        mds_matrix = dequantize(mds_matrix)
+        fragment_ids = scenario.get_fragments()
         scenario_labels = scenario.get_labels()
 
         # Assign the pickled data to R variables
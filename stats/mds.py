@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from scipy import linalg
+from sklearn.metrics import euclidean_distances
+from sklearn.utils import check_random_state
+
+from .distances import get_distance_rows
+
+
+def collapse_codes(codes):
+    """
+    Collapses the identical rows (label tuples) of a code matrix.
+    :param codes: the code matrix, see stats.distances.encode_labels
+    :return: the unique rows, the index of the unique row for every original row, and the multiplicity of every unique row
+    """
+    unique_codes, inverse, counts = np.unique(codes, axis=0, return_inverse=True, return_counts=True)
+    return unique_codes, inverse.ravel(), counts
+
+
+def double_center(squared):
+    """
+    Double-centers a matrix of squared dissimilarities, i.e. computes -1/2 * J * squared * J.
+    """
+    b = squared - squared.mean(axis=0) - squared.mean(axis=1)[:, np.newaxis] + squared.mean()
+    return b / -2
+
+
+def largest_eigenpairs(b, n_components):
+    """
+    :return: the largest (non-negative) eigenvalues of a symmetric matrix in descending order, and their eigenvectors
+    """
+    n_points = b.shape[0]
+    k = min(n_points, n_components)
+    values, vectors = linalg.eigh(b, subset_by_index=[n_points - k, n_points - 1])
+    order = np.argsort(values)[::-1]
+    return np.maximum(values[order], 0), vectors[:, order]
+
+
+def classical_mds(dissimilarities, n_components=2):
+    """
+    Performs classical (Torgerson) Multidimensional Scaling, which is used as a starting configuration for SMACOF.
+    See Borg & Groenen (2005), Modern Multidimensional Scaling, chapter 12.
+    :param dissimilarities: a (points x points) matrix of dissimilarities
+    :return: the coordinates of the points
+    """
+    values, vectors = largest_eigenpairs(double_center(dissimilarities ** 2), n_components)
+    x = np.zeros((dissimilarities.shape[0], n_components))
+    x[:, :len(values)] = vectors * np.sqrt(values)
+    return x
+
+
+def select_landmarks(codes, n_landmarks, random_state=None):
+    """
+    Selects landmarks from the rows of a code matrix using MaxMin selection:
+    after a random first landmark, the row farthest from all landmarks selected so far is added.
+    Selection stops early when every row coincides with a landmark.
+    :param codes: the code matrix, see stats.distances.encode_labels
+    :return: the indices of the landmarks, and a (rows x landmarks) numpy array of distances
+    """
+    random_state = check_random_state(random_state)
+    n_landmarks = min(n_landmarks, codes.shape[0])
+
+    landmarks = [random_state.randint(codes.shape[0])]
+    distances = np.empty((codes.shape[0], n_landmarks), dtype=np.float64)
+    distances[:, 0] = get_distance_rows(codes, np.array(landmarks))[0]
+    nearest = distances[:, 0].copy()
+    while len(landmarks) < n_landmarks:
+        landmark = int(np.argmax(nearest))
+        if nearest[landmark] == 0:
+            break
+        distances[:, len(landmarks)] = get_distance_rows(codes, np.array([landmark]))[0]
+        nearest = np.minimum(nearest, distances[:, len(landmarks)])
+        landmarks.append(landmark)
+
+    return np.array(landmarks), distances[:, :len(landmarks)]
+
+
+def landmark_mds(codes, n_landmarks, n_components=2, weights=None, random_state=None):
+    """
+    Performs Landmark Multidimensional Scaling: the landmarks are embedded with classical scaling,
+    after which all points are triangulated from their distances to the landmarks.
+    Only the distances between the points and the landmarks are computed, so this scales linearly with the points.
+    See De Silva & Tenenbaum (2004), Sparse multidimensional scaling using landmark points.
+    :param codes: the code matrix, see stats.distances.encode_labels
+    :param weights: the multiplicity of every point (used for the stress only)
+    :return: the coordinates of the points, the (raw) stress and the sum of the squared distances,
+    both computed over the pairs of points and landmarks
+    """
+    landmarks, distances = select_landmarks(codes, n_landmarks, random_state)
+
+    # Embed the landmarks, and triangulate all points using the pseudo-inverse of the landmark configuration
+    squared = distances[landmarks] ** 2
+    values, vectors = largest_eigenpairs(double_center(squared), n_components)
+    positive = values > 0
+    pseudo_inverse = vectors[:, positive] / np.sqrt(values[positive])
+
+    x = np.zeros((codes.shape[0], n_components))
+    x[:, :positive.sum()] = -(distances ** 2 - squared.mean(axis=0)).dot(pseudo_inverse) / 2
+
+    weights = np.ones(codes.shape[0]) if weights is None else np.asarray(weights, dtype=np.float64)
+    residuals = (euclidean_distances(x, x[landmarks]) - distances) ** 2
+    stress = weights.dot(residuals).sum()
+    squares = weights.dot(distances ** 2).sum()
+    return x, stress, squares
+
+
+def smacof(dissimilarities, weights=None, n_components=2, init=None, max_iter=300, eps=1e-3, tolerance=None,
+           random_state=None):
+    """
+    Performs metric Multidimensional Scaling using the SMACOF algorithm, optionally with per-point multiplicities.
+    Minimizing the stress for a point with multiplicity m is equal to minimizing the stress for m identical points,
+    hence this produces the same solution as running SMACOF on the expanded dissimilarity matrix.
+    See Borg & Groenen (2005), Modern Multidimensional Scaling, chapter 8.
+    :param dissimilarities: a (points x points) matrix of dissimilarities
+    :param weights: the multiplicity of every point, if not given every point has multiplicity 1
+    :param init: an optional starting configuration, a random configuration is used otherwise
+    :param eps: the convergence criterion of sklearn.manifold.MDS
+    :param tolerance: if given, also stop when the relative improvement of the stress is below this value
+    The (points x points) intermediate matrices are kept in the data type of the dissimilarities, so that a single
+    precision matrix is not converted to double precision. The coordinates and the stress are in double precision.
+    :return: the coordinates of the points, the (raw) stress of the expanded problem,
+    and the stress of the configuration after every iteration
+    """
+    n_points = dissimilarities.shape[0]
+    dtype = dissimilarities.dtype
+    random_state = check_random_state(random_state)
+
+    if weights is None:
+        w = None
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+        w = np.outer(weights, weights)
+        np.fill_diagonal(w, 0)
+
+        # Moore-Penrose inverse of V, which has the vector of ones in its null space
+        v = np.diag(w.sum(axis=1)) - w
+        ones = np.ones((n_points, n_points)) / n_points
+        v_inverse = np.linalg.inv(v + ones) - ones
+
+    def get_stress(x):
+        distances = euclidean_distances(x.astype(dtype, copy=False))
+        residuals = (distances - dissimilarities) ** 2
+        return (residuals if w is None else w * residuals).sum(dtype=np.float64) / 2, distances
+
+    if init is None:
+        x = random_state.uniform(size=n_points * n_components).reshape((n_points, n_components))
+    else:
+        x = np.array(init, dtype=np.float64)
+
+    stress, distances = get_stress(x)
+    history = [stress]
+    old_stress = None
+    for _ in range(max_iter):
+        # Guttman transform. Without weights, the inverse of V reduces to a division by the number of points.
+        distances[distances == 0] = 1e-5
+        b = -dissimilarities / distances
+        if w is not None:
+            b *= w
+        b[np.arange(n_points), np.arange(n_points)] -= b.sum(axis=1)
+        bx = b.dot(x.astype(dtype, copy=False)).astype(np.float64)
+        x = bx / n_points if w is None else v_inverse.dot(bx)
+
+        previous = stress
+        stress, distances = get_stress(x)
+        history.append(stress)
+
+        if tolerance is not None and previous > 0 and (previous - stress) / previous < tolerance:
+            break
+
+        dis = np.sqrt((x ** 2).sum(axis=1)).sum()
+        if old_stress is not None and dis > 0 and (old_stress - stress / dis) < eps:
+            break
+        old_stress = stress / dis if dis > 0 else 0
+
+    return x, stress, history
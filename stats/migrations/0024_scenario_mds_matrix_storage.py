@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-17 15:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0023_alter_scenario_is_public'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenario',
+            name='mds_matrix_storage',
+            field=models.CharField(choices=[('database', 'in the database'), ('float32', 'on disk, as 32-bit floats'), ('uint8', 'on disk, quantized to bytes')], default='database', help_text='For very large scenarios, store the MDS matrix in a memory-mapped file on disk rather than in the database.', max_length=10, verbose_name='Storage of the MDS matrix'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-17 15:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0024_scenario_mds_matrix_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenario',
+            name='mds_collapse_tuples',
+            field=models.BooleanField(default=False, help_text='When enabled, Fragments with identical tuples are combined into a single weighted point before scaling, which speeds up Multidimensional Scaling considerably.', verbose_name='Collapse identical tuples'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.16 on 2026-10-17 15:33
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('stats', '0025_scenario_mds_collapse_tuples'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScenarioJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('finished', 'finished'), ('failed', 'failed')], default='queued', max_length=10)),
+                ('progress', models.PositiveIntegerField(default=0, help_text='Progress of the run in percentages')),
+                ('message', models.TextField(blank=True)),
+                ('worker', models.CharField(blank=True, max_length=200)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('scenario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='stats.scenario')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='scenariojob',
+            index=models.Index(fields=['status', 'created_at'], name='stats_scena_status_6a8141_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.16 on 2026-10-17 15:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0026_scenariojob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenariojob',
+            name='incremental',
+            field=models.BooleanField(default=False, help_text='Only process the fragments that have changed since the last run (see ScenarioChange)'),
+        ),
+        migrations.CreateModel(
+            name='ScenarioChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fragment_id', models.PositiveIntegerField()),
+                ('scenario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='stats.scenario')),
+            ],
+            options={
+                'unique_together': {('scenario', 'fragment_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.16 on 2026-10-17 15:45
+
+import django.core.validators
+from django.db import migrations, models
+import picklefield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0027_scenariochange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenario',
+            name='mds_duration',
+            field=models.FloatField(null=True, verbose_name='Duration of Multidimensional Scaling (in seconds)'),
+        ),
+        migrations.AddField(
+            model_name='scenario',
+            name='mds_init',
+            field=models.CharField(choices=[('random', 'a random configuration'), ('classical', 'classical (Torgerson) scaling'), ('previous', 'the result of the previous run')], default='random', help_text='The starting configuration of Multidimensional Scaling. Fragments that were not part of the previous run start near a Fragment with the same tuple.', max_length=10, verbose_name='Starting configuration'),
+        ),
+        migrations.AddField(
+            model_name='scenario',
+            name='mds_max_iter',
+            field=models.PositiveIntegerField(default=1000, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Maximum number of iterations'),
+        ),
+        migrations.AddField(
+            model_name='scenario',
+            name='mds_stress_history',
+            field=picklefield.fields.PickledObjectField(editable=False, null=True, verbose_name='MDS stress per iteration'),
+        ),
+        migrations.AddField(
+            model_name='scenario',
+            name='mds_tolerance',
+            field=models.FloatField(blank=True, help_text='When set, Multidimensional Scaling stops as soon as the relative improvement of the stress in an iteration drops below this value (e.g. 0.001).', null=True, validators=[django.core.validators.MinValueValidator(0)], verbose_name='Stress tolerance'),
+        ),
+    ]
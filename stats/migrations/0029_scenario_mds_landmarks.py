@@ -0,0 +1,19 @@
+# Generated by Django 3.2.16 on 2026-10-17 15:47
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0028_scenario_mds_init'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenario',
+            name='mds_landmarks',
+            field=models.PositiveIntegerField(blank=True, help_text='For scenarios with (hundreds of) thousands of fragments: when set, only the distances to this number of landmark tuples are computed, and the fragments are placed relative to the landmarks (Landmark MDS). The full MDS matrix is then not stored.', null=True, validators=[django.core.validators.MinValueValidator(10)], verbose_name='Number of landmarks'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-17 15:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0029_scenario_mds_landmarks'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='scenario',
+            name='mds_matrix_storage',
+            field=models.CharField(choices=[('database', 'in the database (deprecated)'), ('float64', 'on disk, as 64-bit floats'), ('float32', 'on disk, as 32-bit floats'), ('uint8', 'on disk, quantized to bytes')], default='float64', help_text='The MDS matrix is stored in a memory-mapped file on disk. For very large scenarios, the distances can be stored in a more compact format.', max_length=10, verbose_name='Storage of the MDS matrix'),
+        ),
+    ]
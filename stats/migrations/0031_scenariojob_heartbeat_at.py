@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-17 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0030_scenario_matrix_float64'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenariojob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, help_text='Updated regularly by the worker while the job is running', null=True),
+        ),
+    ]
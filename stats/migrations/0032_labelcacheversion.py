@@ -0,0 +1,20 @@
+# Generated by Django 3.2.16 on 2026-10-17 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0031_scenariojob_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabelCacheVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 3.2.16 on 2026-10-17 20:12
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0032_labelcacheversion'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='LabelCacheVersion',
+        ),
+    ]
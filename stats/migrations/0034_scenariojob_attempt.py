@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-17 20:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0033_delete_labelcacheversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenariojob',
+            name='attempt',
+            field=models.PositiveIntegerField(default=1, help_text='The number of times the run has been started, as a job is queued again if its worker stops'),
+        ),
+    ]
@@ -1,3 +1,7 @@
+import os
+
+import numpy as np
+
 from django.conf import settings
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
@@ -5,9 +9,32 @@ from django.db import models
 from picklefield.fields import PickledObjectField
 
 from annotations.models import Language, Tense, Corpus, Document, SubCorpus, Fragment, Label, LabelKey
+from .cube import LabelCube
+from .distances import encode_labels, get_distance_matrix, read_distance_matrix
+from .mds import collapse_codes
+from .store import ScenarioStore
 
 
 class Scenario(models.Model):
+    MATRIX_DATABASE = 'database'
+    MATRIX_FLOAT64 = 'float64'
+    MATRIX_FLOAT32 = 'float32'
+    MATRIX_UINT8 = 'uint8'
+    MATRIX_STORAGES = (
+        (MATRIX_DATABASE, 'in the database (deprecated)'),
+        (MATRIX_FLOAT64, 'on disk, as 64-bit floats'),
+        (MATRIX_FLOAT32, 'on disk, as 32-bit floats'),
+        (MATRIX_UINT8, 'on disk, quantized to bytes'),
+    )
+    INIT_RANDOM = 'random'
+    INIT_CLASSICAL = 'classical'
+    INIT_PREVIOUS = 'previous'
+    INITS = (
+        (INIT_RANDOM, 'a random configuration'),
+        (INIT_CLASSICAL, 'classical (Torgerson) scaling'),
+        (INIT_PREVIOUS, 'the result of the previous run'),
+    )
+
     title = models.CharField(max_length=200)
     description = models.TextField()
     is_test = models.BooleanField(
@@ -37,7 +64,32 @@ class Scenario(models.Model):
     mds_matrix = PickledObjectField('MDS matrix', null=True)
     mds_fragments = PickledObjectField('MDS fragments', null=True)
     mds_labels = PickledObjectField('MDS labels', null=True)
+    mds_collapse_tuples = models.BooleanField(
+        'Collapse identical tuples', default=False,
+        help_text='When enabled, Fragments with identical tuples are combined into a single weighted point '
+                  'before scaling, which speeds up Multidimensional Scaling considerably.')
+    mds_matrix_storage = models.CharField(
+        'Storage of the MDS matrix', max_length=10, choices=MATRIX_STORAGES, default=MATRIX_FLOAT64,
+        help_text='The MDS matrix is stored in a memory-mapped file on disk. '
+                  'For very large scenarios, the distances can be stored in a more compact format.')
+    mds_landmarks = models.PositiveIntegerField(
+        'Number of landmarks', blank=True, null=True, validators=[MinValueValidator(10)],
+        help_text='For scenarios with (hundreds of) thousands of fragments: when set, only the distances to this '
+                  'number of landmark tuples are computed, and the fragments are placed relative to the landmarks '
+                  '(Landmark MDS). The full MDS matrix is then not stored.')
+    mds_init = models.CharField(
+        'Starting configuration', max_length=10, choices=INITS, default=INIT_RANDOM,
+        help_text='The starting configuration of Multidimensional Scaling. '
+                  'Fragments that were not part of the previous run start near a Fragment with the same tuple.')
+    mds_max_iter = models.PositiveIntegerField(
+        'Maximum number of iterations', default=1000, validators=[MinValueValidator(1)])
+    mds_tolerance = models.FloatField(
+        'Stress tolerance', blank=True, null=True, validators=[MinValueValidator(0)],
+        help_text='When set, Multidimensional Scaling stops as soon as the relative improvement of the stress '
+                  'in an iteration drops below this value (e.g. 0.001).')
     mds_stress = models.FloatField('MDS stress', null=True)
+    mds_stress_history = PickledObjectField('MDS stress per iteration', null=True)
+    mds_duration = models.FloatField('Duration of Multidimensional Scaling (in seconds)', null=True)
     mds_allow_partial = models.BooleanField(
         'Allow partial tuples in model', default=False,
         help_text='When enabled, the model will include tuples '
@@ -59,17 +111,116 @@ class Scenario(models.Model):
         languages = self.languages_to if hasattr(self, 'languages_to') else self.languages(as_to=True)
         return ', '.join([sl.language.title for sl in languages])
 
+    def active_job(self):
+        """
+        Retrieves the queued or running ScenarioJob for this Scenario, if any.
+        """
+        if hasattr(self, 'active_jobs'):
+            return self.active_jobs[0] if self.active_jobs else None
+        return self.jobs.filter(status__in=[ScenarioJob.QUEUED, ScenarioJob.RUNNING]).first()
+
     def languages(self, **kwargs):
         return self.scenariolanguage_set.filter(**kwargs).select_related('language')
 
     def __str__(self):
         return self.title
 
+    def matrix_on_disk(self):
+        return self.mds_matrix_storage != Scenario.MATRIX_DATABASE
+
+    def matrix_filename(self):
+        return os.path.join(settings.SCENARIO_DATA_PATH, 's{}-matrix.{}'.format(self.pk, self.mds_matrix_storage))
+
+    def results(self):
+        """
+        :return: the ScenarioStore with the results. The store is kept on the instance, so that all results that are
+        read through this Scenario belong to the same run.
+        """
+        store = getattr(self, '_results', None)
+        if store is None or store.scenario_pk != self.pk:
+            store = self._results = ScenarioStore(self)
+        return store
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        # The results may have been rewritten as well
+        self._results = None
+
+    def get_fragments(self):
+        """
+        Retrieves the pks of the Fragments in the MDS model, from the ScenarioStore or (for Scenarios that have not
+        been converted, see the convert_scenario_results management command) from the database.
+        :return: the list of Fragment pks, or None if the Scenario has not been run
+        """
+        if self.results().exists():
+            return self.results().read_fragments().tolist()
+        return self.mds_fragments
+
+    def get_model(self):
+        """
+        Retrieves the MDS model, either as a read-only memory-mapped array or (for Scenarios that have not
+        been converted) from the database.
+        :return: the (fragments x dimensions) coordinates as a numpy array, or None if the Scenario has not been run
+        """
+        if self.results().exists():
+            return self.results().read_model()
+        return None if self.mds_model is None else np.asarray(self.mds_model)
+
+    def get_matrix(self):
+        """
+        Retrieves the MDS matrix, either from the database or as a read-only memory-mapped file.
+        Matrices stored on disk can be quantized, use stats.distances.iter_matrix_rows to read them as distances.
+        :return: the MDS matrix as a numpy array, or None if the Scenario has not been run (or was run with landmarks
+        or on collapsed tuples, see get_collapsed_matrix)
+        """
+        if self.mds_landmarks:
+            return None
+
+        if not self.matrix_on_disk():
+            return None if self.mds_matrix is None else np.asarray(self.mds_matrix)
+
+        if not os.path.exists(self.matrix_filename()):
+            return None
+        fragment_pks = self.results().read_fragments() if self.results().exists() else self.mds_fragments
+        return read_distance_matrix(self.matrix_filename(), self.mds_matrix_storage, len(fragment_pks))
+
+    def get_collapsed_matrix(self):
+        """
+        Retrieves the distance matrix between the unique label tuples of a Scenario that was run on collapsed tuples
+        (see stats.utils.scale_collapsed). Only this matrix is computed (from the labels), the full matrix is not.
+        :return: the (tuples x tuples) matrix and the row of every Fragment in it, or None if the Scenario has not been
+        run on collapsed tuples
+        """
+        if not self.mds_collapse_tuples or self.mds_landmarks or not self.last_run:
+            return None
+        unique_codes, inverse, _ = collapse_codes(encode_labels(self.get_labels()))
+        return get_distance_matrix(unique_codes), inverse
+
+    def get_label_cube(self):
+        """
+        Retrieves the labels of the Fragments in the MDS model as a LabelCube, from the ScenarioStore or (for Scenarios
+        that have not been converted) encoded from the labels in the database.
+        :return: the LabelCube, or None if the Scenario has not been run
+        """
+        if self.results().exists():
+            cube = self.results().read_cube()
+            # Older Scenarios identify Tenses by their pk, see get_labels
+            for language, values in cube.vocabulary.items():
+                cube.vocabulary[language] = [('Tense:{}'.format(v),) if isinstance(v, int) else v for v in values]
+            return cube
+        if self.mds_fragments is None:
+            return None
+        return LabelCube.from_labels(self.mds_fragments, self.get_labels())
+
+    def mds_iterations(self):
+        return len(self.mds_stress_history) - 1 if self.mds_stress_history else None
+
     def get_labels(self):
         # format mds_labels in a way that works with the recent changes.
         # this prevents us from having to rerun all existing scenarios.
+        mds_labels = self.results().read_labels() if self.results().exists() else self.mds_labels
         result = dict()
-        for language, values in self.mds_labels.items():
+        for language, values in mds_labels.items():
             if isinstance(values[0], int):
                 result[language] = [('Tense:{}'.format(v),) for v in values]
             if isinstance(values[0], str):
@@ -115,3 +266,67 @@ class ScenarioLanguage(models.Model):
 
     def __str__(self):
         return 'Details for language {} in scenario {}'.format(self.language.title, self.scenario.title)
+
+
+class ScenarioJob(models.Model):
+    """
+    Stores a queued (re)run of a Scenario. Jobs are processed by the run_scenario_jobs management command.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    STATUSES = (
+        (QUEUED, 'queued'),
+        (RUNNING, 'running'),
+        (FINISHED, 'finished'),
+        (FAILED, 'failed'),
+    )
+
+    scenario = models.ForeignKey(Scenario, related_name='jobs', on_delete=models.CASCADE)
+    incremental = models.BooleanField(
+        default=False,
+        help_text='Only process the fragments that have changed since the last run (see ScenarioChange)')
+
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    attempt = models.PositiveIntegerField(
+        default=1,
+        help_text='The number of times the run has been started, as a job is queued again if its worker stops')
+    progress = models.PositiveIntegerField(default=0, help_text='Progress of the run in percentages')
+    message = models.TextField(blank=True)
+    worker = models.CharField(max_length=200, blank=True)
+
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True,
+                                        help_text='Updated regularly by the worker while the job is running')
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def is_active(self):
+        return self.status in [ScenarioJob.QUEUED, ScenarioJob.RUNNING]
+
+    def __str__(self):
+        return 'Run of scenario {} ({})'.format(self.scenario.title, self.get_status_display())
+
+
+class ScenarioChange(models.Model):
+    """
+    Stores a Fragment that has (possibly) changed since the last run of a Scenario.
+    Changes are recorded by the signal handlers in stats.signals, and processed by stats.utils.update_mds.
+    The Fragment is not stored as a foreign key, as the change might be the deletion of the Fragment.
+    """
+    scenario = models.ForeignKey(Scenario, related_name='changes', on_delete=models.CASCADE)
+    fragment_id = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('scenario', 'fragment_id', )
+
+    def __str__(self):
+        return 'Change of fragment {} in scenario {}'.format(self.fragment_id, self.scenario.title)
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+import random
+from collections import defaultdict
+from itertools import chain, repeat, count
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, When
+
+from annotations.models import Fragment
+from core.utils import HTML
+from .grid import MultiResolutionGrid
+from .utils import get_label_properties_from_cache, prepare_label_cache, label_cache_version
+
+
+# Number of seconds a plot payload is cached (see plot_payload)
+PLOT_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+# Points with the same labels that are closer to each other than this distance are merged (see reduce_model)
+CLUSTER_DISTANCE = 0.1
+
+# The names of the types of the arrays in a binary payload (see encode_plot_data), these match JavaScript typed arrays
+ARRAY_TYPES = {'<f4': 'Float32', '<u4': 'Uint32', '<u2': 'Uint16', '|u1': 'Uint8'}
+
+
+def plot_payload(scenario, language, d1, d2, clustering, with_text=True):
+    """
+    Retrieves the payload of the matrix plot of a Scenario, or computes (and caches) it on a miss.
+    Payloads are keyed on the last run of the Scenario and on the version of the label cache,
+    so that they are recomputed once the Scenario has been rerun or its labels have changed.
+    :param language: the iso of the display language
+    :param d1: the (1-based) dimension on the x-axis
+    :param d2: the (1-based) dimension on the y-axis, or 0 to only show the x-axis
+    :param clustering: whether to merge points with the same labels that are close to each other
+    :param with_text: whether to include the rendered text of the Fragments.
+    If not, only the pks are included, and the texts can be retrieved on demand (see render_fragments).
+    :return: a dictionary with the JSON-encoded flat_data, series_list and clusters, and the languages and number of
+    dimensions of the model
+    """
+    key = plot_cache_key(scenario, language, d1, d2, clustering, 'text' if with_text else 'pks')
+    payload = cache.get(key)
+    if payload is None:
+        plot = build_plot_data(scenario, PlotData(scenario, with_text), language, d1, d2, clustering)
+        payload = dict(plot, **{name: json.dumps(plot[name]) for name in ['flat_data', 'series_list', 'clusters']})
+        cache.set(key, payload, PLOT_CACHE_TIMEOUT)
+    return payload
+
+
+def plot_binary(scenario, language, d1, d2, clustering):
+    """
+    Retrieves the binary payload of the matrix plot of a Scenario (see encode_plot_data), or computes (and caches) it
+    on a miss. The texts of the Fragments are not included. See plot_payload for the parameters.
+    :return: the payload as bytes
+    """
+    key = plot_cache_key(scenario, language, d1, d2, clustering, 'binary')
+    payload = cache.get(key)
+    if payload is None:
+        payload = encode_plot_data(build_plot_data(scenario, PlotData(scenario, False), language, d1, d2, clustering))
+        cache.set(key, payload, PLOT_CACHE_TIMEOUT)
+    return payload
+
+
+def precompute_plots(scenario):
+    """
+    Computes and caches the binary payloads of the matrix plot for all display languages and dimension pairs of a
+    Scenario, with the default clustering (as used by MDSView), and the grids for all dimension pairs.
+    This is only done if SCENARIO_PRECOMPUTE_PLOTS is set, and only benefits the web processes if the cache is shared
+    between processes.
+    """
+    if not settings.SCENARIO_PRECOMPUTE_PLOTS:
+        return
+
+    data = PlotData(scenario, with_text=False)
+    dimensions = range(1, scenario.mds_dimensions + 1)
+    for d1 in dimensions:
+        for d2 in chain([0], dimensions):
+            for language in data.tenses.keys():
+                payload = encode_plot_data(build_plot_data(scenario, data, language, d1, d2, True))
+                cache.set(plot_cache_key(scenario, language, d1, d2, True, 'binary'), payload, PLOT_CACHE_TIMEOUT)
+            grid = build_plot_grid(scenario, d1, d2)
+            cache.set(plot_cache_key(scenario, None, d1, d2, False, 'grid'), grid, PLOT_CACHE_TIMEOUT)
+
+
+def plot_grid(scenario, d1, d2):
+    """
+    Retrieves the MultiResolutionGrid over the points of a Scenario for a pair of dimensions, or builds (and caches)
+    it on a miss. The points are grouped on their label tuple.
+    :return: a dictionary with the grid, the pks of the Fragments, and the label tuple of every group
+    """
+    key = plot_cache_key(scenario, None, d1, d2, False, 'grid')
+    grid = cache.get(key)
+    if grid is None:
+        grid = build_plot_grid(scenario, d1, d2)
+        cache.set(key, grid, PLOT_CACHE_TIMEOUT)
+    return grid
+
+
+def build_plot_grid(scenario, d1, d2):
+    model = scenario.get_model()
+    x = model[:, d1 - 1]
+    y = model[:, d2 - 1] if d2 > 0 else np.zeros(len(model))
+
+    tenses = scenario.get_labels()
+    languages = list(tenses.keys())
+    label_tuples = list(zip(*[tenses[language] for language in languages]))
+    tuple_codes = dict()
+    groups = np.array([tuple_codes.setdefault(label_tuple, len(tuple_codes)) for label_tuple in label_tuples])
+
+    return {
+        'grid': MultiResolutionGrid(x, y, groups),
+        'fragment_pks': np.asarray(scenario.get_fragments(), dtype=np.int64),
+        'languages': languages,
+        'tuples': list(tuple_codes),
+    }
+
+
+def level_of_detail_payload(scenario, display_language, d1, d2, window, budget):
+    """
+    Downsamples the matrix plot of a Scenario to a budget of points in a window (see MultiResolutionGrid.query).
+    Dense regions are returned as cells, with their number of points and most frequent label tuple.
+    :param window: the window to show, as a tuple of (x0, x1, y0, y1), or None to show all points
+    :param budget: the maximum number of cells and points
+    :return: a dictionary with the level of the grid, the cells and the points
+    """
+    plot = plot_grid(scenario, d1, d2)
+    grid = plot['grid']
+    if window is None:
+        window = (grid.x.min(), grid.x.max(), grid.y.min(), grid.y.max())
+    level, cells, points = grid.query(*window, budget)
+
+    label_cache = prepare_label_cache(scenario.corpus)
+    series = dict()
+
+    def describe(group):
+        # Retrieve the key and color of the display language, and the labels of all languages
+        if group not in series:
+            labels = dict(zip(plot['languages'], plot['tuples'][group]))
+            label_list = []
+            for t in labels.values():
+                label, _, _ = get_label_properties_from_cache(t, label_cache, len(series))
+                label_list.append(label.replace('<', '&lt;').replace('>', '&gt;'))
+            key, color, _ = get_label_properties_from_cache(labels[display_language], label_cache, len(series))
+            series[group] = {'key': key, 'color': color, 'tenses': label_list}
+        return series[group]
+
+    result_cells = []
+    if level is not None:
+        grid_level = grid.levels[level]
+        for cell in cells.tolist():
+            result_cells.append(dict(describe(int(grid_level.dominant[cell])), x=float(grid_level.x[cell]),
+                                     y=float(grid_level.y[cell]), count=int(grid_level.counts[cell])))
+
+    result_points = []
+    for point in points.tolist():
+        result_points.append(dict(describe(int(grid.groups[point])), x=float(grid.x[point]), y=float(grid.y[point]),
+                                  fragment_pk=int(plot['fragment_pks'][point])))
+
+    return {'level': level, 'cells': result_cells, 'points': result_points}
+
+
+def plot_cache_key(scenario, language, d1, d2, clustering, payload_format):
+    """
+    :param payload_format: 'text' or 'pks' (see plot_payload), 'binary' (see plot_binary) or 'grid' (see plot_grid)
+    """
+    last_run = scenario.last_run.timestamp() if scenario.last_run else None
+    return ':'.join(str(part) for part in ['stats', 'plot', scenario.pk, last_run, label_cache_version(),
+                                           language, d1, d2, 'on' if clustering else 'off', payload_format])
+
+
+class PlotData:
+    """
+    The results of a Scenario, and the (optionally rendered) Fragments, as used by build_plot_payload.
+    These are retrieved once, and can be reused for multiple payloads (see precompute_plots).
+    """
+
+    def __init__(self, scenario, with_text=True):
+        self.model = scenario.get_model().tolist()
+        self.tenses = scenario.get_labels()
+        self.label_cache = prepare_label_cache(scenario.corpus)
+
+        fragment_pks = scenario.get_fragments()
+
+        # Solution to preserve order taken from https://stackoverflow.com/a/37648265
+        preserved = Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(fragment_pks)])
+        fragments = Fragment.objects.filter(pk__in=fragment_pks).order_by(preserved)
+        if with_text:
+            fragments = fragments.prefetch_related('sentence_set', 'sentence_set__word_set')
+            self.fragments = [(fragment.pk, fragment.full(HTML)) for fragment in fragments]
+        else:
+            # Only check which Fragments still exist
+            self.fragments = [(pk, None) for pk in fragments.values_list('pk', flat=True)]
+
+
+def build_plot_data(scenario, data, display_language, d1, d2, clustering):
+    """
+    Turns the model of a Scenario into the data of the matrix plot, see plot_payload.
+    """
+    model = data.model
+    tenses = data.tenses
+    label_cache = dict(data.label_cache)
+
+    points = defaultdict(list)
+    clusters = []
+    label_set = set()
+    complete = True
+
+    if clustering:
+        reduced = reduce_model(model, tenses)
+    else:
+        # Keep original data points as-is
+        # (which is the same as having all clusters as size 1)
+        reduced = zip(count(), model, repeat(1))
+        random.seed(scenario.pk)  # Fixed seed for random jitter
+
+    for n, embedding, cluster_size in reduced:
+        # Retrieve x/y dimensions, add some jitter
+        x = embedding[d1 - 1]
+        y = 0
+        if not clustering:
+            x += random.uniform(-.5, .5) / 100
+            y += random.uniform(-.5, .5) / 100
+        if d2 > 0:  # Only add y if it's been requested
+            y += embedding[d2 - 1]
+
+        cluster_id = len(clusters)
+        clusters.append(dict(x=x, y=y, count=cluster_size))
+
+        try:
+            fragment_pk, fragment_html = data.fragments[n]
+
+            # Retrieve the labels of all languages in this context
+            ts = [tenses[language][n] for language in list(tenses.keys())]
+            # flatten
+            label_list = []
+            for t in ts:
+                label, _, _ = get_label_properties_from_cache(t, label_cache, len(label_set))
+                label_list.append(label.replace('<', '&lt;').replace('>', '&gt;'))
+                label_set.add(label)
+
+            # Add all values to the dictionary
+            point = {'cluster': cluster_id, 'x': x, 'y': y, 'tenses': label_list, 'fragment_pk': fragment_pk}
+            if fragment_html is not None:
+                point['fragment'] = fragment_html
+            points[tenses[display_language][n]].append(point)
+
+        except IndexError:
+            # Some of the Fragments in this Scenario have been deleted
+            complete = False
+            break
+
+    # flat data representation for d3
+    flat_data, series_list = prepare_flat_data(points, label_cache)
+
+    return {
+        'flat_data': flat_data,
+        'series_list': series_list,
+        'clusters': clusters,
+        'languages': list(tenses.keys()),
+        'dimensions': len(model[0]),
+        'complete': complete,
+    }
+
+
+def encode_plot_data(plot):
+    """
+    Encodes the data of the matrix plot into a compact binary format, consisting of:
+    - the length of the header, as a little-endian unsigned 32-bit integer
+    - the header: a JSON object with the series, the distinct label lists, the languages, the number of dimensions,
+    whether the model is complete, and the name, type and length of the arrays that follow
+    - the arrays, as little-endian typed arrays, every array aligned to 8 bytes:
+    the x, y, fragment pk, cluster, series and label list of every point, and the x, y and size of every cluster
+    :param plot: the data of the matrix plot, see build_plot_data
+    :return: the payload as bytes
+    """
+    flat_data = plot['flat_data']
+    series = {item['key']: n for n, item in enumerate(plot['series_list'])}
+    label_lists = dict()
+    for point in flat_data:
+        label_lists.setdefault(tuple(point['tenses']), len(label_lists))
+
+    arrays = [
+        ('x', np.array([point['x'] for point in flat_data], dtype='<f4')),
+        ('y', np.array([point['y'] for point in flat_data], dtype='<f4')),
+        ('fragment_pk', np.array([point['fragment_pk'] for point in flat_data], dtype='<u4')),
+        ('cluster', np.array([point['cluster'] for point in flat_data], dtype='<u4')),
+        ('series', np.array([series[point['key']] for point in flat_data], dtype=index_type(len(series)))),
+        ('tenses', np.array([label_lists[tuple(point['tenses'])] for point in flat_data],
+                            dtype=index_type(len(label_lists)))),
+        ('cluster_x', np.array([cluster['x'] for cluster in plot['clusters']], dtype='<f4')),
+        ('cluster_y', np.array([cluster['y'] for cluster in plot['clusters']], dtype='<f4')),
+        ('cluster_count', np.array([cluster['count'] for cluster in plot['clusters']], dtype='<u4')),
+    ]
+
+    header = json.dumps({
+        'series': plot['series_list'],
+        'labels': list(label_lists),
+        'languages': plot['languages'],
+        'dimensions': plot['dimensions'],
+        'complete': plot['complete'],
+        'arrays': [(name, ARRAY_TYPES[array.dtype.str], len(array)) for name, array in arrays],
+    }).encode('utf-8')
+
+    chunks = [np.array([len(header)], dtype='<u4').tobytes(), header]
+    size = 4 + len(header)
+    for _, array in arrays:
+        chunks.append(bytes(-size % 8))
+        chunks.append(array.tobytes())
+        size += -size % 8 + array.nbytes
+    return b''.join(chunks)
+
+
+def index_type(n):
+    """
+    :return: the smallest unsigned integer type to store indices into a list of length n
+    """
+    if n <= 2 ** 8:
+        return '|u1'
+    if n <= 2 ** 16:
+        return '<u2'
+    return '<u4'
+
+
+def render_fragments(fragment_pks):
+    """
+    Renders the text of a batch of Fragments, for the payloads without texts (see plot_payload).
+    :return: a dictionary with the rendered text per Fragment pk
+    """
+    fragments = Fragment.objects \
+        .filter(pk__in=fragment_pks) \
+        .prefetch_related('sentence_set', 'sentence_set__word_set')
+    return {fragment.pk: fragment.full(HTML) for fragment in fragments}
+
+
+def reduce_model(model, tenses):
+    """
+    Merges points which overlap exactly, and points with the same labels which are very close to each other.
+    Close points are looked up in a KD-tree per label tuple, rather than by comparing all pairs of points.
+    :return: a list of (index, coordinates, cluster size) tuples, one for every remaining point
+    """
+    cluster_count = defaultdict(int)
+    collect = dict()
+    # First, reduce points which overlap exactly
+    for n, embedding in enumerate(model):
+        t = tuple(embedding)
+        collect[t] = (n, t)
+        cluster_count[t] += 1
+
+    # Group the points by their label tuple, as only points with the same labels are merged
+    languages = list(tenses.keys())
+    groups = defaultdict(list)
+    for coord, point in collect.items():
+        groups[tuple(tenses[language][point[0]] for language in languages)].append(coord)
+
+    # Reduce points which are very close
+    skip = set()
+    for coords in groups.values():
+        if len(coords) == 1:
+            continue
+
+        # The candidates are found with a slightly larger radius, is_close decides on the exact boundary
+        tree = cKDTree(coords)
+        candidates = tree.query_ball_point(coords, CLUSTER_DISTANCE * 1.01)
+        for coord, others in zip(coords, candidates):
+            if coord in skip:
+                continue
+            for other in sorted(others):
+                other_coord = coords[other]
+                if is_close(coord, other_coord):
+                    skip.add(other_coord)
+                    # merge clusters
+                    cluster_count[coord] += cluster_count[other_coord]
+
+    return [(n, embedding, cluster_count[embedding]) for n, embedding in collect.values() if embedding not in skip]
+
+
+def is_close(origin, other):
+    """
+    :return: whether two (distinct) points are within CLUSTER_DISTANCE of each other
+    """
+    d = 0
+    for a, b in zip(origin, other):
+        d += (a - b) ** 2
+    d = math.sqrt(d)
+    return CLUSTER_DISTANCE > d > 0
+
+
+def prepare_flat_data(points, label_cache):
+    # Transpose the dictionary to the correct format for nvd3.
+    # TODO: can this be done in the loop above?
+    matrix = []
+    labels = set()
+    for identifier, values in list(points.items()):
+        label, color, _ = get_label_properties_from_cache(identifier, label_cache, len(labels))
+        labels.add(label)
+
+        d = dict()
+        d['key'] = label
+        d['color'] = color
+        d['values'] = values
+        matrix.append(d)
+
+    # flat data representation for d3
+    flat_data = []
+    series_list = []
+    for series in matrix:
+        series_list.append(
+            {'key': series['key'], 'color': series['color']}
+        )
+        for fragment in series['values']:
+            s = {'key': series['key'], 'color': series['color']}
+            flat_data.append(
+                dict(chain(
+                    iter(s.items()),
+                    iter(fragment.items())
+                ))
+            )
+    return flat_data, series_list
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import json
+
+import numpy as np
+
+from django.core.cache import cache
+
+from annotations.models import Annotation, Fragment
+from .utils import get_label_properties_from_cache, prepare_label_cache, label_cache_version
+
+
+# Number of seconds the flows of a Sankey diagram are cached (see sankey_payload)
+SANKEY_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+
+def sankey_payload(scenario, language_from, language_to, lfrom_option=None, lto_option=None):
+    """
+    Retrieves the nodes and links of the Sankey diagram of a Scenario, or computes (and caches) them on a miss.
+    The diagrams are keyed on the last run of the Scenario and on the version of the label cache.
+    :param language_from: the iso of the source language
+    :param language_to: the iso of the target language
+    :param lfrom_option: an optional attribute of the Fragments to add as a column after the source language
+    :param lto_option: an optional attribute of the Annotations to add as a column after the target language
+    :return: the JSON-encoded nodes and links
+    """
+    last_run = scenario.last_run.timestamp() if scenario.last_run else None
+    key = ':'.join(str(part) for part in ['stats', 'sankey', scenario.pk, last_run, label_cache_version(),
+                                          language_from, language_to, lfrom_option, lto_option])
+    payload = cache.get(key)
+    if payload is None:
+        payload = json.dumps(build_sankey(scenario, language_from, language_to, lfrom_option, lto_option))
+        cache.set(key, payload, SANKEY_CACHE_TIMEOUT)
+    return payload
+
+
+class Column:
+    """
+    A column of the Sankey diagram: a value per Fragment, integer-encoded into codes and a list of distinct values.
+    """
+
+    def __init__(self, language, values):
+        self.language = language
+        code_table = dict()
+        self.codes = np.array([code_table.setdefault(value, len(code_table)) for value in values], dtype=np.int64)
+        self.values = list(code_table)
+
+    @classmethod
+    def from_cube(cls, cube, language):
+        """
+        Creates a column from the (simplified) labels of a language in a LabelCube, by mapping its label codes.
+        The values remain in order of first occurrence, as the vocabulary of the cube is.
+        """
+        column = cls(language, [])
+        code_table = dict()
+        mapping = np.array([code_table.setdefault(simplify(value), len(code_table))
+                            for value in cube.vocabulary[language]], dtype=np.int64)
+        column.codes = mapping[cube.column(language)]
+        column.values = list(code_table)
+        return column
+
+
+def simplify(value):
+    """
+    Simplifies a label (from a tuple to a single value).
+    """
+    result = value[0] if isinstance(value, tuple) and value else value
+    if not result:
+        result = '-'
+    return result
+
+
+def build_sankey(scenario, language_from, language_to, lfrom_option, lto_option):
+    """
+    Computes the nodes and links of the Sankey diagram of a Scenario, see sankey_payload.
+    Every link runs from a value in a column to a value in the next column, and is split by the value of the source
+    language (the origin). The values are integer-encoded per column, so that the links are counted on arrays.
+    :return: a dictionary with the nodes and the links
+    """
+    cube = scenario.get_label_cube()
+    fragment_pks = cube.fragment_pks
+
+    columns = [Column.from_cube(cube, language_from)]
+    if lfrom_option:
+        columns.append(Column('-', option_values(fragment_pks.tolist(), lfrom_option)))
+    columns.append(Column.from_cube(cube, language_to))
+    if lto_option:
+        columns.append(Column('-', annotation_values(fragment_pks.tolist(), language_to, lto_option)))
+
+    # Retrieve the nodes: first the labels of the languages, then the values of the options
+    nodes = dict()
+    for language in cube.languages:
+        for column in columns:
+            if column.language == language:
+                nodes.setdefault(language, dict()).update(dict.fromkeys(column.values))
+    for column in columns:
+        if column.language == '-':
+            nodes.setdefault('-', dict()).update(dict.fromkeys(column.values))
+
+    # Count the links per pair of consecutive columns, and collect the Fragments per link
+    origin = columns[0]
+    links = dict()
+    for source, target in zip(columns, columns[1:]):
+        triples = (origin.codes * len(source.values) + source.codes) * len(target.values) + target.codes
+        unique, first, inverse = np.unique(triples, return_index=True, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(unique) + 1))
+
+        # Keep the links in order of their first occurrence
+        for u in np.argsort(first, kind='stable').tolist():
+            o, rest = divmod(int(unique[u]), len(source.values) * len(target.values))
+            s, t = divmod(rest, len(target.values))
+            link = (origin.values[o], source.values[s], target.values[t])
+            links.setdefault(link, []).extend(fragment_pks[order[bounds[u]:bounds[u + 1]]].tolist())
+
+    # Convert the nodes into a dictionary, and create a lookup of (language, node) -> id
+    label_cache = prepare_label_cache(scenario.corpus)
+    new_nodes = []
+    node_ids = dict()
+    for language, nodes_per_language in nodes.items():
+        for node in nodes_per_language:
+            node_label, node_color, _ = get_label_properties_from_cache(node, label_cache, allow_empty=True)
+            node_ids[(language, node)] = len(new_nodes)
+            new_nodes.append({'id': len(new_nodes), 'language': language, 'node': node, 'color': node_color,
+                              'label': node_label})
+
+    def find_node(language, node):
+        # The values of the options are not bound to a language
+        return node_ids.get((language, node), node_ids.get(('-', node)))
+
+    # Convert the links into a dictionary
+    new_links = []
+    for (l0, l1, l2), link_pks in links.items():
+        l0_label, l0_color, _ = get_label_properties_from_cache(l0, label_cache)
+        new_links.append({
+            'origin': find_node(language_from, l0),
+            'origin_label': l0_label, 'origin_color': l0_color,
+            'source': find_node(language_from, l1),
+            'target': find_node(language_to, l2),
+            'value': len(link_pks), 'fragment_pks': link_pks
+        })
+    new_links = sorted(new_links, key=lambda l: l['origin_color'])
+
+    return {'nodes': new_nodes, 'links': new_links}
+
+
+def option_values(fragment_pks, option):
+    """
+    :return: the value of an attribute (or display method) of the given Fragments, in order of the pks.
+    Fragments that have been deleted since the last run of the Scenario have the value 'none'.
+    """
+    fragments = {fragment.pk: fragment for fragment in Fragment.objects.filter(pk__in=fragment_pks)}
+    return [(getattr(fragments[pk], option)() if option.endswith('display') else getattr(fragments[pk], option))
+            if pk in fragments else 'none' for pk in fragment_pks]
+
+
+def annotation_values(fragment_pks, language_to, option):
+    """
+    :return: the value of an attribute of the Annotations of the given Fragments in the target language
+    """
+    annotations = Annotation.objects \
+        .filter(alignment__original_fragment__pk__in=fragment_pks,
+                alignment__translated_fragment__language__iso=language_to) \
+        .select_related('alignment__original_fragment')
+    annotations = {a.alignment.original_fragment.pk: a for a in annotations}
+    return [getattr(annotations[pk], option) if pk in annotations else 'none' for pk in fragment_pks]
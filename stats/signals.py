@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import os
+
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from annotations.models import Fragment, Annotation, Alignment, Tense, TenseCategory, Label, LabelKey
+from .models import Scenario, ScenarioChange
+from .utils import invalidate_label_cache
+
+
+def record_changes(fragment_pks):
+    """
+    Records the given (original) Fragments as changed for every Scenario of their Corpus that has been run.
+    """
+    fragment_pks = set(fragment_pks)
+    if not fragment_pks:
+        return
+
+    scenarios = Scenario.objects \
+        .filter(corpus__documents__fragment__in=fragment_pks, last_run__isnull=False) \
+        .values_list('pk', 'corpus__documents__fragment')
+    ScenarioChange.objects.bulk_create([ScenarioChange(scenario_id=scenario_pk, fragment_id=fragment_pk)
+                                        for scenario_pk, fragment_pk in scenarios.distinct()],
+                                       ignore_conflicts=True)
+
+
+def original_fragments(annotation_pks):
+    return Alignment.objects \
+        .filter(annotation__in=annotation_pks) \
+        .values_list('original_fragment', flat=True)
+
+
+@receiver(post_save, sender=Fragment)
+@receiver(pre_delete, sender=Fragment)
+def fragment_changed(sender, instance, **kwargs):
+    record_changes([instance.pk])
+
+
+@receiver(post_save, sender=Annotation)
+@receiver(pre_delete, sender=Annotation)
+def annotation_changed(sender, instance, **kwargs):
+    record_changes(original_fragments([instance.pk]))
+
+
+@receiver(m2m_changed, sender=Fragment.labels.through)
+def fragment_labels_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ['post_add', 'post_remove', 'pre_clear']:
+        return
+
+    if not reverse:
+        record_changes([instance.pk])
+    elif action == 'pre_clear':
+        record_changes(instance.fragment_set.values_list('pk', flat=True))
+    else:
+        record_changes(pk_set)
+
+
+@receiver(m2m_changed, sender=Annotation.labels.through)
+def annotation_labels_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ['post_add', 'post_remove', 'pre_clear']:
+        return
+
+    if not reverse:
+        record_changes(original_fragments([instance.pk]))
+    elif action == 'pre_clear':
+        record_changes(original_fragments(instance.annotation_set.values('pk')))
+    else:
+        record_changes(original_fragments(pk_set))
+
+
+@receiver(post_delete, sender=Scenario)
+def scenario_deleted(sender, instance, **kwargs):
+    instance.results().delete()
+    if instance.matrix_on_disk() and os.path.exists(instance.matrix_filename()):
+        os.remove(instance.matrix_filename())
+
+
+@receiver(post_save, sender=Tense)
+@receiver(post_delete, sender=Tense)
+@receiver(post_save, sender=TenseCategory)
+@receiver(post_delete, sender=TenseCategory)
+@receiver(post_save, sender=Label)
+@receiver(post_delete, sender=Label)
+@receiver(post_save, sender=LabelKey)
+@receiver(post_delete, sender=LabelKey)
+@receiver(m2m_changed, sender=LabelKey.corpora.through)
+def label_properties_changed(sender, **kwargs):
+    # Fixtures are loaded during migrations, when the label cache is not in use yet
+    if kwargs.get('raw'):
+        return
+    invalidate_label_cache()
@@ -1,6 +1,49 @@
 /*global d3, _*/
 /* eslint-disable camelcase */
 
+function load_plot_data(url, callback) {
+    // Retrieves the data of the plot in the binary format of stats.plots.encode_plot_data,
+    // and converts it to the flat_data, series_list and clusters expected by MDSView
+    var request = new XMLHttpRequest();
+    request.open("GET", url);
+    request.responseType = "arraybuffer";
+    request.onload = function () {
+        var buffer = request.response;
+        var header_length = new DataView(buffer).getUint32(0, true);
+        var header = JSON.parse(new TextDecoder("utf-8").decode(new Uint8Array(buffer, 4, header_length)));
+
+        // The arrays are little-endian, which matches the byte order of (nearly) all browsers
+        var arrays = {};
+        var offset = 4 + header_length;
+        header.arrays.forEach(function (array) {
+            var name = array[0], type = window[array[1] + "Array"], length = array[2];
+            offset += (8 - offset % 8) % 8;
+            arrays[name] = new type(buffer, offset, length);
+            offset += length * type.BYTES_PER_ELEMENT;
+        });
+
+        var flat_data = [];
+        for (var i = 0; i < arrays.x.length; i++) {
+            var series = header.series[arrays.series[i]];
+            flat_data.push({
+                key: series.key,
+                color: series.color,
+                cluster: arrays.cluster[i],
+                x: arrays.x[i],
+                y: arrays.y[i],
+                tenses: header.labels[arrays.tenses[i]],
+                fragment_pk: arrays.fragment_pk[i]
+            });
+        }
+        var clusters = [];
+        for (var j = 0; j < arrays.cluster_x.length; j++) {
+            clusters.push({x: arrays.cluster_x[j], y: arrays.cluster_y[j], count: arrays.cluster_count[j]});
+        }
+        callback(flat_data, header.series, clusters, header.complete);
+    };
+    request.send();
+}
+
 function MDSView(flat_data, series_list, clusters, options) {
     var containerWidth = d3.select(".container").node().getBoundingClientRect().width,
         margin = { top: 20, right: 20, bottom: 30, left: 40 },
@@ -49,6 +92,15 @@ function MDSView(flat_data, series_list, clusters, options) {
             .tickFormat(d3.format(".02f"))
             .orient("left");
 
+    // Large plots are drawn at a level of detail: only the points in the visible window are drawn, with dense regions
+    // downsampled to cells, as retrieved from the server on every zoom (see load_level_of_detail).
+    // The full data is only used for the boundaries of the axes.
+    var level_of_detail = options.lodUrl !== undefined && flat_data.length > options.lodThreshold;
+    if (level_of_detail) {
+        flat_data = [];
+        clusters = [];
+    }
+
     // setup fill color
     var cValue = function(d) { return d.color; };
 
@@ -224,6 +276,47 @@ function MDSView(flat_data, series_list, clusters, options) {
         return Math.max(3, Math.pow(cluster.count, cluster_size_a) * cluster_size_b);
     }
 
+    // texts of the fragments, for payloads that only contain the fragment ids
+    var fragment_texts = {};
+    var pending_fragments = [];
+    var pending_timer = null;
+    var tooltip_point = null;
+
+    function load_fragment(pk, callback) {
+        // batch the requests for fragments that are hovered over in quick succession
+        pending_fragments.push({pk: pk, callback: callback});
+        if (pending_timer) {
+            return;
+        }
+        pending_timer = setTimeout(function () {
+            var batch = pending_fragments;
+            pending_fragments = [];
+            pending_timer = null;
+            var pks = _.uniq(_.pluck(batch, "pk"));
+            $.getJSON(options.fragmentsUrl, {pks: pks.join(",")})
+                .done(function (data) {
+                    _.extend(fragment_texts, data.fragments);
+                    batch.forEach(function (request) { request.callback(); });
+                })
+                .fail(function () {
+                    // the batch is dropped, so hovering over the points again retries the request
+                    batch.forEach(function (request) { request.callback("The fragment could not be loaded."); });
+                });
+        }, 50);
+    }
+
+    function tooltip_html(d, text) {
+        return (options.clustered ? clusters[d.cluster].count + " fragment" +
+            (clusters[d.cluster].count === 1 ? "" : "s, for example")
+            + ":<br/>" : "") +
+            "<strong>" +
+            d.fragment_pk +
+            "</strong>: <em>" +
+            text +
+            "</em><br>" +
+            d.tenses;
+    }
+
     function show_tooltip(d) {
         // highlight node
         d3.select(this).style("fill-opacity", .5);
@@ -231,16 +324,26 @@ function MDSView(flat_data, series_list, clusters, options) {
         tooltip.transition()
             .duration(100)
             .style("opacity", .9);
-        tooltip.html(
-            (options.clustered ? clusters[d.cluster].count + " fragment" +
-            (clusters[d.cluster].count === 1 ? "" : "s, for example")
-            + ":<br/>" : "") +
-            "<strong>" +
-            d.fragment_pk +
-            "</strong>: <em>" +
-            d.fragment +
-            "</em><br>" +
-            d.tenses)
+        tooltip_point = d;
+        var text = d.fragment !== undefined ? d.fragment : fragment_texts[d.fragment_pk];
+        if (d.fragment_pk === undefined) {
+            // a cell of the level of detail, which combines the fragments in a region of the plot
+            tooltip.html(d.count + " fragments, mostly:<br>" + d.tenses)
+                .style("left", (d3.event.pageX + 10) + "px")
+                .style("top", (d3.event.pageY - 28) + "px");
+            return;
+        }
+        if (text === undefined) {
+            text = "&hellip;";
+            load_fragment(d.fragment_pk, function (error) {
+                // only update the tooltip if it is still showing this point
+                if (tooltip_point === d) {
+                    tooltip.html(tooltip_html(d, error ?
+                        "<span class=\"text-danger\">" + error + "</span>" : fragment_texts[d.fragment_pk]));
+                }
+            });
+        }
+        tooltip.html(tooltip_html(d, text))
             .style("left", (d3.event.pageX + 10) + "px")
             .style("top", (d3.event.pageY - 28) + "px");
     }
@@ -259,7 +362,7 @@ function MDSView(flat_data, series_list, clusters, options) {
         var data = d3.selectAll(".dot");
         for (var circle of data[0]) {
             var f = circle.__data__
-            if (f !== undefined) {
+            if (f !== undefined && f.fragment_pk !== undefined) {
                 if (within_distance(origin, f, distance)) {
                     if (_.isEqual(f.tenses.concat().sort(), origin.tenses.concat().sort())) {
                         brushedNodes.push(f.fragment_pk);
@@ -276,24 +379,32 @@ function MDSView(flat_data, series_list, clusters, options) {
     }
 
     //add data points
-    container.selectAll(".dot")
-        .data(flat_data)
-        .enter()
-        .append("circle")
-        .attr("class", options.clustered ? "dot clustered" : "dot")
-        .attr("r", function (d) { return cluster_size(clusters[d.cluster]); })
-        .attr("cx", function (d) { return xMap(clusters[d.cluster]); })
-        .attr("cy", function (d) { return yMap(clusters[d.cluster]); })
-        .style("fill", function (d) { return cValue(d); })
-        .on("mouseover", show_tooltip)
-        .on("mouseout", function (d) {
-            d3.select(this).style("fill-opacity", 1);
-            tooltip.style("opacity", 0);
-        })
-        .on("click", function (d) {
-            $(".loading-overlay").show();
-            select_neighbours(d);
-        });
+    function draw_dots() {
+        var dots = container.selectAll(".dot").data(flat_data);
+        dots.exit().remove();
+        dots.enter()
+            .append("circle")
+            .on("mouseover", show_tooltip)
+            .on("mouseout", function (d) {
+                d3.select(this).style("fill-opacity", 1);
+                tooltip.style("opacity", 0);
+            })
+            .on("click", function (d) {
+                // cells of the level of detail cannot be selected, zoom in to show their fragments
+                if (d.fragment_pk === undefined) {
+                    return;
+                }
+                $(".loading-overlay").show();
+                select_neighbours(d);
+            });
+        dots.attr("class", options.clustered ? "dot clustered" : "dot")
+            .attr("r", function (d) { return cluster_size(clusters[d.cluster]); })
+            .attr("cx", function (d) { return xMap(clusters[d.cluster]); })
+            .attr("cy", function (d) { return yMap(clusters[d.cluster]); })
+            .style("fill", function (d) { return cValue(d); });
+    }
+
+    draw_dots();
 
     // Retrieve vertices for a key (used to calculate convex hulls)
     function vertices(key) {
@@ -350,7 +461,51 @@ function MDSView(flat_data, series_list, clusters, options) {
         window.location.hash = [zoom.scale(), zoom.translate(), cluster_size_a, cluster_size_b].join(",");
     }
 
+    var lod_timer = null;
+    var lod_request = null;
+
+    function load_level_of_detail() {
+        // wait until zooming or panning has stopped, then retrieve the points in the visible window
+        clearTimeout(lod_timer);
+        lod_timer = setTimeout(function () {
+            if (lod_request) {
+                lod_request.abort();
+            }
+            var x = xScale.domain(), y = yScale.domain();
+            lod_request = $.getJSON(options.lodUrl, {x0: x[0], x1: x[1], y0: y[0], y1: y[1], budget: options.lodBudget})
+                .done(function (data) {
+                    $("#lod-error").hide();
+                    // cells are drawn like the clusters of the full plot, sized by their number of fragments
+                    flat_data = [];
+                    clusters = [];
+                    data.cells.concat(data.points).forEach(function (d) {
+                        clusters.push({x: d.x, y: d.y, count: d.count || 1});
+                        flat_data.push(_.extend(d, {cluster: clusters.length - 1}));
+                    });
+                    container.selectAll(".cluster-label, .hull").remove();
+                    draw_dots();
+                    redraw();
+                })
+                .fail(function (request, status) {
+                    if (status !== "abort") {
+                        $("#lod-error").show();
+                    }
+                })
+                .always(function () {
+                    lod_request = null;
+                });
+        }, 200);
+    }
+
     function zoomed() {
+        redraw();
+        update_location_hash();
+        if (level_of_detail) {
+            load_level_of_detail();
+        }
+    }
+
+    function redraw() {
         d3.select(".x.axis").call(xAxis);
         d3.select(".y.axis").call(yAxis);
         d3.select(".x.grid").call(xAxisGrid);
@@ -379,8 +534,6 @@ function MDSView(flat_data, series_list, clusters, options) {
 
         // Remove dots, labels, and hulls linked to inactive legendEntries
         d3.selectAll(".legendEntry:not(.active)").each(d => set_dots(d.key, false));
-
-        update_location_hash();
     }
 
     var zoom = d3.behavior.zoom()
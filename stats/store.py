@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from django.conf import settings
+
+from .cube import LabelCube
+
+
+class ScenarioStore:
+    """
+    Stores the results of a Scenario as binary files in a directory per Scenario, so that every array can be loaded
+    independently (and memory-mapped), rather than unpickling the full results:
+    - fragments.npy: the pks of the Fragments in the model
+    - model.npy: the (fragments x dimensions) coordinates
+    - labels.npy: the (fragments x languages) label codes, an index into the vocabulary of the language
+    - labels.json: the languages, and the distinct labels (the vocabulary) per language
+    - tuples.npy, tuple_rows.npy, tuple_offsets.npy: the index of the Fragments per label tuple (see LabelCube)
+    - sorted_fragments.npy, sorted_rows.npy: the index of the rows per Fragment pk
+    Every run is written to a new version directory, which is made current by replacing the current file (that
+    contains the name of the version directory) in a single rename. A store pins the version on its first read,
+    so that the arrays read through a store always belong to the same run. The previous version is kept for readers
+    that are still using it. Results written before versions were introduced reside in the directory itself.
+    The distance matrix is stored separately, see Scenario.get_matrix.
+    """
+    CURRENT = 'current'
+    VERSION_PREFIX = 'version-'
+    FRAGMENTS = 'fragments.npy'
+    MODEL = 'model.npy'
+    CODES = 'labels.npy'
+    VOCABULARY = 'labels.json'
+    TUPLES = 'tuples.npy'
+    TUPLE_ROWS = 'tuple_rows.npy'
+    TUPLE_OFFSETS = 'tuple_offsets.npy'
+    SORTED_FRAGMENTS = 'sorted_fragments.npy'
+    SORTED_ROWS = 'sorted_rows.npy'
+
+    DATA_FILES = [FRAGMENTS, MODEL, CODES, VOCABULARY, TUPLES, TUPLE_ROWS, TUPLE_OFFSETS, SORTED_FRAGMENTS,
+                  SORTED_ROWS]
+
+    def __init__(self, scenario):
+        self.scenario_pk = scenario.pk
+        self.directory = os.path.join(settings.SCENARIO_DATA_PATH, 's{}'.format(scenario.pk))
+        self.version = None
+
+    def path(self, name):
+        """
+        :return: the path of a file that is kept next to the versions of the results, e.g. an export
+        """
+        return os.path.join(self.directory, name)
+
+    def data_path(self, name):
+        """
+        :return: the path of a file of the (pinned) current version of the results
+        """
+        version = self.current_version()
+        return os.path.join(self.directory, version or '', name)
+
+    def current_version(self):
+        """
+        Pins the current version of the results on first use.
+        :return: the name of the version directory, '' for results written before versions were introduced,
+        or None if there are no results
+        """
+        if self.version is None:
+            self.version = self._read_current()
+        return self.version
+
+    def _read_current(self):
+        try:
+            with open(self.path(self.CURRENT), encoding='utf-8') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return '' if os.path.exists(self.path(self.FRAGMENTS)) else None
+
+    def exists(self):
+        return self.current_version() is not None and os.path.exists(self.data_path(self.FRAGMENTS))
+
+    def write(self, fragment_pks, fragment_labels, model):
+        """
+        Writes the results of a Scenario.
+        :param fragment_pks: the pks of the Fragments
+        :param fragment_labels: a dictionary with a list of labels per language, in the order of fragment_pks
+        :param model: the coordinates of the Fragments
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        cube = LabelCube.from_labels(fragment_pks, fragment_labels)
+        vocabulary = {language: [list(value) if isinstance(value, tuple) else value for value in values]
+                      for language, values in cube.vocabulary.items()}
+
+        # Write the files in a temporary directory, which is renamed to a version directory when it is complete
+        directory = tempfile.mkdtemp(prefix='tmp-', dir=self.directory)
+        arrays = [(self.FRAGMENTS, cube.fragment_pks), (self.MODEL, np.asarray(model, dtype=np.float64)),
+                  (self.CODES, cube.codes), (self.TUPLES, cube.tuples), (self.TUPLE_ROWS, cube.rows),
+                  (self.TUPLE_OFFSETS, cube.offsets), (self.SORTED_FRAGMENTS, cube.sorted_pks),
+                  (self.SORTED_ROWS, cube.sorted_rows)]
+        for name, array in arrays:
+            np.save(os.path.join(directory, name), array)
+        with open(os.path.join(directory, self.VOCABULARY), 'w', encoding='utf-8') as f:
+            json.dump({'languages': cube.languages, 'vocabulary': vocabulary}, f)
+        os.chmod(directory, 0o755)
+
+        version = self.VERSION_PREFIX + os.path.basename(directory)[len('tmp-'):]
+        os.rename(directory, self.path(version))
+
+        # Make the new version current in a single rename
+        previous_version = self._read_current()
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(version)
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, self.path(self.CURRENT))
+        self.version = version
+
+        self._remove_versions(keep=[version, previous_version])
+
+    def _remove_versions(self, keep):
+        """
+        Removes the versions of the results that are not kept.
+        """
+        for name in os.listdir(self.directory):
+            if name.startswith(self.VERSION_PREFIX) and name not in keep:
+                shutil.rmtree(self.path(name), ignore_errors=True)
+        if '' not in keep:
+            for name in self.DATA_FILES:
+                if os.path.exists(self.path(name)):
+                    os.remove(self.path(name))
+
+    def read_fragments(self):
+        """
+        :return: the pks of the Fragments, as a read-only memory-mapped array
+        """
+        return np.load(self.data_path(self.FRAGMENTS), mmap_mode='r')
+
+    def read_model(self):
+        """
+        :return: the coordinates of the Fragments, as a read-only memory-mapped array
+        """
+        return np.load(self.data_path(self.MODEL), mmap_mode='r')
+
+    def read_codes(self):
+        """
+        :return: the label codes of the Fragments, as a read-only memory-mapped array
+        """
+        return np.load(self.data_path(self.CODES), mmap_mode='r')
+
+    def read_vocabulary(self):
+        """
+        :return: the languages, and a dictionary with the distinct labels per language
+        """
+        with open(self.data_path(self.VOCABULARY), encoding='utf-8') as f:
+            data = json.load(f)
+        vocabulary = {language: [tuple(value) if isinstance(value, list) else value for value in values]
+                      for language, values in data['vocabulary'].items()}
+        return data['languages'], vocabulary
+
+    def read_labels(self):
+        """
+        :return: a dictionary with the list of labels per language, in the order of the Fragments
+        """
+        languages, vocabulary = self.read_vocabulary()
+        codes = self.read_codes()
+        return {language: [vocabulary[language][code] for code in codes[:, column].tolist()]
+                for column, language in enumerate(languages)}
+
+    def read_cube(self):
+        """
+        :return: the LabelCube of the Fragments. The indices are computed for results written before they were stored.
+        """
+        languages, vocabulary = self.read_vocabulary()
+        tuple_index = self._read_optional(self.TUPLES, self.TUPLE_ROWS, self.TUPLE_OFFSETS)
+        fragment_index = self._read_optional(self.SORTED_FRAGMENTS, self.SORTED_ROWS)
+        return LabelCube(self.read_fragments(), languages, vocabulary, self.read_codes(),
+                         *tuple_index, *fragment_index)
+
+    def _read_optional(self, *names):
+        if not all(os.path.exists(self.data_path(name)) for name in names):
+            return [None] * len(names)
+        return [np.load(self.data_path(name), mmap_mode='r') for name in names]
+
+    def delete(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.version = None
@@ -1,9 +1,35 @@
+import glob
+import io
+import json
+import os
+import random
+import tempfile
+from datetime import timedelta
+from zipfile import ZipFile
+
 import numpy as np
+import pyarrow.feather as feather
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
 
 from annotations.test_models import BaseTestCase
-from annotations.models import Alignment, Annotation, Label, LabelKey, Sentence, Fragment, Word, Tense, TenseCategory
-from .models import Scenario, ScenarioLanguage
-from .utils import run_mds
+from annotations.models import Alignment, Annotation, Label, LabelKey, Language, Sentence, Fragment, Word, Tense, \
+    TenseCategory
+from .cube import LabelCube
+from .distances import encode_labels, get_distance_matrix, get_distance_rows
+from .jobs import enqueue_scenario, run_worker, rerun_scenarios, claim_job, requeue_stale_jobs
+from .loader import CorpusSnapshot
+from .management.commands.scenario_to_feather import export_matrix, export_zip
+from .mds import collapse_codes, classical_mds, landmark_mds, select_landmarks, smacof
+from .models import Scenario, ScenarioLanguage, ScenarioJob
+from .grid import MultiResolutionGrid
+from .plots import ARRAY_TYPES, plot_payload, plot_binary, reduce_model
+from .sankey import sankey_payload, option_values, annotation_values
+from .store import ScenarioStore
+from .utils import run_mds, update_mds, convert_results, get_distance, prepare_label_cache, \
+    label_cache_statistics
 
 np.seterr(invalid='ignore')  # Silences the RuntimeWarnings for small Scenarios
 
@@ -22,9 +48,21 @@ def create_annotation(original, translated, label):
     return annotation
 
 
+def use_temporary_data_path(test_case):
+    """
+    Stores the results of Scenarios in a temporary directory for the duration of a test.
+    """
+    data_path = tempfile.TemporaryDirectory()
+    test_case.addCleanup(data_path.cleanup)
+    settings_override = override_settings(SCENARIO_DATA_PATH=data_path.name)
+    settings_override.enable()
+    test_case.addCleanup(settings_override.disable)
+
+
 class ScenarioTenseTest(BaseTestCase):
     def setUp(self):
         super().setUp()
+        use_temporary_data_path(self)
         self.scenario = Scenario.objects.create(title='Test Scenario',
                                                 description='Test Scenario', corpus=self.c1,)
         self.scenario.documents.add(self.d)
@@ -50,14 +88,15 @@ class ScenarioTenseTest(BaseTestCase):
     def test_mds_single_point(self):
         run_mds(self.scenario)
         # expect one label per language
-        self.assertEqual(self.scenario.mds_labels['en'], [('Tense:{}'.format(self.tense_1.id),)])
-        self.assertEqual(self.scenario.mds_labels['nl'], [('Tense:{}'.format(self.tense_2.id),)])
-        self.assertEqual(self.scenario.mds_model, [[0.0, 0.0, 0.0, 0.0, 0.0]])  # 5 dimensions by default
+        self.assertEqual(self.scenario.get_labels()['en'], [('Tense:{}'.format(self.tense_1.id),)])
+        self.assertEqual(self.scenario.get_labels()['nl'], [('Tense:{}'.format(self.tense_2.id),)])
+        self.assertEqual(self.scenario.get_model().tolist(), [[0.0, 0.0, 0.0, 0.0, 0.0]])  # 5 dimensions by default
 
 
 class ScenarioLabelsTest(BaseTestCase):
     def setUp(self):
         super().setUp()
+        use_temporary_data_path(self)
         self.scenario = Scenario.objects.create(
             title='Test Scenario', description='Test Scenario',
             corpus=self.c1,
@@ -105,9 +144,9 @@ class ScenarioLabelsTest(BaseTestCase):
     def test_mds_single_point(self):
         run_mds(self.scenario)
         # expect one label per language
-        self.assertEqual(self.scenario.mds_labels['en'], [('Label:{}'.format(self.label_1.id),)])
-        self.assertEqual(self.scenario.mds_labels['nl'], [('Label:{}'.format(self.label_2.id),)])
-        self.assertEqual(self.scenario.mds_model, [[0.0, 0.0, 0.0, 0.0, 0.0]])  # 5 dimensions by default
+        self.assertEqual(self.scenario.get_labels()['en'], [('Label:{}'.format(self.label_1.id),)])
+        self.assertEqual(self.scenario.get_labels()['nl'], [('Label:{}'.format(self.label_2.id),)])
+        self.assertEqual(self.scenario.get_model().tolist(), [[0.0, 0.0, 0.0, 0.0, 0.0]])  # 5 dimensions by default
 
     def test_mds_two_points(self):
         label_3 = Label.objects.create(title='Label3 (nl)', key=self.label_key)
@@ -119,12 +158,12 @@ class ScenarioLabelsTest(BaseTestCase):
 
         run_mds(self.scenario)
         # original fragments both have the same label
-        self.assertEqual(self.scenario.mds_labels['en'], [('Label:{}'.format(self.label_1.id),)] * 2)
+        self.assertEqual(self.scenario.get_labels()['en'], [('Label:{}'.format(self.label_1.id),)] * 2)
         # translated fragments have two different labels
-        self.assertEqual(self.scenario.mds_labels['nl'], [('Label:{}'.format(self.label_2.id),),
+        self.assertEqual(self.scenario.get_labels()['nl'], [('Label:{}'.format(self.label_2.id),),
                                                           ('Label:{}'.format(label_3.id),)])
 
-        points = [np.array(x) for x in self.scenario.mds_model]
+        points = self.scenario.get_model()
         self.assertAlmostEqual(np.linalg.norm(points[0] - points[1]), 0.5, places=2)
 
     def test_mds_two_points_multiple_target_labels(self):
@@ -146,13 +185,414 @@ class ScenarioLabelsTest(BaseTestCase):
         run_mds(self.scenario)
 
         # original fragments both have the same label
-        self.assertEqual(self.scenario.mds_labels['en'], [(label_symbol(self.label_1),)] * 2)
+        self.assertEqual(self.scenario.get_labels()['en'], [(label_symbol(self.label_1),)] * 2)
         # translated fragments have two different paris of labels
-        self.assertEqual(self.scenario.mds_labels['nl'], [(label_symbol(self.label_2), label_symbol(label_3)),
+        self.assertEqual(self.scenario.get_labels()['nl'], [(label_symbol(self.label_2), label_symbol(label_3)),
                                                           (label_symbol(self.label_2), label_symbol(label_4))])
 
-        points = [np.array(x) for x in self.scenario.mds_model]
+        points = self.scenario.get_model()
+        self.assertAlmostEqual(np.linalg.norm(points[0] - points[1]), 0.5, places=2)
+
+    def test_mds_matrix_on_disk(self):
+        label_3 = Label.objects.create(title='Label3 (nl)', key=self.label_key)
+
+        create_annotation(
+            self.make_fragment('Another sentence', self.en, 'sentence', self.label_1),
+            self.make_fragment('Nog een zin', self.nl, 'zin'),
+            label_3).save()
+
+        with tempfile.TemporaryDirectory() as data_path, override_settings(SCENARIO_DATA_PATH=data_path):
+            for storage in [Scenario.MATRIX_FLOAT32, Scenario.MATRIX_UINT8]:
+                self.scenario.mds_matrix_storage = storage
+                run_mds(self.scenario)
+                self.assertIsNone(self.scenario.mds_matrix)
+
+                matrix = self.scenario.get_matrix()
+                self.assertEqual(matrix.dtype, np.dtype(storage))
+                self.assertEqual(matrix.shape, (2, 2))
+
+                filename = '{}/matrix.feather'.format(data_path)
+                export_matrix(filename, self.scenario)
+                df = feather.read_feather(filename)
+                self.assertEqual(df.values.tolist(), [[0.0, 0.5], [0.5, 0.0]])
+
+                points = self.scenario.get_model()
+                self.assertAlmostEqual(np.linalg.norm(points[0] - points[1]), 0.5, places=2)
+
+    def test_mds_collapse_tuples(self):
+        label_3 = Label.objects.create(title='Label3 (nl)', key=self.label_key)
+
+        for _ in range(2):
+            create_annotation(
+                self.make_fragment('Another sentence', self.en, 'sentence', self.label_1),
+                self.make_fragment('Nog een zin', self.nl, 'zin'),
+                label_3).save()
+
+        self.scenario.mds_collapse_tuples = True
+        with tempfile.TemporaryDirectory() as data_path, override_settings(SCENARIO_DATA_PATH=data_path):
+            run_mds(self.scenario)
+            self.assertEqual(len(self.scenario.get_fragments()), 3)
+
+            # The full distance matrix is never built, only the matrix between the unique tuples
+            self.assertFalse(os.path.exists(self.scenario.matrix_filename()))
+            self.assertIsNone(self.scenario.get_matrix())
+            matrix, inverse = self.scenario.get_collapsed_matrix()
+            self.assertEqual(matrix.shape, (2, 2))
+            self.assertAlmostEqual(matrix[0, 1], 0.5)
+            self.assertEqual(inverse.tolist(), [0, 1, 1])
+
+            points = self.scenario.get_model()
+            self.assertTrue(np.array_equal(points[1], points[2]))
+            self.assertAlmostEqual(np.linalg.norm(points[0] - points[1]), 0.5, places=2)
+
+            # The export contains the matrix between the unique tuples, and the row of every Fragment in it
+            with ZipFile(export_zip(self.scenario)) as zip_file:
+                pk = self.scenario.pk
+                exported = feather.read_feather(io.BytesIO(zip_file.read('s{}-matrix.feather'.format(pk))))
+                labels = feather.read_feather(io.BytesIO(zip_file.read('s{}-labels.feather'.format(pk))))
+            self.assertEqual(exported.values.tolist(), matrix.tolist())
+            self.assertEqual(labels['matrix_row'].tolist(), [0, 1, 1])
+
+    def assertSnapshotMatches(self):
+        # A snapshot of the whole Corpus should give the same results as one scoped to the Scenario
+        run_mds(self.scenario)
+        expected_fragments, expected_labels = self.scenario.get_fragments(), self.scenario.get_labels()
+        run_mds(self.scenario, snapshot=CorpusSnapshot(self.c1))
+        self.assertEqual(self.scenario.get_fragments(), expected_fragments)
+        self.assertEqual(dict(self.scenario.get_labels()), dict(expected_labels))
+
+    def test_mds_snapshot(self):
+        second_key = LabelKey.objects.create(title='Second Label Key')
+        second_key.corpora.add(self.c1)
+        label_3 = Label.objects.create(title='Label3', key=second_key)
+        label_4 = Label.objects.create(title='Label4', key=second_key)
+
+        self.annotation.labels.add(label_3)
+        create_annotation(
+            self.make_fragment('Another sentence', self.en, 'sentence', self.label_1),
+            self.make_fragment('Nog een zin', self.nl, 'zin'),
+            label_4).save()
+        create_annotation(
+            self.make_fragment('Yet another sentence', self.en, 'sentence', label_3),
+            self.make_fragment('Nog een andere zin', self.nl, 'zin'),
+            self.label_2).save()
+        self.make_fragment('A sentence without translation', self.en, 'sentence', self.label_1)
+        self.assertSnapshotMatches()
+
+        self.l2.include_keys.add(second_key)
+        self.scenario.mds_allow_partial = True
+        self.assertSnapshotMatches()
+
+        self.l1.include_labels.add(self.label_1)
+        self.l2.include_labels.add(label_4)
+        self.assertSnapshotMatches()
+
+        # Use the source language as target language as well
+        self.l1.as_to = True
+        self.l1.save()
+        self.assertSnapshotMatches()
+
+    def test_mds_include_keys_per_language(self):
+        second_key = LabelKey.objects.create(title='Second Label Key')
+        second_key.corpora.add(self.c1)
+        label_3 = Label.objects.create(title='Label3', key=second_key)
+
+        de = Language.objects.get(iso='de')
+        ScenarioLanguage.objects.create(scenario=self.scenario, language=de,
+                                        as_from=False, as_to=True, use_labels=True)
+        self.l2.include_keys.add(second_key)
+        self.annotation.labels.add(label_3)
+
+        # Dutch includes only the second key, German only the first key
+        create_annotation(self.f_en, self.make_fragment('Das ist ein Satz', de, 'Satz'), self.label_2).labels.add(label_3)
+        self.scenario.languages(language=de).get().include_keys.add(self.label_key)
+
+        run_mds(self.scenario)
+        self.assertEqual(self.scenario.get_labels()['nl'], [(label_symbol(label_3),)])
+        self.assertEqual(self.scenario.get_labels()['de'], [(label_symbol(self.label_2),)])
+
+    def test_rerun_scenarios(self):
+        results = list(rerun_scenarios([self.scenario]))
+        self.assertEqual(len(results), 1)
+        pk, title, duration, error = results[0]
+        self.assertEqual(pk, self.scenario.pk)
+        self.assertIsNone(error)
+
+        self.scenario.refresh_from_db()
+        self.assertIsNotNone(self.scenario.last_run)
+        self.assertEqual(self.scenario.get_labels()['nl'], [('Label:{}'.format(self.label_2.id),)])
+
+    def test_label_cache(self):
+        cache.clear()
+        label_cache = prepare_label_cache(self.c1)
+        self.assertEqual(label_cache[label_symbol(self.label_1)][0], 'Label1 (en)')
+        self.assertEqual(label_cache_statistics()['misses'], 1)
+
+        # The second time, the properties are retrieved from the cache
+        with self.assertNumQueries(0):
+            label_cache = prepare_label_cache(self.c1)
+        self.assertEqual(label_cache[label_symbol(self.label_1)][0], 'Label1 (en)')
+        self.assertEqual(label_cache_statistics()['hits'], 1)
+
+        # Changing a Label invalidates the cache
+        version = label_cache_statistics()['version']
+        self.label_1.title = 'Label1 (en, renamed)'
+        self.label_1.save()
+        self.assertEqual(label_cache_statistics()['version'], version + 1)
+        label_cache = prepare_label_cache(self.c1)
+        self.assertEqual(label_cache[label_symbol(self.label_1)][0], 'Label1 (en, renamed)')
+        self.assertEqual(label_cache_statistics()['misses'], 2)
+
+    def test_plot_payload(self):
+        cache.clear()
+        run_mds(self.scenario)
+        payload = plot_payload(self.scenario, 'en', 1, 2, True)
+        self.assertTrue(payload['complete'])
+        self.assertEqual(payload['dimensions'], self.scenario.mds_dimensions)
+        self.assertEqual([point['fragment_pk'] for point in json.loads(payload['flat_data'])], [self.f_en.pk])
+        self.assertIn('hard to test', payload['flat_data'])
+
+        # The second time, the payload is retrieved from the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(plot_payload(self.scenario, 'en', 1, 2, True), payload)
+
+        # Without texts, only the pks of the Fragments are included
+        payload = plot_payload(self.scenario, 'en', 1, 2, True, with_text=False)
+        self.assertNotIn('hard to test', payload['flat_data'])
+
+        # After a rerun, the binary payloads are precomputed (if enabled)
+        with override_settings(SCENARIO_PRECOMPUTE_PLOTS=True):
+            run_mds(self.scenario)
+        with self.assertNumQueries(0):
+            plot_binary(self.scenario, 'nl', 2, 0, True)
+
+    def test_mds_data(self):
+        run_mds(self.scenario)
+        self.client.login(username=self.u1.username, password='secret')
+        url = reverse('stats:mds_data', args=[self.scenario.pk, 'en', 1, 2])
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+
+        # Decode the payload, see load_plot_data in mds.js
+        content = response.content
+        header_length = int(np.frombuffer(content[:4], dtype='<u4')[0])
+        header = json.loads(content[4:4 + header_length])
+        self.assertEqual(header['labels'], [['Label1 (en)', 'Label2 (nl)']])
+        dtypes = {array_type: dtype for dtype, array_type in ARRAY_TYPES.items()}
+        arrays = dict()
+        offset = 4 + header_length
+        for name, array_type, length in header['arrays']:
+            offset += -offset % 8
+            arrays[name] = np.frombuffer(content, dtype=dtypes[array_type], count=length, offset=offset)
+            offset += arrays[name].nbytes
+        self.assertEqual(offset, len(content))
+        self.assertEqual(arrays['fragment_pk'].tolist(), [self.f_en.pk])
+        self.assertEqual(arrays['cluster_count'].tolist(), [1])
+
+        # The response can be revalidated
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        # A downsampled version of the plot can be retrieved
+        response = self.client.get(reverse('stats:mds_lod', args=[self.scenario.pk, 'en', 1, 2]), {'budget': 10})
+        self.assertEqual([point['fragment_pk'] for point in response.json()['points']], [self.f_en.pk])
+        self.assertEqual(response.json()['points'][0]['tenses'], ['Label1 (en)', 'Label2 (nl)'])
+
+        # Dimensions that are not in the model are not found
+        response = self.client.get(reverse('stats:mds_data', args=[self.scenario.pk, 'en', 1, 9]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_mds_fragments(self):
+        run_mds(self.scenario)
+        self.client.login(username=self.u1.username, password='secret')
+        url = reverse('stats:mds_fragments', args=[self.scenario.pk])
+
+        # Only the texts of Fragments in the Scenario are returned
+        response = self.client.get(url, {'pks': '{},{}'.format(self.f_en.pk, self.f_nl.pk)})
+        self.assertEqual(list(response.json()['fragments']), [str(self.f_en.pk)])
+        self.assertIn('hard to test', response.json()['fragments'][str(self.f_en.pk)])
+
+        self.assertEqual(self.client.get(url, {'pks': 'x'}).status_code, 400)
+
+    def test_sankey(self):
+        cache.clear()
+        run_mds(self.scenario)
+        data = json.loads(sankey_payload(self.scenario, 'en', 'nl'))
+        nodes = {node['id']: (node['language'], node['label']) for node in data['nodes']}
+        self.assertEqual([(nodes[link['source']], nodes[link['target']], link['fragment_pks'])
+                          for link in data['links']], [(('en', 'Label1 (en)'), ('nl', 'Label2 (nl)'), [self.f_en.pk])])
+
+        # The second time, the flows are retrieved from the cache
+        with self.assertNumQueries(0):
+            sankey_payload(self.scenario, 'en', 'nl')
+
+        # With an option, the flows run through the values of the option
+        data = json.loads(sankey_payload(self.scenario, 'en', 'nl', 'get_formal_structure_display'))
+        nodes = {node['id']: (node['language'], node['label']) for node in data['nodes']}
+        self.assertEqual([(nodes[link['source']][0], nodes[link['target']][0]) for link in data['links']],
+                         [('en', '-'), ('-', 'nl')])
+
+        # The values of the options line up with the pks, also for Fragments that have been deleted since the last run
+        missing_pk = Fragment.objects.order_by('-pk').values_list('pk', flat=True).first() + 1
+        self.assertEqual(option_values([missing_pk, self.f_en.pk], 'get_formal_structure_display'),
+                         ['none', self.f_en.get_formal_structure_display()])
+        self.assertEqual(annotation_values([missing_pk, self.f_en.pk], 'nl', 'is_translation'), ['none', True])
+
+    def test_descriptive(self):
+        create_annotation(
+            self.make_fragment('Another sentence', self.en, 'sentence', self.label_1),
+            self.make_fragment('Nog een zin', self.nl, 'zin'),
+            self.label_2).save()
+        run_mds(self.scenario)
+        self.client.login(username=self.u1.username, password='secret')
+        response = self.client.get(reverse('stats:descriptive', args=[self.scenario.pk]))
+
+        fragment_pks = self.scenario.get_fragments()
+        self.assertEqual(response.context['counters'][self.en], {'Label1 (en)': fragment_pks})
+        self.assertEqual(response.context['tuples_with_fragments'],
+                         {('Label1 (en)', 'Label2 (nl)'): fragment_pks})
+
+        # The drill-through includes all Fragments with the same labels
+        session = self.client.session
+        session['scenario_pk'] = self.scenario.pk
+        session['fragment_pks'] = [self.f_en.pk]
+        session.save()
+        response = self.client.get(reverse('stats:fragment_table_mds'))
+        self.assertEqual(sorted(f.pk for f in response.context['fragments']), sorted(fragment_pks))
+
+    def test_download(self):
+        run_mds(self.scenario)
+        self.client.login(username=self.u1.username, password='secret')
+        response = self.client.get(reverse('stats:download', args=[self.scenario.pk]))
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with ZipFile(io.BytesIO(b''.join(response.streaming_content))) as zip_file:
+            self.assertEqual(sorted(zip_file.namelist()),
+                             sorted(['s{}-matrix.feather'.format(self.scenario.pk), 'tensecats.feather',
+                                     's{}-labels.feather'.format(self.scenario.pk)]))
+            labels_filename = 's{}-labels.feather'.format(self.scenario.pk)
+            labels = feather.read_feather(io.BytesIO(zip_file.read(labels_filename)))
+        self.assertEqual(labels['fragment_pk'].tolist(), [self.f_en.pk])
+
+        # The export is kept for the current run only, but an export that is being downloaded can still be read
+        exports = glob.glob(self.scenario.results().path('export-*.zip'))
+        self.assertEqual(len(exports), 1)
+        previous = Scenario.objects.get(pk=self.scenario.pk)
+        run_mds(self.scenario)
+        with export_zip(previous) as downloading:
+            self.client.get(reverse('stats:download', args=[self.scenario.pk])).close()
+            current = glob.glob(self.scenario.results().path('export-*.zip'))
+            self.assertNotEqual(current, exports)
+            self.assertTrue(ZipFile(downloading).namelist())
+
+        # An export for a previous run does not remove the export of the current run
+        export_zip(previous).close()
+        self.assertTrue(set(current) <= set(glob.glob(self.scenario.results().path('export-*.zip'))))
+
+    def test_convert_results(self):
+        run_mds(self.scenario)
+        expected_labels = self.scenario.get_labels()
+        expected_model = self.scenario.get_model().tolist()
+        expected_matrix = self.scenario.get_matrix().tolist()
+
+        # Scenarios that have been run before have their results pickled in the database
+        self.scenario.results().delete()
+        self.scenario.mds_matrix_storage = Scenario.MATRIX_DATABASE
+        self.scenario.mds_matrix = np.array(expected_matrix)
+        self.scenario.mds_model = expected_model
+        self.scenario.mds_fragments = [self.f_en.pk]
+        self.scenario.mds_labels = expected_labels
+        self.scenario.save()
+        self.assertEqual(self.scenario.get_labels(), expected_labels)
+
+        self.assertTrue(convert_results(Scenario.objects.get(pk=self.scenario.pk)))
+        self.scenario.refresh_from_db()
+        self.assertIsNone(self.scenario.mds_model)
+        self.assertEqual(self.scenario.mds_matrix_storage, Scenario.MATRIX_FLOAT64)
+        self.assertEqual(self.scenario.get_fragments(), [self.f_en.pk])
+        self.assertEqual(self.scenario.get_labels(), expected_labels)
+        self.assertEqual(self.scenario.get_model().tolist(), expected_model)
+        self.assertEqual(self.scenario.get_matrix().tolist(), expected_matrix)
+
+        # Deleting the Scenario removes its results
+        directory = self.scenario.results().directory
+        self.scenario.delete()
+        self.assertFalse(os.path.exists(directory))
+
+    def test_mds_landmarks(self):
+        label_3 = Label.objects.create(title='Label3 (nl)', key=self.label_key)
+        create_annotation(
+            self.make_fragment('Another sentence', self.en, 'sentence', self.label_1),
+            self.make_fragment('Nog een zin', self.nl, 'zin'),
+            label_3).save()
+
+        self.scenario.mds_landmarks = 10
+        run_mds(self.scenario)
+        self.assertIsNone(self.scenario.mds_matrix)
+        self.assertIsNone(self.scenario.get_matrix())
+        self.assertEqual(len(self.scenario.get_model()), 2)
+
+        points = self.scenario.get_model()
         self.assertAlmostEqual(np.linalg.norm(points[0] - points[1]), 0.5, places=2)
+        self.assertAlmostEqual(self.scenario.mds_stress, 0, places=2)
+
+    def test_mds_init(self):
+        label_3 = Label.objects.create(title='Label3 (nl)', key=self.label_key)
+        create_annotation(
+            self.make_fragment('Another sentence', self.en, 'sentence', self.label_1),
+            self.make_fragment('Nog een zin', self.nl, 'zin'),
+            label_3).save()
+
+        for init in [Scenario.INIT_RANDOM, Scenario.INIT_CLASSICAL, Scenario.INIT_PREVIOUS]:
+            previous = self.scenario.get_model()
+            self.scenario.mds_init = init
+            run_mds(self.scenario)
+
+            points = self.scenario.get_model()
+            self.assertAlmostEqual(np.linalg.norm(points[0] - points[1]), 0.5, places=2)
+            self.assertEqual(self.scenario.mds_stress_history[-1], self.scenario.mds_stress)
+            self.assertEqual(self.scenario.mds_iterations(), len(self.scenario.mds_stress_history) - 1)
+            self.assertIsNotNone(self.scenario.mds_duration)
+
+            if init == Scenario.INIT_PREVIOUS:
+                # The previous solution is already optimal
+                self.assertEqual(self.scenario.get_model().tolist(), previous.tolist())
+
+    def test_mds_update(self):
+        run_mds(self.scenario)
+        self.scenario.last_run = timezone.now()
+        self.scenario.save()
+        self.assertFalse(self.scenario.changes.exists())
+
+        # Adding a Fragment records the change, and adds the Fragment to the results
+        label_3 = Label.objects.create(title='Label3 (nl)', key=self.label_key)
+        annotation = create_annotation(
+            self.make_fragment('Another sentence', self.en, 'sentence', self.label_1),
+            self.make_fragment('Nog een zin', self.nl, 'zin'),
+            label_3)
+        original = annotation.alignment.original_fragment
+        self.assertIn(original.pk, self.scenario.changes.values_list('fragment_id', flat=True))
+
+        self.assertGreater(update_mds(self.scenario), 0)
+        self.assertFalse(self.scenario.changes.exists())
+        self.assertEqual(self.scenario.get_fragments(), [self.f_en.pk, original.pk])
+        self.assertEqual(self.scenario.get_labels()['nl'], [(label_symbol(self.label_2),), (label_symbol(label_3),)])
+        self.assertEqual(self.scenario.get_matrix().tolist(), [[0.0, 0.5], [0.5, 0.0]])
+        points = self.scenario.get_model()
+        self.assertAlmostEqual(np.linalg.norm(points[0] - points[1]), 0.5, places=2)
+
+        # Changing the labels updates the row of the Fragment
+        annotation.labels.set([self.label_2])
+        update_mds(self.scenario)
+        self.assertEqual(self.scenario.get_labels()['nl'], [(label_symbol(self.label_2),)] * 2)
+        self.assertEqual(self.scenario.get_matrix().tolist(), [[0.0, 0.0], [0.0, 0.0]])
+
+        # Removing the Annotation removes the Fragment from the results
+        annotation.delete()
+        update_mds(self.scenario)
+        self.assertEqual(self.scenario.get_fragments(), [self.f_en.pk])
+        self.assertEqual(self.scenario.get_matrix().tolist(), [[0.0]])
+
+        # Without changes, nothing is updated
+        self.assertEqual(update_mds(self.scenario), 0)
 
     def test_mds_label_filter(self):
         label_3 = Label.objects.create(title='Label3 (nl)', key=self.label_key)
@@ -166,10 +606,10 @@ class ScenarioLabelsTest(BaseTestCase):
         self.l2.save()
 
         run_mds(self.scenario)
-        self.assertEqual(self.scenario.mds_labels['en'], [('Label:{}'.format(self.label_1.id),)])
-        self.assertEqual(self.scenario.mds_labels['nl'], [('Label:{}'.format(label_3.id),)])
+        self.assertEqual(self.scenario.get_labels()['en'], [('Label:{}'.format(self.label_1.id),)])
+        self.assertEqual(self.scenario.get_labels()['nl'], [('Label:{}'.format(label_3.id),)])
 
-        points = [np.array(x) for x in self.scenario.mds_model]
+        points = self.scenario.get_model()
         # after filtering we expect a single point
         self.assertEqual(len(points), 1)
 
@@ -188,7 +628,7 @@ class ScenarioLabelsTest(BaseTestCase):
         # leaving ScenarioLanguage.include_keys empty, all label keys should be used
         run_mds(self.scenario)
         # expecting a tuple of two labels
-        self.assertEqual(len(self.scenario.mds_labels['nl'][0]), 2)
+        self.assertEqual(len(self.scenario.get_labels()['nl'][0]), 2)
 
         # including only one LabelKey for nl, two for en
         self.l2.include_keys.clear()
@@ -196,9 +636,9 @@ class ScenarioLabelsTest(BaseTestCase):
         self.l2.save()
         run_mds(self.scenario)
         # expecting a tuple of two labels for en
-        self.assertEqual(len(self.scenario.mds_labels['en'][0]), 2)
+        self.assertEqual(len(self.scenario.get_labels()['en'][0]), 2)
         # and a tuple of one label for nl
-        self.assertEqual(len(self.scenario.mds_labels['nl'][0]), 1)
+        self.assertEqual(len(self.scenario.get_labels()['nl'][0]), 1)
 
         # here we will filter by label without including the relevant label key
         annotation = create_annotation(
@@ -216,14 +656,256 @@ class ScenarioLabelsTest(BaseTestCase):
         run_mds(self.scenario)
 
         # nl now includes only one key (self.label_key)
-        self.assertEqual(len(self.scenario.mds_labels['nl'][0]), 1)
-        self.assertEqual(self.scenario.mds_labels['nl'], [('Label:{}'.format(self.label_2.id),),
+        self.assertEqual(len(self.scenario.get_labels()['nl'][0]), 1)
+        self.assertEqual(self.scenario.get_labels()['nl'], [('Label:{}'.format(self.label_2.id),),
                                                           ('Label:{}'.format(label_5.id),)])
 
         # run again, filtering by label_3 whose key (second_key) is not in include_keys
         self.l2.include_labels.add(label_3)
         run_mds(self.scenario)
 
-        self.assertEqual(len(self.scenario.mds_labels['nl'][0]), 1)
+        self.assertEqual(len(self.scenario.get_labels()['nl'][0]), 1)
         # and there should be only one annotation, with labels 5 and 3, but only 5 is visible
-        self.assertEqual(self.scenario.mds_labels['nl'], [('Label:{}'.format(label_5.id),)])
+        self.assertEqual(self.scenario.get_labels()['nl'], [('Label:{}'.format(label_5.id),)])
+
+
+class ScenarioJobTest(ScenarioTenseTest):
+    def test_run_job(self):
+        job = enqueue_scenario(self.scenario, self.u1)
+        # Queueing twice should not create another job
+        self.assertEqual(enqueue_scenario(self.scenario, self.u1), job)
+        self.assertEqual(self.scenario.active_job(), job)
+
+        run_worker(once=True)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ScenarioJob.FINISHED)
+        self.assertEqual(job.progress, 100)
+        self.assertIsNone(self.scenario.active_job())
+
+        self.scenario.refresh_from_db()
+        self.assertIsNotNone(self.scenario.last_run)
+        self.assertEqual(self.scenario.get_model().tolist(), [[0.0, 0.0, 0.0, 0.0, 0.0]])
+
+    def test_requeue_stale_job(self):
+        job = enqueue_scenario(self.scenario)
+        self.assertEqual(claim_job('killed-worker'), job)
+
+        # A job with a recent heartbeat is left alone
+        self.assertEqual(requeue_stale_jobs(), 0)
+        ScenarioJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(requeue_stale_jobs(), 1)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ScenarioJob.FAILED)
+        requeued = self.scenario.active_job()
+        self.assertEqual(requeued.status, ScenarioJob.QUEUED)
+
+        self.assertEqual(requeued.attempt, 2)
+
+        # The Scenario can be run again
+        run_worker(once=True)
+        requeued.refresh_from_db()
+        self.assertEqual(requeued.status, ScenarioJob.FINISHED)
+
+    def test_requeue_stale_job_max_attempts(self):
+        enqueue_scenario(self.scenario)
+        for attempt in range(1, 4):
+            job = claim_job('killed-worker')
+            self.assertEqual(job.attempt, attempt)
+            ScenarioJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+            self.assertEqual(requeue_stale_jobs(max_attempts=3), 1 if attempt < 3 else 0)
+
+        # After the last attempt, the job fails and the Scenario is not queued again
+        job.refresh_from_db()
+        self.assertEqual(job.status, ScenarioJob.FAILED)
+        self.assertIn('3 attempts', job.message)
+        self.assertIsNone(self.scenario.active_job())
+
+    def test_run_job_empty_scenario(self):
+        self.annotation.delete()
+
+        job = enqueue_scenario(self.scenario)
+        run_worker(once=True)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ScenarioJob.FAILED)
+        self.assertIn('empty', job.message)
+
+        self.scenario.refresh_from_db()
+        self.assertIsNone(self.scenario.last_run)
+
+
+class ScenarioStoreTest(SimpleTestCase):
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as data_path, override_settings(SCENARIO_DATA_PATH=data_path):
+            store = ScenarioStore(Scenario(pk=1))
+            self.assertFalse(store.exists())
+
+            labels = {'en': [('Tense:1',), ('Tense:1', 'Label:2'), None],
+                      'nl': [(), ('Label:3',), ('Tense:1',)]}
+            store.write([3, 1, 2], labels, np.arange(6).reshape(3, 2) / 10)
+            self.assertTrue(store.exists())
+            self.assertEqual(store.read_fragments().tolist(), [3, 1, 2])
+            self.assertEqual(store.read_model().tolist(), [[0, .1], [.2, .3], [.4, .5]])
+            self.assertEqual(store.read_labels(), labels)
+            self.assertEqual(store.read_codes().tolist(), [[0, 0], [1, 1], [2, 2]])
+            cube = store.read_cube()
+            self.assertEqual(cube.tuples.tolist(), [0, 1, 2])
+            self.assertEqual(cube.sorted_pks.tolist(), [1, 2, 3])
+            self.assertEqual(cube.find_row(1), 1)
+
+            store.delete()
+            self.assertFalse(store.exists())
+
+    def test_store_versions(self):
+        with tempfile.TemporaryDirectory() as data_path, override_settings(SCENARIO_DATA_PATH=data_path):
+            labels = {'en': [('Tense:1',), ('Tense:2',)]}
+            ScenarioStore(Scenario(pk=1)).write([1, 2], labels, [[0, 0], [1, 1]])
+
+            # A reader keeps reading the version it started with, even if the results are rewritten meanwhile
+            reader = ScenarioStore(Scenario(pk=1))
+            self.assertEqual(reader.read_fragments().tolist(), [1, 2])
+            ScenarioStore(Scenario(pk=1)).write([3, 4, 5], {'en': [None, None, None]}, [[0, 0], [1, 1], [2, 2]])
+            self.assertEqual(reader.read_model().tolist(), [[0, 0], [1, 1]])
+            self.assertEqual(reader.read_labels(), labels)
+            self.assertEqual(ScenarioStore(Scenario(pk=1)).read_model().shape, (3, 2))
+
+            # Only the current and the previous version are kept
+            ScenarioStore(Scenario(pk=1)).write([6], {'en': [None]}, [[0, 0]])
+            versions = [name for name in os.listdir(reader.directory) if name.startswith(reader.VERSION_PREFIX)]
+            self.assertEqual(len(versions), 2)
+            self.assertNotIn(reader.version, versions)
+
+
+class LabelCubeTest(SimpleTestCase):
+    def test_cube(self):
+        labels = {'en': [('Label:1',), ('Label:2',), ('Label:1',), None],
+                  'nl': [('Label:3',), ('Label:4',), ('Label:3',), ('Label:4',)]}
+        cube = LabelCube.from_labels([5, 6, 7, 8], labels)
+        self.assertEqual(cube.label_counts('nl').tolist(), [2, 2])
+        self.assertEqual([rows.tolist() for rows in cube.rows_per_label('en')], [[0, 2], [1], [3]])
+
+        # The tuples are numbered in order of first occurrence
+        self.assertEqual(cube.tuples.tolist(), [0, 1, 0, 2])
+        self.assertEqual(cube.n_tuples(), 3)
+        self.assertEqual(cube.fragment_pks[cube.tuple_rows(0)].tolist(), [5, 7])
+        self.assertEqual(cube.tuple_labels(1), {'en': ('Label:2',), 'nl': ('Label:4',)})
+        self.assertEqual(cube.find_row(8), 3)
+        self.assertIsNone(cube.find_row(9))
+        self.assertEqual(cube.find_tuple(7), 0)
+        self.assertEqual(cube.tuple_fragments(cube.find_tuple(7)), [5, 7])
+
+
+class DistanceMatrixTest(SimpleTestCase):
+    def test_distance_matrix(self):
+        random.seed(0)
+        languages = ['en', 'nl', 'de', 'fr', 'es', 'it', 'pt']
+        choices = [None, (), ('Tense:1',), ('Tense:2',), ('Tense:3',), ('Label:1', 'Label:2')]
+        fragment_labels = {language: [random.choice(choices) for _ in range(60)] for language in languages}
+        labels_matrix = list(zip(*fragment_labels.values()))
+        expected = np.array([[get_distance(l1, l2) for l2 in labels_matrix] for l1 in labels_matrix])
+
+        # Use a small block size to check the blocked computation as well
+        for block_cells in [10, 2 ** 24]:
+            matrix = get_distance_matrix(encode_labels(fragment_labels), block_cells)
+            self.assertTrue(np.array_equal(matrix, expected))
+
+            rows = np.array([3, 17, 42])
+            self.assertTrue(np.array_equal(get_distance_rows(encode_labels(fragment_labels), rows, block_cells),
+                                           expected[rows]))
+
+    def test_smacof(self):
+        codes = np.random.RandomState(0).randint(0, 4, size=(100, 3))
+        matrix = get_distance_matrix(codes)
+
+        pos, stress, history = smacof(matrix, n_components=2, max_iter=1000, eps=1e-6, random_state=0)
+        self.assertEqual(stress, history[-1])
+        self.assertTrue(all(np.diff(history) <= 1e-9))  # SMACOF never increases the stress
+
+        # Starting from the classical solution should not need more iterations than starting from a random one
+        init = classical_mds(matrix, n_components=2)
+        _, classical_stress, classical_history = smacof(matrix, n_components=2, init=init, max_iter=1000, eps=1e-6)
+        self.assertLessEqual(len(classical_history), len(history))
+        self.assertLess(classical_history[0], history[0])
+
+        # A tolerance stops as soon as the relative improvement drops below it
+        _, _, early_history = smacof(matrix, n_components=2, max_iter=1000, eps=1e-6, tolerance=1e-2,
+                                     random_state=0)
+        self.assertLess(len(early_history), len(history))
+        self.assertLess((early_history[-2] - early_history[-1]) / early_history[-2], 1e-2)
+
+    def test_landmark_mds(self):
+        codes = collapse_codes(np.random.RandomState(0).randint(1, 6, size=(300, 3)))[0]
+        matrix = get_distance_matrix(codes)
+
+        landmarks, distances = select_landmarks(codes, 20, random_state=0)
+        self.assertEqual(len(set(landmarks.tolist())), 20)
+        self.assertTrue(np.array_equal(distances, matrix[:, landmarks]))
+
+        # When every point is a landmark, this is classical scaling
+        pos, _, _ = landmark_mds(codes, len(codes), n_components=2, random_state=0)
+        landmarks, _ = select_landmarks(codes, len(codes), random_state=0)
+        expected = classical_mds(matrix[np.ix_(landmarks, landmarks)], n_components=2)
+        self.assertTrue(np.allclose(pos[landmarks], expected))
+
+        # With fewer landmarks, the stress over the pairs of points and landmarks is comparable to classical scaling
+        pos, stress, squares = landmark_mds(codes, 20, n_components=2, random_state=0)
+        self.assertEqual(pos.shape, (len(codes), 2))
+        landmarks, distances = select_landmarks(codes, 20, random_state=0)
+        classical = classical_mds(matrix, n_components=2)
+        classical_distances = np.sqrt(((classical[:, np.newaxis, :] - classical[landmarks]) ** 2).sum(axis=2))
+        self.assertLessEqual(stress, ((classical_distances - distances) ** 2).sum())
+
+    def test_weighted_smacof(self):
+        codes = np.random.RandomState(0).randint(0, 4, size=(200, 3))
+        unique_codes, inverse, counts = collapse_codes(codes)
+        self.assertTrue(np.array_equal(unique_codes[inverse], codes))
+        self.assertEqual(counts.sum(), len(codes))
+
+        pos, stress, _ = smacof(get_distance_matrix(unique_codes), counts, n_components=2,
+                                max_iter=1000, eps=1e-6, random_state=0)
+
+        # The stress of the collapsed problem equals the stress of the expanded solution
+        matrix = get_distance_matrix(codes)
+        expanded = pos[inverse]
+        distances = np.sqrt(((expanded[:, np.newaxis, :] - expanded[np.newaxis, :, :]) ** 2).sum(axis=2))
+        self.assertAlmostEqual(stress, ((distances - matrix) ** 2).sum() / 2, places=6)
+
+
+class PlotTest(SimpleTestCase):
+    def test_reduce_model(self):
+        model = [[0, 0], [0.05, 0], [0.12, 0], [0.05, 0], [0.5, 0.5], [0.55, 0.5], [0.1, 0]]
+        tenses = {'en': [1, 1, 1, 1, 1, 2, 2]}
+
+        # Points are merged with close points with the same labels, a point close to two clusters is counted twice
+        self.assertEqual(reduce_model(model, tenses), [
+            (0, (0, 0), 3),
+            (2, (0.12, 0), 3),
+            (4, (0.5, 0.5), 1),
+            (5, (0.55, 0.5), 1),
+            (6, (0.1, 0), 1),
+        ])
+
+    def test_grid(self):
+        random_state = np.random.RandomState(0)
+        x, y = random_state.normal(0, .1, 1000), random_state.uniform(-1, 1, 1000)
+        groups = (x > 0).astype(int)
+        grid = MultiResolutionGrid(x, y, groups)
+
+        # All points fit the budget
+        level, cells, points = grid.query(-1, 1, -1, 1, 1000)
+        self.assertIsNone(level)
+        self.assertEqual(len(points), 1000)
+
+        # Otherwise, the points are aggregated in cells, and every point is either in a cell or returned
+        for budget in [1, 50, 500]:
+            level, cells, points = grid.query(-1, 1, -1, 1, budget)
+            self.assertLessEqual(len(cells) + len(points), budget)
+            self.assertEqual(grid.levels[level].counts[cells].sum() + len(points), 1000)
+
+        # The points of the cells that are expanded are clipped to the window
+        level, cells, points = grid.query(-.05, .05, -.5, .5, 200)
+        self.assertIsNotNone(level)
+        self.assertTrue(np.all((np.abs(x[points]) <= .05) & (np.abs(y[points]) <= .5)))
+
+        # The dominant group of the top level is the most frequent group
+        self.assertEqual(grid.levels[0].dominant.tolist(), [np.bincount(groups).argmax()])
@@ -1,9 +1,9 @@
 from django.urls import path, re_path
 
 from .views import ScenarioList, ScenarioDetail, ScenarioDownload, ScenarioManual, \
-    MDSView, MDSViewOld, \
+    MDSView, MDSViewOld, MDSDataView, MDSLevelOfDetailView, MDSFragmentsView, \
     DescriptiveStatsView, FragmentTableView, \
-    FragmentTableViewMDS, UpsetView, SankeyView, SankeyManual, CaptchaTestView
+    FragmentTableViewMDS, UpsetView, SankeyView, SankeyManual, CaptchaTestView, LabelCacheStatistics
 
 urlpatterns = [
 
@@ -19,8 +19,13 @@ urlpatterns = [
 
     # Multidimensional Scaling
     re_path(r'^mds/(?P<pk>\d+)/$', MDSView.as_view(), name='mds'),
+    re_path(r'^mds/(?P<pk>\d+)/fragments/$', MDSFragmentsView.as_view(), name='mds_fragments'),
     re_path(r'^mds/(?P<pk>\d+)/(?P<language>\w+)/$', MDSView.as_view(), name='mds'),
     re_path(r'^mds/(?P<pk>\d+)/(?P<language>\w+)/(?P<d1>\d+)/(?P<d2>\d+)/$', MDSView.as_view(), name='mds'),
+    re_path(r'^mds/(?P<pk>\d+)/(?P<language>\w+)/(?P<d1>\d+)/(?P<d2>\d+)/data/$', MDSDataView.as_view(),
+            name='mds_data'),
+    re_path(r'^mds/(?P<pk>\d+)/(?P<language>\w+)/(?P<d1>\d+)/(?P<d2>\d+)/lod/$', MDSLevelOfDetailView.as_view(),
+            name='mds_lod'),
     # ... and similar for the old version
     re_path(r'^mds_old/(?P<pk>\d+)/$', MDSViewOld.as_view(), name='mds_old'),
     re_path(r'^mds_old/(?P<pk>\d+)/(?P<language>\w+)/$', MDSViewOld.as_view(), name='mds_old'),
@@ -43,4 +48,7 @@ urlpatterns = [
 
     # Captcha
     path('captcha/', CaptchaTestView.as_view(), name='captcha_test'),
+
+    # Monitoring
+    path('label_cache/', LabelCacheStatistics.as_view(), name='label_cache'),
 ]
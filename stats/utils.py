@@ -2,15 +2,25 @@
 
 
 import numbers
-from collections import defaultdict
+import os
+import time
 
 import numpy as np
-from sklearn import manifold
 
-from django.db.models import Q, Prefetch
+from django.core.cache import cache
+from django.utils import timezone
 
-from annotations.models import Fragment, Annotation, Tense, Label
+from annotations.models import Tense, Label
 from core.utils import COLOR_LIST
+from .distances import encode_labels, get_distance_matrix, iter_distance_blocks, iter_patched_blocks, \
+    iter_matrix_rows, read_distance_matrix, write_matrix, dequantize
+from .loader import CorpusSnapshot
+from .mds import collapse_codes, classical_mds, landmark_mds, smacof
+from .models import Scenario
+
+
+# Number of seconds the label properties of a Corpus are cached (see prepare_label_cache)
+LABEL_CACHE_TIMEOUT = 24 * 60 * 60
 
 
 class EmptyScenario(Exception):
@@ -21,220 +31,359 @@ class ImproperScenario(Exception):
     pass
 
 
-def run_mds(scenario):
-    languages_from = scenario.languages(as_from=True).prefetch_related('tenses', 'include_keys', 'include_labels')
-    languages_to = scenario.languages(as_to=True).prefetch_related('tenses', 'include_keys', 'include_labels')
+def run_mds(scenario, progress=None, snapshot=None):
+    """
+    Runs Multidimensional Scaling for a Scenario, and stores the results on the Scenario.
+    If SCENARIO_PRECOMPUTE_PLOTS is set, the matrix plots are computed afterwards (see stats.plots.precompute_plots).
+    :param scenario: the Scenario to run
+    :param progress: an optional callback, called with a percentage and a message when a step has been completed
+    :param snapshot: an optional CorpusSnapshot of the Scenario's Corpus to retrieve the labels from.
+    If not given, a snapshot of only the data required for this Scenario is loaded.
+    """
+    def report(percentage, message):
+        if progress:
+            progress(percentage, message)
+
+    # Changes recorded up to now are processed by this run
+    changes = dict(scenario.changes.values_list('fragment_id', 'pk'))
+
+    languages_from, languages_to = scenario_languages(scenario)
 
     # For each Fragment, retrieve the labels per language (as key), using the same order as fragment_pks
-    fragment_pks = []
-    fragment_labels = defaultdict(list)
-
-    for language_from in languages_from:
-        # Retrieve the Fragments
-        fragments = retrieve_fragments(scenario, language_from)
-
-        # Retrieve the Annotations from all ScenarioLanguages (except when they are also used as from-language)
-        languages_to_filtered = languages_to.exclude(language=language_from.language)
-        annotations = retrieve_annotations(scenario, languages_to_filtered, fragments)
-
-        # Retrieve the labels
-        retrieve_labels(scenario, fragments, annotations, languages_to_filtered,
-                        fragment_labels, fragment_pks, language_from)
-
-    # If no from-languages are provided, call the same methods without this parameter
-    if not languages_from:
-        # Retrieve the Fragments
-        fragments = retrieve_fragments(scenario)
-
-        # Retrieve the Annotations from all ScenarioLanguages
-        annotations = retrieve_annotations(scenario, languages_to, fragments)
-
-        # Retrieve the labels
-        retrieve_labels(scenario, fragments, annotations, languages_to,
-                        fragment_labels, fragment_pks)
-
-    # the following creates a transposed matrix of fragment_labels:
-    # in fragment_labels we find a list of labels per language,
-    # while labels_matrix stores the labels per fragment
-    # for example:
-    #
-    # fragment_labels['en'] = [simple past, present perfect, future]
-    # fragment_labels['fr'] = [imparfait, passé composé, futur]
-    # becomes
-    # labels_matrix[0] = [simple past, imparfait]
-    # labels_matrix[1] = [present perfect, passé composé]
-    # labels_matrix[2] = [future, futur]
-    #
-    # this then allows to calculate a distance measure for each item of labels_matrix
-
-    labels_matrix = defaultdict(list)
-    for language_labels in list(fragment_labels.values()):
-        for n, label in enumerate(language_labels):
-            labels_matrix[n].append(label)
-
-    # Create a distance matrix
-    matrix = []
-    for labels_1 in list(labels_matrix.values()):
-        result = []
-        for labels_2 in list(labels_matrix.values()):
-            result.append(get_distance(labels_1, labels_2))
-        matrix.append(result)
-
-    if len(matrix) == 0:
+    if not snapshot:
+        snapshot = CorpusSnapshot(scenario.corpus, scenario)
+    fragment_pks, fragment_labels = snapshot.retrieve_labels(scenario, languages_from, languages_to)
+
+    # Every Fragment should have a (possibly empty) label for every language
+    if len(set(len(language_labels) for language_labels in fragment_labels.values())) > 1:
+        raise ImproperScenario()
+
+    codes = encode_labels(fragment_labels)
+    if len(codes) == 0:
+        raise EmptyScenario()
+    report(25, 'Retrieved the labels of {} fragments'.format(len(codes)))
+
+    if scenario.mds_landmarks:
+        # Only compute the distances between the Fragments and the landmarks
+        pos, stress, squares = scale_landmarks(scenario, codes)
+        history = [stress]
+    else:
+        init = None
+        if scenario.mds_init == Scenario.INIT_PREVIOUS:
+            init = warm_start(scenario, fragment_pks, codes, changes)
+
+        if scenario.mds_collapse_tuples:
+            # Only the distances between the unique tuples are computed
+            pos, stress, history, squares = scale_collapsed(scenario, codes, init)
+        else:
+            # Create a distance matrix: the labels are integer-encoded per language,
+            # which allows to calculate the distance measure (see get_distance) for all pairs of fragments at once.
+            matrix, squares = store_matrix(scenario, codes)
+            report(50, 'Created the distance matrix')
+
+            pos, stress, history = scale(scenario, codes, matrix, init)
+    report(90, 'Performed Multidimensional Scaling')
+
+    store_results(scenario, fragment_pks, fragment_labels, pos, stress, history, squares)
+    if changes:
+        scenario.changes.filter(pk__in=changes.values()).delete()
+
+
+def update_mds(scenario, progress=None):
+    """
+    Updates the results of a Scenario with the Fragments that have changed since its last run (see ScenarioChange).
+    Only the labels of the changed Fragments are retrieved, and only their rows in the distance matrix are recomputed.
+    Multidimensional Scaling is then warm-started from the previous solution.
+    Falls back to a full run if the stored results cannot be updated, e.g. after the configuration has changed.
+    :param scenario: the Scenario to update
+    :param progress: an optional callback, see run_mds
+    :return: the number of changed Fragments that have been processed
+    """
+    def report(percentage, message):
+        if progress:
+            progress(percentage, message)
+
+    changes = dict(scenario.changes.values_list('fragment_id', 'pk'))
+    if not changes:
+        return 0
+
+    languages_from, languages_to = scenario_languages(scenario)
+    old_pks, old_labels, old_model, old_matrix = previous_results(scenario)
+    if not can_update(scenario, old_pks, old_labels, old_model, old_matrix, languages_from, languages_to):
+        run_mds(scenario, progress)
+        return len(changes)
+
+    # Retrieve the labels of the changed Fragments only
+    snapshot = CorpusSnapshot(scenario.corpus, scenario, fragment_pks=list(changes))
+    changed_pks, changed_labels = snapshot.retrieve_labels(scenario, languages_from, languages_to)
+    if changed_pks and set(changed_labels.keys()) != set(old_labels.keys()):
+        run_mds(scenario, progress)
+        return len(changes)
+    report(25, 'Retrieved the labels of {} changed fragments'.format(len(changed_pks)))
+
+    # Patch the rows: drop the Fragments that are no longer included, replace the labels of the changed Fragments,
+    # and append the Fragments that are new to the Scenario
+    languages = list(old_labels.keys())
+    changed_rows = {pk: row for row, pk in enumerate(changed_pks)}
+    kept = [row for row, pk in enumerate(old_pks) if pk not in changes or pk in changed_rows]
+
+    fragment_pks = [old_pks[row] for row in kept]
+    fragment_labels = {language: [old_labels[language][row] for row in kept] for language in languages}
+    positions = {pk: position for position, pk in enumerate(fragment_pks)}
+    for pk, row in changed_rows.items():
+        if pk not in positions:
+            positions[pk] = len(fragment_pks)
+            fragment_pks.append(pk)
+            for language in languages:
+                fragment_labels[language].append(None)
+        for language in languages:
+            fragment_labels[language][positions[pk]] = changed_labels[language][row]
+
+    codes = encode_labels(fragment_labels)
+    if len(codes) == 0:
         raise EmptyScenario()
 
-    # Perform Multidimensional Scaling, keep the settings as close to the SMACOF implementation in R
-    mds = manifold.MDS(n_components=scenario.mds_dimensions,
-                       dissimilarity='precomputed',
-                       n_init=1, max_iter=1000, eps=1e-6)
-    matrix = np.array(matrix)
-    pos = mds.fit_transform(matrix)
+    # Warm-start from the previous solution
+    init = warm_start(scenario, fragment_pks, codes, changes, old_pks, old_model)
+
+    # Copy the distances of the kept Fragments from the previous matrix,
+    # and only recompute the rows (and columns) of the changed Fragments
+    changed = np.array(sorted(positions[pk] for pk in changed_pks), dtype=np.int64)
+    matrix, squares = store_matrix(scenario, codes, iter_patched_blocks(old_matrix, kept, codes, changed))
+    report(50, 'Updated the distance matrix')
+
+    pos, stress, history = scale(scenario, codes, matrix, init)
+    report(90, 'Performed Multidimensional Scaling')
+
+    store_results(scenario, fragment_pks, fragment_labels, pos, stress, history, squares)
+    scenario.changes.filter(pk__in=changes.values()).delete()
+    return len(changes)
+
+
+def scenario_languages(scenario):
+    """
+    :return: the from-languages and to-languages of a Scenario, with the data required by the CorpusSnapshot
+    """
+    languages_from = scenario.languages(as_from=True).prefetch_related('tenses', 'include_keys', 'include_labels')
+    languages_to = scenario.languages(as_to=True).prefetch_related('tenses', 'include_keys', 'include_labels')
+    return languages_from, languages_to
+
+
+def previous_results(scenario):
+    """
+    :return: the Fragment pks, labels, model and distance matrix of the previous run of a Scenario
+    """
+    fragment_pks = scenario.get_fragments()
+    if not fragment_pks:
+        return None, None, None, None
+    return fragment_pks, scenario.get_labels(), scenario.get_model(), scenario.get_matrix()
+
+
+def can_update(scenario, fragment_pks, fragment_labels, model, matrix, languages_from, languages_to):
+    """
+    Checks whether the previous results of a Scenario match its configuration, and can thus be updated incrementally.
+    """
+    if not fragment_pks or model is None or matrix is None or scenario.mds_landmarks:
+        return False
+    n_fragments = len(fragment_pks)
+    if model.shape != (n_fragments, scenario.mds_dimensions) or matrix.shape != (n_fragments, n_fragments):
+        return False
+
+    # The languages should not have changed, and the labels should be stored as tuples (see get_labels)
+    isos = set(sl.language.iso for sl in list(languages_from) + list(languages_to))
+    if set(fragment_labels.keys()) != isos or any(len(values) != n_fragments for values in fragment_labels.values()):
+        return False
+    return all(value is None or isinstance(value, tuple)
+               for values in fragment_labels.values() for value in values[:1])
+
+
+def store_matrix(scenario, codes, blocks=None):
+    """
+    Stores the distance matrix of a Scenario, either in a memory-mapped file on disk or (deprecated) in the database.
+    The matrix is computed and written in blocks of rows.
+    :param blocks: the blocks of the matrix, see stats.distances.iter_distance_blocks
+    :return: the distance matrix, and the sum of the squared distances
+    """
+    if blocks is None:
+        blocks = iter_distance_blocks(codes)
 
-    # Pickle the created objects
+    if scenario.matrix_on_disk():
+        scenario.mds_matrix = None
+        squares = write_matrix(blocks, len(codes), scenario.matrix_filename(), scenario.mds_matrix_storage)
+        return read_distance_matrix(scenario.matrix_filename(), scenario.mds_matrix_storage, len(codes)), squares
+
+    matrix = np.empty((len(codes), len(codes)), dtype=np.float64)
+    for start, stop, block in blocks:
+        matrix[start:stop] = block
     scenario.mds_matrix = matrix
-    scenario.mds_fragments = fragment_pks
-    scenario.mds_labels = fragment_labels
+    return matrix, (matrix.ravel() ** 2).sum()
+
+
+def warm_start(scenario, fragment_pks, codes, changed=(), old_pks=None, old_model=None):
+    """
+    Creates a starting configuration from the previous solution of a Scenario.
+    Fragments that are new or have changed start at the position of an unchanged Fragment with the same labels.
+    Otherwise, changed Fragments keep their previous position, and new Fragments start near the centroid.
+    :param changed: the pks of the Fragments that have changed since the previous run
+    :param old_pks: the Fragment pks of the previous run, retrieved from the Scenario if not given
+    :param old_model: the model of the previous run, retrieved from the Scenario if not given
+    :return: the starting configuration, or None if there is no (compatible) previous solution
+    """
+    n_dimensions = scenario.mds_dimensions
+    if old_pks is None:
+        old_pks, old_model = scenario.get_fragments(), scenario.get_model()
+    if not old_pks or old_model is None or old_model.shape != (len(old_pks), n_dimensions):
+        return None
+
+    model = np.asarray(old_model, dtype=np.float64)
+    rows = {pk: row for row, pk in enumerate(old_pks)}
+
+    init = np.empty((len(fragment_pks), n_dimensions), dtype=np.float64)
+    unknown = []
+    unchanged = dict()
+    for position, pk in enumerate(fragment_pks):
+        if pk in rows and pk not in changed:
+            init[position] = model[rows[pk]]
+            unchanged.setdefault(codes[position].tobytes(), position)
+        else:
+            unknown.append((position, pk))
+
+    centroid = model.mean(axis=0)
+    random_state = np.random.RandomState(len(fragment_pks))
+    for position, pk in unknown:
+        same = unchanged.get(codes[position].tobytes())
+        if same is not None:
+            init[position] = init[same]
+        elif pk in rows:
+            init[position] = model[rows[pk]]
+        else:
+            init[position] = centroid + random_state.uniform(-.01, .01, size=n_dimensions)
+    return init
+
+
+def scale(scenario, codes, matrix, init=None):
+    """
+    Performs Multidimensional Scaling on the distance matrix of a Scenario.
+    The settings are kept as close to the SMACOF implementation in R as possible.
+    :param matrix: the (possibly memory-mapped) distance matrix, see store_matrix
+    :param init: an optional starting configuration, if not given, the configured starting configuration is used
+    :return: the coordinates of the Fragments, the (raw) stress and the stress after every iteration
+    """
+    start = time.time()
+    # A matrix stored in single precision (or quantized) is scaled in single precision, see smacof
+    pos, stress, history = run_smacof(scenario, dequantize(np.asarray(matrix), np.float32), init=init)
+    scenario.mds_duration = time.time() - start
+    return pos, stress, history
 
-    # Normalize stress as per https://stackoverflow.com/a/47501135
-    scenario.mds_stress = np.nan_to_num(np.sqrt(mds.stress_ / ((matrix.ravel() ** 2).sum() / 2)))
 
-    # Pickle the model. Rounding here helps cluster points which are very close,
-    # and also prevents loss of accuracy from serialization and deserialization of numpy arrays
-    scenario.mds_model = pos.round(3).tolist()
+def scale_collapsed(scenario, codes, init=None):
+    """
+    Performs Multidimensional Scaling on the unique tuples of a Scenario only, weighted by the number of Fragments,
+    and expands the solution. Only the distances between the unique tuples are computed, the full distance matrix is
+    never built (see Scenario.get_collapsed_matrix).
+    :param init: an optional starting configuration for the Fragments
+    :return: the coordinates of the Fragments, the (raw) stress, the stress after every iteration,
+    and the sum of the squared distances of the full matrix
+    """
+    start = time.time()
+    remove_matrix(scenario)
+
+    unique_codes, inverse, weights = collapse_codes(codes)
+    matrix = get_distance_matrix(unique_codes)
+    # Every pair of tuples occurs (weight x weight) times in the full matrix
+    squares = weights @ (matrix ** 2) @ weights
+    if init is not None:
+        _, first = np.unique(inverse, return_index=True)
+        init = init[first]
+
+    pos, stress, history = run_smacof(scenario, matrix, weights, init)
+    scenario.mds_duration = time.time() - start
+    return pos[inverse], stress, history, squares
+
+
+def run_smacof(scenario, matrix, weights=None, init=None):
+    """
+    Runs SMACOF with the settings of a Scenario, which are kept as close to the implementation in R as possible.
+    """
+    if init is None and scenario.mds_init == Scenario.INIT_CLASSICAL:
+        init = classical_mds(matrix, n_components=scenario.mds_dimensions)
+
+    return smacof(matrix, weights, n_components=scenario.mds_dimensions, init=init,
+                  max_iter=scenario.mds_max_iter, eps=1e-6, tolerance=scenario.mds_tolerance)
+
+
+def remove_matrix(scenario):
+    """
+    Removes the distance matrix of a previous run of a Scenario.
+    """
+    scenario.mds_matrix = None
+    if scenario.matrix_on_disk() and os.path.exists(scenario.matrix_filename()):
+        os.remove(scenario.matrix_filename())
+
 
+def scale_landmarks(scenario, codes):
+    """
+    Performs Landmark Multidimensional Scaling for a Scenario. The landmarks are selected from the unique tuples.
+    :return: the coordinates of the Fragments, the (raw) stress and the sum of the squared distances,
+    the latter two computed over the pairs of Fragments and landmarks
+    """
+    start = time.time()
+
+    # The full distance matrix is never created: remove any matrix from a previous run
+    remove_matrix(scenario)
+
+    unique_codes, inverse, counts = collapse_codes(codes)
+    unique_pos, stress, squares = landmark_mds(unique_codes, scenario.mds_landmarks,
+                                               n_components=scenario.mds_dimensions, weights=counts, random_state=0)
+
+    scenario.mds_duration = time.time() - start
+    # Every pair is counted once, whereas store_results expects the squares of the full (symmetric) matrix
+    return unique_pos[inverse], stress, 2 * squares
+
+
+def store_results(scenario, fragment_pks, fragment_labels, pos, stress, history, squares):
+    # Store the model in the ScenarioStore. Rounding here helps cluster points which are very close.
+    scenario.results().write(fragment_pks, fragment_labels, pos.round(3))
+
+    # The results are no longer pickled in the database
+    scenario.mds_model = None
+    scenario.mds_fragments = None
+    scenario.mds_labels = None
+
+    # Normalize stress as per https://stackoverflow.com/a/47501135
+    scenario.mds_stress = np.nan_to_num(np.sqrt(stress / (squares / 2)))
+    scenario.mds_stress_history = np.nan_to_num(np.sqrt(np.array(history) / (squares / 2))).tolist()
+
+    # The cached plots (see stats.plots) are keyed on the last run
+    scenario.last_run = timezone.now()
     scenario.save()
 
+    from .plots import precompute_plots
+    precompute_plots(scenario)
 
-def retrieve_fragments(scenario, language_from=None):
-    # Fetch all Fragments, filter on Corpus and Language, prefetch Language, Tense, and Labels
-    if language_from and language_from.include_keys.all():
-        filtered_labels = Label.objects.filter(key__in=language_from.include_keys.all())
-    else:
-        filtered_labels = Label.objects.all()
-    fragments = Fragment.objects \
-        .filter(document__corpus=scenario.corpus) \
-        .select_related('language', 'tense') \
-        .prefetch_related(Prefetch('labels', queryset=filtered_labels, to_attr='labels_prefetched'))
-
-    # Filter on the from-language (if set)
-    if language_from:
-        fragments = fragments.filter(language=language_from.language)
-
-    # Filter on Documents (if selected)
-    if scenario.documents.exists():
-        fragments = fragments.filter(document__in=scenario.documents.all())
-
-    # Filter on SubCorpora (if selected)
-    if scenario.subcorpora.exists():
-        for subcorpus in scenario.subcorpora.all():
-            fragments = fragments.filter(pk__in=subcorpus.get_fragments())
-
-    # Filter on formal structure (if selected)
-    if scenario.formal_structure != Fragment.FS_NONE:
-        fragments = fragments.filter(formal_structure=scenario.formal_structure)
-
-    # Filter on sentence function (if selected)
-    if scenario.sentence_function != Fragment.SF_NONE:
-        fragments = fragments.filter(sentence_function=scenario.sentence_function)
-
-    # Filter on Tenses (if selected)
-    if language_from and language_from.use_tenses and language_from.tenses.exists():
-        fragments = fragments.filter(tense__in=language_from.tenses.all())
-
-    # Filter on Labels (if selected)
-    if language_from and language_from.use_labels and language_from.include_labels.exists():
-        fragments = fragments.filter(labels__in=language_from.include_labels.all())
-
-    return fragments
-
-
-def retrieve_annotations(scenario, languages_to, fragments):
-    result = Annotation.objects.none()
-    for language_to in languages_to:
-        # Fetch the correct Annotations per Language, prefetch Fragment, Language, Tense, and Labels
-        if language_to.include_keys.all():
-            filtered_labels = Label.objects.filter(key__in=language_to.include_keys.all())
-        else:
-            filtered_labels = Label.objects.all()
-        annotations = Annotation.objects \
-            .exclude(Q(tense=None) & Q(labels=None)) \
-            .filter(is_no_target=False, is_translation=True) \
-            .filter(alignment__original_fragment__in=fragments) \
-            .filter(alignment__translated_fragment__language=language_to.language) \
-            .select_related('alignment__original_fragment',
-                            'alignment__translated_fragment__language',
-                            'tense') \
-            .prefetch_related(Prefetch('labels', queryset=filtered_labels, to_attr='labels_prefetched'))
-
-        # Filter on formal structure (if selected)
-        if scenario.formal_structure != Fragment.FS_NONE and scenario.formal_structure_strict:
-            annotations = annotations.filter(is_not_same_structure=False)
-
-        # Filter on Tenses (if selected)
-        if language_to.use_tenses and language_to.tenses.exists():
-            annotations = annotations.filter(~Q(alignment__translated_fragment__language=language_to.language) |
-                                             Q(tense__in=language_to.tenses.all()))
-
-        # Filter on labels (if selected)
-        if language_to.use_labels and language_to.include_labels.exists():
-            annotations = annotations.filter(~Q(alignment__translated_fragment__language=language_to.language) |
-                                             Q(labels__in=language_to.include_labels.all()))
-
-        result |= annotations
-
-    return result
-
-
-def retrieve_labels(scenario, fragments, annotations, languages_to, fragment_labels, fragment_pks, language_from=None):
-    # Create a dict of Fragment -> Annotations for lookup in the for-loop below
-    annotations_dict = defaultdict(list)
-    for annotation in annotations:
-        annotations_dict[annotation.alignment.original_fragment.pk].append(annotation)
-
-    # For every Fragment, retrieve the Annotations and its labels
-    for fragment in fragments:
-        fragment_annotations = annotations_dict.get(fragment.pk)
-        if not fragment_annotations:
-            # No Annotations at all, skip Fragment
-            continue
 
-        # Compile a list of Annotations...
-        annotated_labels = dict()
-        for language_to in languages_to:
-            language_annotations = []
-            for fa in fragment_annotations:
-                if fa.alignment.translated_fragment.language == language_to.language:
-                    language_annotations.append(fa)
-
-            if language_annotations:
-                # TODO: For now, we only have one Annotation per Fragment. This might change in the future.
-                a = language_annotations[0]
-                a_language = language_to.language.iso
-                a_label = get_labels(a, language_to)
-                if a_label:
-                    annotated_labels[a_language] = a_label
-
-        # ... but only allow Fragments that have Annotations in all languages
-        # unless the scenario allows partial tuples.
-        if scenario.mds_allow_partial or len(annotated_labels) == len(languages_to):
-            fragment_pks.append(fragment.pk)
-
-            # store label of source language
-            if language_from:
-                from_labels = get_labels(fragment, language_from)
-                fragment_labels[fragment.language.iso].append(from_labels)
-
-            # store label(s) of target language(s)
-            for language in languages_to:
-                key = language.language.iso
-                fragment_labels[key].append(annotated_labels.get(key))
-
-
-def get_labels(model, scenario_language):
-    return model.get_labels(as_pk=True,
-                            include_tense=scenario_language.use_tenses,
-                            include_labels=scenario_language.use_labels,
-                            include_keys=scenario_language.include_keys.all())
+def convert_results(scenario):
+    """
+    Moves the pickled results of a Scenario to the ScenarioStore, and a distance matrix stored in the database to disk.
+    :return: whether the Scenario had pickled results to convert
+    """
+    if scenario.mds_fragments is None:
+        return False
+
+    if scenario.mds_matrix is not None and not scenario.matrix_on_disk():
+        matrix = np.asarray(scenario.mds_matrix, dtype=np.float64)
+        scenario.mds_matrix_storage = Scenario.MATRIX_FLOAT64
+        write_matrix(iter_matrix_rows(matrix), len(matrix), scenario.matrix_filename(), scenario.mds_matrix_storage)
+
+    model = np.asarray(scenario.mds_model if scenario.mds_model is not None else [], dtype=np.float64)
+    scenario.results().write(scenario.mds_fragments, scenario.mds_labels or dict(), model)
+
+    scenario.mds_matrix = None
+    scenario.mds_model = None
+    scenario.mds_fragments = None
+    scenario.mds_labels = None
+    scenario.save()
+    return True
 
 
 def get_distance(array1, array2):
@@ -279,6 +428,8 @@ def copy_scenario(request, scenario):
     copy_scenario.mds_fragments = None
     copy_scenario.mds_labels = None
     copy_scenario.mds_stress = None
+    copy_scenario.mds_stress_history = None
+    copy_scenario.mds_duration = None
     copy_scenario.last_run = None
     copy_scenario.save()
 
@@ -371,15 +522,83 @@ def get_label_properties_from_cache(identifier, label_cache, seq=0, allow_empty=
 def prepare_label_cache(corpus):
     """
     Prepares the Tense/Label cache for a Corpus that is used in get_label_properties_from_cache.
+    The properties are shared between requests (and processes) through Django's cache framework.
+    Cached properties are invalidated by changes to Tenses and Labels, see stats.signals.
     :param corpus: The given Corpus.
     :return: A dictionary with label, colors and categories per label identifier.
     """
-    cache = {'Tense:{}'.format(t.pk): (t.title, t.category.color, t.category.title)
-             for t in Tense.objects.select_related('category')}
+    key = label_cache_key('corpus', corpus.pk, label_cache_version())
+    properties = cache.get(key)
+    if properties is None:
+        count_label_cache('misses')
+        properties = build_label_cache(corpus)
+        cache.set(key, properties, LABEL_CACHE_TIMEOUT)
+    else:
+        count_label_cache('hits')
+
+    # Return a copy, as get_label_properties_from_cache adds the identifiers that are not in the cache
+    return dict(properties)
+
+
+def build_label_cache(corpus):
+    """
+    Retrieves the properties of all Tenses, and of the Labels in a Corpus.
+    Tenses are also keyed on their pk, for older Scenarios that identify Tenses by their pk (see Scenario.get_labels).
+    """
+    properties = dict()
+    for t in Tense.objects.select_related('category'):
+        properties['Tense:{}'.format(t.pk)] = properties[t.pk] = (t.title, t.category.color, t.category.title)
     for i, label in enumerate(Label.objects.filter(key__corpora=corpus)):
         color = label.color if label.color is not None else COLOR_LIST[i % len(COLOR_LIST)]
-        cache['Label:{}'.format(label.pk)] = label.title, color, None
-    return cache
+        properties['Label:{}'.format(label.pk)] = label.title, color, None
+    return properties
+
+
+def label_cache_key(*parts):
+    return ':'.join(['stats', 'label_cache'] + [str(part) for part in parts])
+
+
+def label_cache_version():
+    """
+    :return: the current version of the label cache, cached properties of previous versions are no longer used
+    """
+    version = cache.get(label_cache_key('version'))
+    if version is None:
+        # Start from the current time, so that properties cached before the version was evicted are not reused
+        cache.add(label_cache_key('version'), int(time.time() * 1000), None)
+        version = cache.get(label_cache_key('version'))
+    return version
+
+
+def invalidate_label_cache():
+    """
+    Invalidates the cached properties of all Corpora.
+    """
+    try:
+        cache.incr(label_cache_key('version'))
+    except ValueError:
+        label_cache_version()
+
+
+def count_label_cache(counter):
+    try:
+        cache.incr(label_cache_key(counter))
+    except ValueError:
+        cache.add(label_cache_key(counter), 1, None)
+
+
+def label_cache_statistics():
+    """
+    :return: the number of hits and misses of the label cache, and its current version
+    """
+    hits = cache.get(label_cache_key('hits'), 0)
+    misses = cache.get(label_cache_key('misses'), 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / (hits + misses) if hits + misses else None,
+        'version': label_cache_version(),
+    }
 
 
 def get_color(tense, seq=0):
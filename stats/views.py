@@ -1,31 +1,34 @@
+import hashlib
 import json
-import math
 import numbers
 import os
-import random
 from collections import Counter, OrderedDict, defaultdict
-from itertools import chain, repeat, count
-from zipfile import ZipFile
+
+import numpy as np
 
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import PermissionDenied
 from django.db.models import Case, When, Prefetch
-from django.http import Http404, HttpResponseRedirect, HttpResponse
+from django.http import Http404, HttpResponseRedirect, HttpResponse, HttpResponseBadRequest, JsonResponse, \
+    FileResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from django.views import generic
 from django_filters.views import FilterView
 
-from annotations.models import Corpus, Fragment, Language, Tense, TenseCategory, Sentence, Word, Annotation
+from annotations.models import Corpus, Fragment, Language, Tense, TenseCategory, Sentence, Word
 from annotations.utils import get_available_corpora
-from core.mixins import LimitedPublicAccessMixin
-from core.utils import HTML
+from core.mixins import LimitedPublicAccessMixin, SuperuserRequiredMixin
 from .filters import ScenarioFilter, FragmentFilter, PublicScenarioFilter
 from .forms import CaptchaForm
-from .management.commands.scenario_to_feather import export_matrix, export_fragments, export_tensecats
-from .models import Scenario, ScenarioLanguage
-from .utils import get_label_properties_from_cache, prepare_label_cache
+from .management.commands.scenario_to_feather import export_zip
+from .models import Scenario, ScenarioLanguage, ScenarioJob
+from .plots import plot_payload, plot_binary, plot_cache_key, level_of_detail_payload, render_fragments
+from .sankey import sankey_payload
+from .utils import get_label_properties_from_cache, prepare_label_cache, label_cache_statistics
 
 
 class ScenarioList(LimitedPublicAccessMixin, FilterView):
@@ -47,14 +50,17 @@ class ScenarioList(LimitedPublicAccessMixin, FilterView):
 
         languages_from = ScenarioLanguage.objects.filter(as_from=True).select_related('language')
         languages_to = ScenarioLanguage.objects.filter(as_to=True).select_related('language')
+        active_jobs = ScenarioJob.objects.filter(status__in=[ScenarioJob.QUEUED, ScenarioJob.RUNNING])
         return Scenario.objects \
             .filter(**scenario_list_kwargs) \
             .exclude(last_run__isnull=True) \
             .select_related('corpus') \
             .prefetch_related(Prefetch('scenariolanguage_set', queryset=languages_from, to_attr='languages_from'),
-                              Prefetch('scenariolanguage_set', queryset=languages_to, to_attr='languages_to')) \
+                              Prefetch('scenariolanguage_set', queryset=languages_to, to_attr='languages_to'),
+                              Prefetch('jobs', queryset=active_jobs, to_attr='active_jobs')) \
             .order_by('corpus__title') \
-            .defer('mds_model', 'mds_matrix', 'mds_fragments', 'mds_labels')  # Don't fetch the PickledObjectFields
+            .defer('mds_model', 'mds_matrix', 'mds_fragments', 'mds_labels',
+                   'mds_stress_history')  # Don't fetch the PickledObjectFields
 
     def get_filterset_class(self):
         return ScenarioFilter if self.request.user.is_authenticated else PublicScenarioFilter
@@ -70,7 +76,8 @@ class ScenarioDetail(LimitedPublicAccessMixin, generic.DetailView):
         """
         qs = Scenario.objects \
             .select_related('corpus') \
-            .defer('mds_model', 'mds_matrix', 'mds_fragments', 'mds_labels')  # Don't fetch the PickledObjectFields
+            .defer('mds_model', 'mds_matrix', 'mds_fragments', 'mds_labels',
+                   'mds_stress_history')  # Don't fetch the PickledObjectFields
         scenario = super().get_object(qs)
         lack_access_to_corpus = scenario.corpus not in get_available_corpora(self.request.user)
         if lack_access_to_corpus:
@@ -99,7 +106,7 @@ class ScenarioManual(generic.TemplateView):
 
         first_scenario = Scenario.objects \
             .exclude(last_run=None) \
-            .defer('mds_model', 'mds_matrix', 'mds_fragments', 'mds_labels') \
+            .defer('mds_model', 'mds_matrix', 'mds_fragments', 'mds_labels', 'mds_stress_history') \
             .first()
 
         context['scenario'] = first_scenario
@@ -111,177 +118,75 @@ class MDSView(ScenarioDetail):
     """Loads the matrix plot view"""
     model = Scenario
     template_name = 'stats/mds.html'
+    # The data of the plot is retrieved in a binary format (see MDSDataView), rather than embedded in the page
+    embed_data = False
+    # Plots with more points than this are drawn at a level of detail for the visible window (see MDSLevelOfDetailView)
+    level_of_detail_threshold = 5000
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-
-        # Retrieve kwargs
-        scenario = self.object
+    def get_plot_parameters(self, scenario):
+        """
+        Retrieves the display language, the dimensions and whether to cluster the points from the request.
+        :return: a tuple of the display language, the dimensions on the x- and y-axis, whether to cluster the points,
+        and the number of dimensions of the model
+        """
         default_language = scenario.languages().order_by('language__iso').first()
         display_language = self.kwargs.get('language', default_language.language.iso)
         # We choose dimensions to be 1-based
         d1 = int(self.kwargs.get('d1', 1))
         d2 = int(self.kwargs.get('d2', 2))
+        clustering = self.request.GET.get('clustering', 'on') == 'on'
 
         # Check whether the languages provided are correct, and included in this Scenario
         language_object = get_object_or_404(Language, iso=display_language)
         if language_object not in [sl.language for sl in scenario.languages()]:
             raise Http404('Language {} does not exist in Scenario {}'.format(language_object, scenario.pk))
 
-        # Retrieve pickled data
-        model = scenario.mds_model
-        tenses = scenario.get_labels()
-        fragment_pks = scenario.mds_fragments
+        # Check whether the dimensions are included in the model
+        dimensions = scenario.get_model().shape[1]
+        if not 1 <= d1 <= dimensions or not 0 <= d2 <= dimensions:
+            raise Http404('Dimensions {} and {} do not exist in Scenario {}'.format(d1, d2, scenario.pk))
 
-        # Solution to preserve order taken from https://stackoverflow.com/a/37648265
-        preserved = Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(fragment_pks)])
-        fragments = list(Fragment.objects.filter(pk__in=fragment_pks).
-                         order_by(preserved).
-                         prefetch_related('sentence_set', 'sentence_set__word_set'))
+        return display_language, d1, d2, clustering, dimensions
 
-        # Turn the pickled model into a scatterplot dictionary
-        points = defaultdict(list)
-        clusters = []
-        label_cache = prepare_label_cache(self.object.corpus)
-        label_set = set()
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
 
-        clustering = self.request.GET.get('clustering', 'on') == 'on'
+        # Retrieve kwargs
+        scenario = self.object
+        display_language, d1, d2, clustering, dimensions = self.get_plot_parameters(scenario)
         cluster_labels = self.request.GET.get('labels', 'on') == 'on'
         hulls = self.request.GET.get('hulls', 'on') == 'on'
-        if clustering:
-            reduced = self.reduce_model(model, tenses)
-        else:
-            # Keep original data points as-is
-            # (which is the same as having all clusters as size 1)
-            reduced = zip(count(), model, repeat(1))
-            random.seed(scenario.pk)  # Fixed seed for random jitter
-
-        for n, embedding, cluster_size in reduced:
-            # Retrieve x/y dimensions, add some jitter
-            x = embedding[d1 - 1]
-            y = 0
-            if not clustering:
-                x += random.uniform(-.5, .5) / 100
-                y += random.uniform(-.5, .5) / 100
-            if d2 > 0:  # Only add y if it's been requested
-                y += embedding[d2 - 1]
-
-            cluster_id = len(clusters)
-            clusters.append(dict(x=x, y=y, count=cluster_size))
-
-            try:
-                fragment = fragments[n]
-
-                # Retrieve the labels of all languages in this context
-                ts = [tenses[language][n] for language in list(tenses.keys())]
-                # flatten
-                label_list = []
-                for t in ts:
-                    label, _, _ = get_label_properties_from_cache(t, label_cache, len(label_set))
-                    label_list.append(label.replace('<', '&lt;').replace('>', '&gt;'))
-                    label_set.add(label)
-
-                # Add all values to the dictionary
-                points[tenses[display_language][n]].append(
-                    {'cluster': cluster_id, 'x': x, 'y': y,
-                     'tenses': label_list, 'fragment_pk': fragment.pk, 'fragment': fragment.full(HTML)})
-
-            except IndexError:
-                messages.error(self.request, 'Some of the Fragments in this Scenario have been deleted. '
-                                             'Please rerun your Scenario.')
-                break
 
         context['language'] = display_language
-        context['languages'] = Language.objects.filter(iso__in=list(tenses.keys())).order_by('iso')
+        context['languages'] = Language.objects.filter(pk__in=scenario.languages().values('language')).order_by('iso')
         context['d1'] = d1
         context['d2'] = d2
         context['clustering'] = 'on' if clustering else 'off'
         context['cluster_labels'] = 'on' if cluster_labels else 'off'
         context['hulls'] = 'on' if hulls else 'off'
-        context['max_dimensions'] = list(range(1, len(model[0]) + 1))  # We choose dimensions to be 1-based
+        context['max_dimensions'] = list(range(1, dimensions + 1))  # We choose dimensions to be 1-based
         context['stress'] = scenario.mds_stress
 
-        # flat data representation for d3
-        flat_data, series_list = self.prepare_flat_data(points, label_cache)
-        context['flat_data'] = json.dumps(flat_data)
-        context['series_list'] = json.dumps(series_list)
-        context['clusters'] = json.dumps(clusters)
+        if self.embed_data:
+            # Retrieve the (cached) payload of the plot
+            payload = plot_payload(scenario, display_language, d1, d2, clustering)
+            if not payload['complete']:
+                messages.error(self.request, 'Some of the Fragments in this Scenario have been deleted. '
+                                             'Please rerun your Scenario.')
+
+            # flat data representation for d3
+            context['flat_data'] = payload['flat_data']
+            context['series_list'] = payload['series_list']
+            context['clusters'] = payload['clusters']
+        else:
+            context['data_url'] = '{}?clustering={}'.format(
+                reverse('stats:mds_data', args=(scenario.pk, display_language, d1, d2)), context['clustering'])
+            context['lod_url'] = reverse('stats:mds_lod', args=(scenario.pk, display_language, d1, d2))
+            context['lod_threshold'] = self.level_of_detail_threshold
+            context['lod_budget'] = MDSLevelOfDetailView.default_budget
 
         return context
 
-    def reduce_model(self, model, tenses):
-        cluster_count = defaultdict(int)
-        collect = dict()
-        # First, reduce points which overlap exactly
-        for n, embedding in enumerate(model):
-            t = tuple(embedding)
-            collect[t] = (n, t)
-            cluster_count[t] += 1
-
-        # Reduce points which are very close
-        skip = set()
-
-        # Distance helper function
-        def distance(origin):
-            def _distance(other):
-                d = 0
-                for a, b in zip(origin, other):
-                    d += (a - b) ** 2
-                d = math.sqrt(d)
-                return 0.1 > d > 0
-
-            return _distance
-
-        # Look among close points for overlap in label tuples
-        for coord, point in collect.items():
-            if coord in skip:
-                continue
-            close_by = filter(distance(coord), collect.keys())
-            for other_coord in close_by:
-                sequence = point[0]
-                tenses_a = tuple(tenses[language][sequence] for language in list(tenses.keys()))
-                other_sequence = collect[other_coord][0]
-                tenses_b = tuple(tenses[language][other_sequence] for language in list(tenses.keys()))
-
-                if tenses_a == tenses_b:
-                    skip.add(other_coord)
-                    # merge clusters
-                    cluster_count[coord] += cluster_count[other_coord]
-
-        return [(n, embedding, cluster_count[embedding]) for n, embedding in collect.values() if embedding not in skip]
-
-    def prepare_flat_data(self, points, label_cache):
-        # Transpose the dictionary to the correct format for nvd3.
-        # TODO: can this be done in the loop above?
-        matrix = []
-        labels = set()
-        for identifier, values in list(points.items()):
-            label, color, _ = get_label_properties_from_cache(identifier, label_cache, len(labels))
-            labels.add(label)
-
-            d = dict()
-            d['key'] = label
-            d['color'] = color
-            d['values'] = values
-            matrix.append(d)
-
-        # flat data representation for d3
-        flat_data = []
-        series_list = []
-        for series in matrix:
-            series_list.append(
-                {'key': series['key'], 'color': series['color']}
-            )
-            for fragment in series['values']:
-                s = {'key': series['key'], 'color': series['color']}
-                flat_data.append(
-                    dict(chain(
-                        iter(s.items()),
-                        iter(fragment.items())
-                    ))
-                )
-        return flat_data, series_list
-
     def post(self, request, pk, *args, **kwargs):
         request.session['scenario_pk'] = pk
         request.session['fragment_pks'] = json.loads(request.POST['fragment_ids'])
@@ -291,6 +196,78 @@ class MDSView(ScenarioDetail):
 class MDSViewOld(MDSView):
     """Loads the matrix plot view, previous version (for the sake of comparison and nostalgia)"""
     template_name = 'stats/mds_old.html'
+    embed_data = True
+
+
+class MDSDataView(MDSView):
+    """
+    Returns the data of the matrix plot in a binary format (see stats.plots.encode_plot_data).
+    The response can be cached by the browser, but has to be revalidated: it changes when the Scenario is rerun,
+    or when its labels have changed.
+    """
+
+    def get(self, request, *args, **kwargs):
+        scenario = self.object = self.get_object()
+        display_language, d1, d2, clustering, _ = self.get_plot_parameters(scenario)
+
+        key = plot_cache_key(scenario, display_language, d1, d2, clustering, 'binary')
+        etag = quote_etag(hashlib.md5(key.encode('utf-8')).hexdigest())
+        last_modified = int(scenario.last_run.timestamp())
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = HttpResponse(plot_binary(scenario, display_language, d1, d2, clustering),
+                                    content_type='application/octet-stream')
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class MDSLevelOfDetailView(MDSView):
+    """
+    Returns the matrix plot downsampled to a budget of points, for a window of the plot
+    (see stats.plots.level_of_detail_payload). The window is given by the x0, x1, y0 and y1 parameters.
+    """
+    default_budget = 2000
+    max_budget = 20000
+
+    def get(self, request, *args, **kwargs):
+        scenario = self.object = self.get_object()
+        display_language, d1, d2, _, _ = self.get_plot_parameters(scenario)
+
+        try:
+            budget = int(request.GET.get('budget', self.default_budget))
+            window = None
+            if 'x0' in request.GET:
+                window = tuple(float(request.GET[parameter]) for parameter in ['x0', 'x1', 'y0', 'y1'])
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest('Invalid window or budget')
+        if not 1 <= budget <= self.max_budget:
+            return HttpResponseBadRequest('The budget should be between 1 and {}'.format(self.max_budget))
+
+        return JsonResponse(level_of_detail_payload(scenario, display_language, d1, d2, window, budget))
+
+
+class MDSFragmentsView(ScenarioDetail):
+    """Returns the texts of a batch of Fragments in a Scenario, for the tooltips in the matrix plot view"""
+    max_fragments = 100
+
+    def get(self, request, *args, **kwargs):
+        scenario = self.get_object()
+        try:
+            fragment_pks = [int(pk) for pk in request.GET.get('pks', '').split(',') if pk]
+        except ValueError:
+            return HttpResponseBadRequest('Invalid fragment ids')
+        if len(fragment_pks) > self.max_fragments:
+            return HttpResponseBadRequest('At most {} fragments can be requested at once'.format(self.max_fragments))
+
+        # Only allow Fragments that are part of the Scenario
+        fragment_pks = np.asarray(fragment_pks, dtype=np.int64)
+        fragment_pks = fragment_pks[np.isin(fragment_pks, scenario.get_fragments())].tolist()
+
+        texts = render_fragments(fragment_pks)
+        return JsonResponse({'fragments': {str(pk): text for pk, text in texts.items()}})
 
 
 class DescriptiveStatsView(ScenarioDetail):
@@ -301,8 +278,8 @@ class DescriptiveStatsView(ScenarioDetail):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        fragment_pks = self.object.mds_fragments
-        scenario_labels = self.object.get_labels()
+        cube = self.object.get_label_cube()
+        fragment_pks = cube.fragment_pks
 
         # Fetch the Languages, first sort as_from, then as_to
         languages_from = self.object.languages(as_from=True).order_by('language__iso')
@@ -311,18 +288,22 @@ class DescriptiveStatsView(ScenarioDetail):
 
         counters_tensecats = dict()
         fragments_per_label = dict()
-        tuples = defaultdict(tuple)
+        labels_per_code = dict()
         colors = dict()
         categories = dict()
         distinct_tensecats = set()
 
         label_cache = prepare_label_cache(self.object.corpus)
 
+        # The labels are integer-coded per language (see LabelCube), so the properties are retrieved per distinct label
         for language in languages:
             f_per_label = defaultdict(list)
             c_tensecats = Counter()
             labels = set()
-            for n, identifier in enumerate(scenario_labels[language.iso]):
+            labels_per_code[language] = []
+            counts = cube.label_counts(language.iso)
+            rows = cube.rows_per_label(language.iso)
+            for code, identifier in enumerate(cube.vocabulary[language.iso]):
                 label, color, category = get_label_properties_from_cache(identifier, label_cache, len(labels))
 
                 # multiple labels are expected, handle single tense labels
@@ -331,13 +312,13 @@ class DescriptiveStatsView(ScenarioDetail):
 
                 for tense_label in label:
                     labels.add(tense_label)
-                    f_per_label[tense_label].append(fragment_pks[n])
-                    tuples[n] += (tense_label,)
+                    f_per_label[tense_label].extend(fragment_pks[rows[code]].tolist())
                     colors[tense_label] = color
                     categories[tense_label] = category
+                labels_per_code[language].append(label)
 
                 distinct_tensecats.add(category)
-                c_tensecats.update([category])
+                c_tensecats[category] += int(counts[code])
 
             counters_tensecats[language] = c_tensecats
             fragments_per_label[language] = dict(f_per_label)
@@ -354,9 +335,15 @@ class DescriptiveStatsView(ScenarioDetail):
         categories_table_ordered = OrderedDict(
             sorted(list(categories_table.items()), key=lambda item: sum(item[1]) if item[0] else 0, reverse=True))
 
-        tuples_with_fragments = defaultdict(list)
-        for n, label_tuple in enumerate(tuples.values()):
-            tuples_with_fragments[label_tuple].append(fragment_pks[n])
+        # Combine the labels per label tuple, tuples with the same labels are merged
+        rows_per_tuple = defaultdict(list)
+        columns = [(cube.languages.index(language.iso), labels_per_code[language]) for language in languages]
+        for tuple_id in range(cube.n_tuples()):
+            rows = cube.tuple_rows(tuple_id)
+            label_tuple = sum((labels[cube.codes[rows[0], column]] for column, labels in columns), ())
+            rows_per_tuple[label_tuple].append(rows)
+        tuples_with_fragments = {label_tuple: fragment_pks[np.sort(np.concatenate(rows))].tolist()
+                                 for label_tuple, rows in rows_per_tuple.items()}
 
         fragments_per_label_count = {
             language.iso: sorted([[label, len(fs)] for label, fs in f_per_label.items()],
@@ -367,7 +354,7 @@ class DescriptiveStatsView(ScenarioDetail):
         context['counters'] = fragments_per_label
         context['counters_json'] = json.dumps(fragments_per_label_count)
         context['tensecat_table'] = categories_table_ordered
-        context['tuples_with_fragments'] = dict(tuples_with_fragments)
+        context['tuples_with_fragments'] = tuples_with_fragments
         context['colors_json'] = json.dumps(colors)
         context['tensecats_json'] = json.dumps(categories)
         context['languages'] = languages
@@ -415,27 +402,19 @@ class FragmentTableView(LimitedPublicAccessMixin, FilterView):
         if not scenario_pk or not fragment_pks:
             return Http404
 
-        # Don't fetch some of the PickledObjectFields
+        # Don't fetch the PickledObjectFields
         scenario = Scenario.objects \
-            .defer('mds_model', 'mds_matrix') \
+            .defer('mds_model', 'mds_matrix', 'mds_fragments', 'mds_labels', 'mds_stress_history') \
             .get(pk=scenario_pk)
 
-        # Find the index of the first Fragment
-        index = 0
-        for n, fragment in enumerate(scenario.mds_fragments):
-            if int(fragment_pks[0]) == fragment:
-                index = n
-                break
-
-        # Retrieve the labels for this specific Fragment
+        # Retrieve the labels for the first Fragment
+        cube = scenario.get_label_cube()
+        row = cube.find_row(int(fragment_pks[0]))
         label_cache = prepare_label_cache(scenario.corpus)
         labels = []
-        for values in scenario.get_labels().values():
-            for n, value in enumerate(values):
-                if index == n:
-                    label, _, _ = get_label_properties_from_cache(value, label_cache)
-                    labels.append(label)
-                    break
+        for value in cube.row_labels(row if row is not None else 0).values():
+            label, _, _ = get_label_properties_from_cache(value, label_cache)
+            labels.append(label)
 
         context['scenario'] = scenario
         context['labels'] = labels
@@ -450,20 +429,15 @@ class FragmentTableViewMDS(FragmentTableView):
         fragment_pks = self.request.session.get('fragment_pks', [])
         scenario_pk = self.request.session.get('scenario_pk')
 
-        # Include all fragments whose label set matches that of the selected fragment
-        fragment = int(fragment_pks[0])
-        fragment_pks = []
-        scenario = Scenario.objects.get(pk=scenario_pk)
-        all_labels = scenario.get_labels()
-        scenario_fragments = scenario.mds_fragments
-        sequence = scenario_fragments.index(fragment)
-        languages = all_labels.keys()
-        label_key = tuple(all_labels[lang][sequence] for lang in languages)
-
-        for seq, frag in enumerate(scenario_fragments):
-            labels = tuple(all_labels[lang][seq] for lang in languages)
-            if labels == label_key:
-                fragment_pks.append(frag)
+        # Include all fragments whose label set matches that of the selected fragment,
+        # these are looked up in the index of the Fragments per label tuple (see LabelCube)
+        scenario = Scenario.objects \
+            .defer('mds_model', 'mds_matrix', 'mds_fragments', 'mds_labels',
+                   'mds_stress_history') \
+            .get(pk=scenario_pk)  # Don't fetch the PickledObjectFields
+        cube = scenario.get_label_cube()
+        tuple_id = cube.find_tuple(int(fragment_pks[0]))
+        fragment_pks = cube.tuple_fragments(tuple_id) if tuple_id is not None else []
 
         return self.queryset_for_fragments(fragment_pks)
 
@@ -476,31 +450,34 @@ class UpsetView(ScenarioDetail):
         context = super().get_context_data(**kwargs)
 
         scenario = self.object
-        labels = scenario.get_labels()
-        fragments = scenario.mds_fragments
+        cube = scenario.get_label_cube()
 
         # Get the currently selected TenseCategory. We pick "Present Perfect" as the default here.
         # TODO: we might want to change this magic number into a setting?
         tc_pk = int(self.kwargs.get('tc', TenseCategory.objects.get(title='Present Perfect').pk))
 
-        results = []
-        languages = set()
+        # Decide per distinct label whether its Tense is in the selected TenseCategory, then look up the labels
         tense_cache = {t.pk: t for t in Tense.objects.select_related('category')}
-        for n, fragment_pk in enumerate(fragments):
-            d = {'fragment_pk': fragment_pk}
-            for language, label in list(labels.items()):
-                languages.add(language)
-                label = label[n]
+        columns = dict()
+        for language in cube.languages:
+            in_category = []
+            for label in cube.vocabulary[language]:
+                tense = None
                 if isinstance(label, numbers.Number):
                     tense = tense_cache.get(label)
                 # TODO: below is a temporary fix to work with newer Scenarios.
                 # Ideally, we first make sure the Scenario works with Tense only.
-                if isinstance(label, tuple):
+                if isinstance(label, tuple) and label:
                     tense_pk = int(label[0].split(':')[1])
                     tense = tense_cache.get(tense_pk)
-                d[str(language)] = int(tense.category.pk == tc_pk)
+                in_category.append(int(tense is not None and tense.category.pk == tc_pk))
+            columns[str(language)] = np.asarray(in_category, dtype=np.int64)[cube.column(language)].tolist()
 
-            results.append(d)
+        results = [{'fragment_pk': fragment_pk} for fragment_pk in cube.fragment_pks.tolist()]
+        for language, values in columns.items():
+            for d, value in zip(results, values):
+                d[language] = value
+        languages = set(columns)
 
         context['tense_categories'] = TenseCategory.objects.all()
         context['selected_tc'] = TenseCategory.objects.get(pk=tc_pk)
@@ -513,126 +490,38 @@ class UpsetView(ScenarioDetail):
 class SankeyView(ScenarioDetail):
     model = Scenario
     template_name = 'stats/sankey.html'
+    lfrom_options = {
+        'get_formal_structure_display': 'Formal structure',
+        'get_sentence_function_display': 'Sentence function'
+    }
+    lto_options = {}  # None as of yet...
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
         scenario = self.object
-        mds_labels = scenario.get_labels()
-        fragment_pks = scenario.mds_fragments
         languages_from = scenario.languages(as_from=True)
         languages_to = scenario.languages(as_to=True)
 
         language_from = self.request.GET.get('language_from', languages_from.first().language.iso)
         language_to = self.request.GET.get('language_to', languages_to.first().language.iso)
+        # Only allow the options that are offered (these are part of the cache key)
         lfrom_option = self.request.GET.get('lfrom_option')
-        lfrom_option = None if lfrom_option == 'none' else lfrom_option
+        lfrom_option = lfrom_option if lfrom_option in self.lfrom_options else None
         lto_option = self.request.GET.get('lto_option')
-        lto_option = None if lto_option == 'none' else lto_option
-
-        # Simplify labels (from tuples to single values)
-        def simplify(value):
-            result = value[0] if isinstance(value, tuple) else value
-            if not result:
-                result = '-'
-            return result
-
-        labels = dict()
-        for language, values in mds_labels.items():
-            labels[language] = [simplify(v) for v in values]
-
-        # Retrieve nodes and links
-        nodes = defaultdict(set)
-        for language, ls in labels.items():
-            if language in [language_from, language_to]:
-                for label in ls:
-                    nodes[language].add(label) if label else nodes[language].add('-')
-
-        # Retrieve the values for the source language
-        lfrom_values = []
-        if lfrom_option:
-            # Solution to preserve order taken from https://stackoverflow.com/a/37648265
-            preserved = Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(fragment_pks)])
-            fragments = Fragment.objects.filter(pk__in=fragment_pks).order_by(preserved)
-            for fragment in fragments:
-                lfrom_value = getattr(fragment, lfrom_option)() if lfrom_option.endswith('display') \
-                    else getattr(fragment, lfrom_option)
-                nodes['-'].add(lfrom_value)
-                lfrom_values.append(lfrom_value)
-
-        # Retrieve the values for the target language
-        lto_values = []
-        if lto_option:
-            annotations = Annotation.objects \
-                .filter(alignment__original_fragment__pk__in=fragment_pks,
-                        alignment__translated_fragment__language__iso=language_to) \
-                .select_related('alignment__original_fragment')
-            annotations = {a.alignment.original_fragment.pk: a for a in annotations}
-            for fragment_pk in fragment_pks:
-                annotation = annotations.get(fragment_pk)
-                lto_value = 'none'
-                if annotation:
-                    lto_value = getattr(annotation, lto_option)
-                nodes['-'].add(lto_value)
-                lto_values.append(lto_value)
-
-        # Count the links  # TODO: can we do this in a more generic way?
-        list_of_lists = [labels[language_from]]
-        for label in [lfrom_values, labels[language_to], lto_values]:
-            if label:
-                list_of_lists.append(label)
-
-        links = defaultdict(list)
-        for l1, l2 in zip(list_of_lists, list_of_lists[1:]):
-            zipped = list(zip(l1, l2))
-            for n, link in enumerate(zipped):
-                origin = list_of_lists[0][n]
-                links[(origin, link[0], link[1])].append(fragment_pks[n])
-
-        # Convert the nodes into a dictionary
-        label_cache = prepare_label_cache(scenario.corpus)
-        new_nodes = []
-        i = 0
-        for language, nodes_per_language in nodes.items():
-            for node in nodes_per_language:
-                node_label, node_color, _ = get_label_properties_from_cache(node, label_cache, allow_empty=True)
-                new_node = {'id': i, 'language': language, 'node': node, 'color': node_color, 'label': node_label}
-                new_nodes.append(new_node)
-                i += 1
-
-        def find_node(list_of_dicts, language, node):
-            return next(item for item in list_of_dicts
-                        if item.get('language') in [language, '-'] and item.get('node') == node)
-
-        # Convert the links into a dictionary
-        new_links = []
-        for link, fragment_pks in links.items():
-            for l0, l1, l2 in zip(link, link[1:], link[2:]):
-                l0_label, l0_color, _ = get_label_properties_from_cache(l0, label_cache)
-                new_link = {
-                    'origin': find_node(new_nodes, language_from, l0).get('id'),
-                    'origin_label': l0_label, 'origin_color': l0_color,
-                    'source': find_node(new_nodes, language_from, l1).get('id'),
-                    'target': find_node(new_nodes, language_to, l2).get('id'),
-                    'value': len(fragment_pks), 'fragment_pks': fragment_pks
-                }
-                new_links.append(new_link)
-        new_links = sorted(new_links, key=lambda l: l['origin_color'])
-
-        # JSONify the data and add it to the context
-        context['data'] = json.dumps({'nodes': new_nodes, 'links': new_links})
+        lto_option = lto_option if lto_option in self.lto_options else None
+
+        # Retrieve the (cached) nodes and links
+        context['data'] = sankey_payload(scenario, language_from, language_to, lfrom_option, lto_option)
 
         # Add selection of languages to the context
         context['languages_from'] = languages_from
         context['languages_to'] = languages_to
         context['selected_language_from'] = language_from
         context['selected_language_to'] = language_to
-        context['lfrom_options'] = {
-            'get_formal_structure_display': 'Formal structure',
-            'get_sentence_function_display': 'Sentence function'
-        }
+        context['lfrom_options'] = self.lfrom_options
         context['selected_lfrom_option'] = lfrom_option
-        context['lto_options'] = {}  # None as of yet...
+        context['lto_options'] = self.lto_options
         context['selected_lto_option'] = lto_option
 
         return context
@@ -653,36 +542,11 @@ class ScenarioDownload(LoginRequiredMixin, ScenarioDetail):
     def get(self, request, *args, **kwargs):
         scenario = self.get_object()
 
-        try:
-            matrix_filename = 's{}-matrix.feather'.format(scenario.pk)
-            export_matrix(matrix_filename, scenario)
-        except ValueError:
-            matrix_filename = None
-
-        tensecats_filename = 'tensecats.feather'
-        export_tensecats(tensecats_filename)
-
-        fragments_filename = 's{}-labels.feather'.format(scenario.pk)
-        export_fragments(fragments_filename, scenario)
-
-        zip_filename = 's{}.zip'.format(scenario.pk)
-        zip_file = ZipFile(zip_filename, 'w')
-        if matrix_filename:
-            zip_file.write(matrix_filename)
-        zip_file.write(tensecats_filename)
-        zip_file.write(fragments_filename)
-        zip_file.close()
-
-        with open(zip_filename, 'rb') as f:
-            contents = f.read()
-        if matrix_filename:
-            os.unlink(matrix_filename)
-        os.unlink(tensecats_filename)
-        os.unlink(fragments_filename)
-        os.unlink(zip_filename)
-
-        response = HttpResponse(contents, content_type='application/zip')
-        response['Content-Disposition'] = 'attachment; filename={}'.format(zip_filename)
+        # The export is created once per run, and streamed from disk
+        zip_file = export_zip(scenario)
+        response = FileResponse(zip_file, content_type='application/zip')
+        response['Content-Length'] = os.fstat(zip_file.fileno()).st_size
+        response['Content-Disposition'] = 'attachment; filename=s{}.zip'.format(scenario.pk)
         return response
 
 
@@ -702,3 +566,10 @@ class CaptchaTestView(generic.FormView):
         messages.error(self.request, "You might be a human, but the answer you submitted was not a good one. Please try again.")
 
         return super().form_invalid(form)
+
+
+class LabelCacheStatistics(SuperuserRequiredMixin, generic.View):
+    """Shows the hits and misses of the label cache (see prepare_label_cache), for monitoring"""
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(label_cache_statistics())
@@ -161,4 +161,27 @@ LOGIN_REDIRECT_URL = '/timealign/status'
 # Path to where the PerfectExtractor corpora reside
 PE_DATA_PATH = '/opt/Corpora/'
 
+# Path to where the results of Scenarios (MDS models and matrices) are stored on disk
+SCENARIO_DATA_PATH = os.path.join(BASE_DIR, 'scenarios')
+
+# Whether to compute the matrix plots of a Scenario right after it has been run (see stats.plots.precompute_plots)
+SCENARIO_PRECOMPUTE_PLOTS = False
+
+# The interval (in seconds) at which workers update the heartbeat of a running ScenarioJob, and the time after which
+# a running job without a heartbeat is considered stale and is queued again (see stats.jobs.requeue_stale_jobs),
+# up to a maximum number of attempts
+SCENARIO_JOB_HEARTBEAT = 30
+SCENARIO_JOB_TIMEOUT = 600
+SCENARIO_JOB_MAX_ATTEMPTS = 3
+
+# The cache is shared between processes, as the properties of Tenses and Labels are invalidated through it
+# (see stats.utils.prepare_label_cache). It can be replaced in settings_secret.py, e.g. by memcached.
+if 'CACHES' not in locals():
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(BASE_DIR, 'cache'),
+        }
+    }
+
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
@@ -7,3 +7,13 @@ user_db = {
     'HOST': 'localhost',   # Or an IP Address that your DB is hosted on
     'PORT': '3306',  # You can use '' for localhost
 }
+
+# Cache settings. The properties of Tenses and Labels are cached (see stats.utils.prepare_label_cache), and their
+# invalidation must reach every process, so use a cache that is shared between processes. By default, a file-based
+# cache is used (see settings.py). When the application runs on multiple hosts, use e.g.:
+# CACHES = {
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+#         'LOCATION': '127.0.0.1:11211',
+#     }
+# }